@@ -23,10 +23,17 @@ import multiprocessing
 # multiprocessing module.
 # See http://stackoverflow.com/questions/6974695/python-process-pool-non-daemonic
 from datetime import datetime
+from collections import Counter, OrderedDict
+import math
+import numpy as np
+from scipy.spatial import cKDTree
 import mcerp
-import gmpes
+import caravan.core.gmpes.gmpes as gmpes
 import caravan.core.gmpes.gmpe_utils as gmpe_utils
 from runutils import RunInfo
+from scenario import latest_session
+import workerpool
+import spatialindex
 import caravan.settings.globalkeys as gk
 
 
@@ -39,7 +46,10 @@ import caravan.settings.globalkeys as gk
 #http://initd.org/psycopg/install/
 
 import caravan.settings.globals as globals
+import caravan.dbutils as dbutils
 import risk_calc
+import risk.exposure_module as exposure_module
+import risk.loss_module as loss_module
 
 _DEBUG_= globals._DEBUG_
 #mcerp.npts = globals.mcerp_npts
@@ -51,11 +61,21 @@ import random
 _intensity_labels = (4.5, 5.5, 6.5, 7.5, 8.5, 9.5, 10.5)
 
 #def geocell_run(gmpe_func, lat_sta, lon_sta, percentiles, target_id, geocell_id, ground_motion_only, scenario_id, session_id, logdir = None ):
-def geocell_run(intensity, lat_sta, lon_sta, percentiles, target_id, geocell_id, ground_motion_only, scenario_id, session_id, logdir = None ):
+def geocell_run(intensity, lat_sta, lon_sta, percentiles, target_id, geocell_id, ground_motion_only, scenario_id, session_id, logdir = None, conn = None, writer = None, 
+                failures = None):
     """
         Performs a ground motion calculation given the above arguments. Writes to database the percentiles
+        conn is the database connection to use. If None, a new connection is opened and closed. 
+        writer is an optional dbutils.BatchWriter of processing.ground_motion (see _GM_COLUMNS): if given, 
+        the ground motion row is added to it instead of being inserted immediately. 
+        failures is an optional collections.Counter: if given, a failure is counted in it (keyed by exception class name) 
+        and it is up to the caller to write the failures to the database. Otherwise, the failed targets counter of the 
+        session is incremented immediately. 
+        Returns the median intensity, or None if the calculation failed
     """
     
+    close_conn = conn is None
+    
     def val(value):
         #value should be either a scalar number or a numpy.ndarray element. Check below is WEAK, because it checks only if 
         #len(value) can be called, but it avoids importing numpy etcetera
@@ -82,13 +102,18 @@ def geocell_run(intensity, lat_sta, lon_sta, percentiles, target_id, geocell_id,
 #        arg1 =  """INSERT INTO processing.ground_motion (target_id, geocell_id, scenario_id, session_id, percentiles, ground_motion) VALUES (%s, %s, %s, %s, %s, %s);""" 
 #        arg2 = (target_id, geocell_id, scenario_id, session_id, _p, _dist) 
         
-        conn = globals.connection()
-        conn.execute(arg1, arg2)
-        conn.close()
+        if writer is not None:
+            writer.add(arg2)
+        else:
+            if conn is None:
+                conn = globals.connection()
+            conn.execute(arg1, arg2, prepare=globals.DB_PREPARED)
         
         #do risk calculation (risk is Michael source, modified by me)
         if not ground_motion_only:
-            risk_calc.calculaterisk(intensity, percentiles, session_id, scenario_id, target_id, geocell_id)
+            risk_calc.calculaterisk(intensity, percentiles, session_id, scenario_id, target_id, geocell_id, conn)
+        
+        return _dist[-1]
 
     except Exception as run_exc:
     
@@ -96,10 +121,14 @@ def geocell_run(intensity, lat_sta, lon_sta, percentiles, target_id, geocell_id,
             import traceback
             traceback.print_exc()
         
-        #connect to the database and write the failed number:
-        conn = globals.connection()
-        conn.execute("UPDATE processing.sessions SET num_targets_failed = num_targets_failed + 1 where gid=%s",(session_id,))
-        conn.close()
+        if failures is not None:
+            failures[type(run_exc).__name__] += 1
+        else:
+            #connect to the database and write the failed number:
+            if conn is None:
+                conn = globals.connection()
+            conn.execute("UPDATE processing.sessions SET num_targets_failed = num_targets_failed + 1 where gid=%s",(session_id,), 
+                         prepare=globals.DB_PREPARED)
         
         #         log dir must be passed as argument problems when declaring global var (maybe multiprocess?)
         if _DEBUG_:
@@ -115,8 +144,242 @@ def geocell_run(intensity, lat_sta, lon_sta, percentiles, target_id, geocell_id,
                 except:
                     traceback.print_exc()
         #raise run_exc
+    finally:
+        if close_conn and conn is not None:
+            conn.close()
         
 
+#columns of processing.ground_motion written by geocell_run (see argument writer):
+_GM_COLUMNS = ('target_id', 'geocell_id', 'scenario_id', 'session_id', 'ground_motion')
+
+#worker process state (see _worker_gmpe): the gmpes of the most recent sessions, from the least to the most 
+#recently used. The dispatcher interleaves the tasks of concurrent sessions (see workerpool), thus a worker keeps 
+#the gmpes of up to as many sessions as the pool processes (at least 2):
+_worker_gmpes = OrderedDict()
+
+def _worker_gmpe(session_id, gmpe_spec, npts):
+    """
+        Returns the gmpe built from gmpe_spec (see gmpes.Gmpe.spec) from within a worker process.
+        The gmpe is built once per session and worker process, and cached (see _worker_gmpes). npts is the 
+        mcerp number of points (mcerp.npts) of the calling process
+    """
+    mcerp.npts = npts #(set anyway, as the previous task might belong to another session)
+    gmpe = _worker_gmpes.pop(session_id, None)
+    if gmpe is None:
+        gmpe = gmpes.fromspec(gmpe_spec)
+        processes = globals.pool_processes if globals.pool_processes > 0 else multiprocessing.cpu_count()
+        while len(_worker_gmpes) >= max(2, processes):
+            _worker_gmpes.popitem(last=False)
+    _worker_gmpes[session_id] = gmpe #(re-)inserted as the most recently used
+    return gmpe
+
+def chunks(targets, chunk_size, tile_deg=None):
+    """
+        Splits targets (list of tuples target_id, geocell_id, lon, lat) into blocks to be processed 
+        each in a single task (see targets_run). Returns the tuple (targets, ranges), where ranges is 
+        a list of (start, end) indices of the returned targets, each range holding at most chunk_size targets. 
+        If tile_deg is a positive number, targets are also grouped by spatial tiles of tile_deg x tile_deg 
+        degrees (the returned targets are sorted accordingly), so that a block never spans over two tiles. 
+        Otherwise, the returned targets are the input targets
+    """
+    chunk_size = max(1, int(chunk_size))
+    if not tile_deg or tile_deg <= 0:
+        return targets, [(i, min(i+chunk_size, len(targets))) for i in xrange(0, len(targets), chunk_size)]
+    
+    tile = lambda t: (int(math.floor(t[3] / tile_deg)), int(math.floor(t[2] / tile_deg)))
+    targets = sorted(targets, key=tile)
+    ranges = []
+    start = 0
+    for i in xrange(1, len(targets)+1):
+        if i == len(targets) or i - start == chunk_size or tile(targets[i]) != tile(targets[start]):
+            ranges.append((start, i))
+            start = i
+    return targets, ranges
+
+#number of neighbours of a cell in the multi-resolution refinement (see refine_targets):
+_REFINE_NEIGHBOURS = 6
+
+def refine_targets(gmpe_func, coarse, fine, min_intensity=None, min_delta=None, min_fatalities=None, exposure=None):
+    """
+        Multi-resolution refinement of the targets of a coarse tessellation (see user_options.refine_tess_ids). 
+        coarse and fine are lists of (well formed) tuples target_id, geocell_id, lon, lat, where fine holds the targets 
+        of a finer tessellation over the same area. Each fine target belongs to the cell of its nearest coarse target 
+        (as in a Voronoi tessellation): this approximates the coarse cell polygons, which are not known here, so that 
+        fine cells crossing the border of a refined coarse cell might be included while overlapping a coarse cell not 
+        refined (or vice versa, excluded). A coarse cell is refined, i.e. replaced by the fine targets it holds, if its 
+        median intensity (gmpe_func evaluated at once on all coarse targets, see Gmpe.evaluate_many): 
+            - is greater or equal than min_intensity, or 
+            - differs by at least min_delta from the median intensity of one of its neighbouring cells, or
+        if its expected fatalities (see risk_calc.fatalities_many, with the given exposure arrays of the coarse targets, 
+        see exposure_module.select) are greater or equal than min_fatalities. None disables the relative criterion. 
+        Returns the tuple (targets, num_refined), where targets is the list of the fine targets of the refined cells 
+        followed by the coarse targets not refined (or refined but holding no fine target, which are kept), and 
+        num_refined is the number of refined coarse cells replaced by fine targets
+    """
+    if not coarse or not fine:
+        return list(coarse or fine), 0
+    
+    lons = np.array([float(t[2]) for t in coarse])
+    lats = np.array([float(t[3]) for t in coarse])
+    I = gmpe_func.evaluate_many(lats, lons)
+    medians = globals.percentile_many(I, [0.5])[:, 0]
+    
+    refine = np.zeros(len(coarse), dtype=bool)
+    if min_intensity is not None:
+        refine |= medians >= min_intensity
+    tree = cKDTree(spatialindex.unit_vectors(lats, lons))
+    if min_delta is not None and len(coarse) > 1:
+        #neighbours (first column: the cell itself):
+        _, neighbours = tree.query(spatialindex.unit_vectors(lats, lons), min(_REFINE_NEIGHBOURS, len(coarse)-1) + 1)
+        refine |= np.max(np.abs(medians[neighbours] - medians[:, None]), axis=1) >= min_delta
+    if min_fatalities is not None and exposure is not None and np.any(exposure['valid']):
+        ok = exposure['valid']
+        fatalities = np.zeros(len(coarse))
+        fatalities[ok] = np.mean(risk_calc.fatalities_many(np.asarray(I)[ok], {k: v[ok] for k, v in exposure.iteritems()}), axis=1)
+        refine |= fatalities >= min_fatalities
+    
+    _, owners = tree.query(spatialindex.unit_vectors([t[3] for t in fine], [t[2] for t in fine]))
+    #coarse cells to be refined holding no fine target are kept (otherwise their area would be lost):
+    refine &= np.bincount(owners, minlength=len(coarse)) > 0
+    targets = [t for t, owner in zip(fine, owners) if refine[owner]] + [t for t, r in zip(coarse, refine) if not r]
+    return targets, int(np.sum(refine))
+
+def targets_run(gmpe_spec, npts, targets, percentiles, ground_motion_only, scenario_id, session_id, logdir = None, exposure = None):
+    """
+        Calculates the intensities of the targets (list of tuples target_id, geocell_id, lon, lat) with 
+        the gmpe of the given spec (see _worker_gmpe) and runs geocell_run for each of them, with a single database connection. 
+        Ground motions are written in batches (see user_options.db_batch_size and db_batch_interval), all written 
+        before this function returns. 
+        Unless ground_motion_only is True, the risk is calculated for all targets of a batch at once (see risk_calc.calculaterisk_many 
+        and _risk_run) with the given exposure arrays of the targets (see exposure_module.select, None: load them from the database). 
+        Called from within a worker process. Returns the tuple (target_ids, medians, failures, skipped) where target_ids and medians are 
+        numpy arrays, medians holds the median intensity of each target (NaN if the target calculation failed), failures 
+        is a dict of the number of failed targets keyed by reason (usually the exception class name) and skipped is the 
+        number of targets whose risk calculation was skipped (see user_options.risk_cutoff_intensity). 
+        Failed targets are written to the database with a single update of the session failed targets counter. 
+        If the session is canceled (see workerpool.cancelled, checked between batches), the remaining targets are 
+        not calculated (NaN medians) and not counted as failed in the database
+    """
+    failures = Counter()
+    skipped = 0
+    gmpe_error = None
+    if workerpool.cancelled(session_id):
+        return np.array([t[0] for t in targets]), np.full(len(targets), np.nan), {}, skipped
+    try:
+        intensities = _worker_gmpe(session_id, gmpe_spec, npts).evaluate_many([t[3] for t in targets], [t[2] for t in targets])
+    except Exception as exc:
+        if _DEBUG_:
+            import traceback
+            traceback.print_exc()
+        gmpe_error = type(exc).__name__
+        intensities = [None] * len(targets) #all targets failed (see below)
+    
+    medians = np.full(len(targets), np.nan) #NaN: not calculated (e.g., session canceled, see below)
+    conn = globals.connection()
+    try:
+        #Ground motions and risk results are written in batches (see user_options.db_batch_size and db_batch_interval). 
+        #Unless ground_motion_only is True, a batch of ground motions is written only after the risk results of the 
+        #same targets, so that the progress (which counts ground motions) implies written risk results:
+        gm_writer = dbutils.BatchWriter(conn, 'processing.ground_motion', _GM_COLUMNS, globals.db_batch_size, 
+                                        globals.db_batch_interval, autoflush=ground_motion_only, prepare=globals.DB_PREPARED)
+        risk_writer = dbutils.BatchWriter(conn, 'risk.social_conseq', loss_module.SOCIAL_CONSEQ_COLUMNS, 
+                                          len(targets), autoflush=False, prepare=globals.DB_PREPARED)
+        batch = [] #indices of the targets of the current batch
+        for i, (t, intensity) in enumerate(zip(targets, intensities)):
+            #between batches (all previous results written), stop if the session has been canceled:
+            if (not batch or not gm_writer.rows) and workerpool.cancelled(session_id):
+                break
+            if gmpe_error is not None:
+                failures[gmpe_error] += 1
+                median = None
+            else:
+                intensity = intensity if len(intensity) > 1 else float(intensity[0]) #a single point is a scalar
+                median = geocell_run(intensity, t[3], t[2], percentiles, t[0], t[1], True, scenario_id, session_id, logdir, conn, gm_writer, 
+                                     failures)
+            medians[i] = np.nan if median is None else median
+            batch.append(i)
+            
+            if i == len(targets) - 1 or (not ground_motion_only and gm_writer.due()):
+                #do risk calculation on the (cells x samples) intensity matrix of the succesfully calculated targets:
+                if not ground_motion_only:
+                    skipped += _risk_run(batch, targets, intensities, medians, percentiles, scenario_id, session_id, conn, exposure, 
+                                         risk_writer, failures)
+                gm_writer.flush()
+                batch = []
+        
+        #ground motions not written (failed batch writes) are failed targets, counted once (targets already failed, 
+        #e.g. in the risk calculation, are not counted again):
+        if gm_writer.dropped:
+            dropped = set(row[0] for row in gm_writer.dropped)
+            indices = [i for i, t in enumerate(targets) if t[0] in dropped and not np.isnan(medians[i])]
+            medians[indices] = np.nan
+            failures[_DB_WRITE_FAILURE] += len(indices)
+        
+        #a single increment per chunk (instead of one per failed target) to avoid contention on the session row:
+        num_failed = sum(failures.itervalues())
+        if num_failed:
+            conn.execute("UPDATE processing.sessions SET num_targets_failed = num_targets_failed + %s where gid=%s",
+                         (num_failed, session_id,), prepare=globals.DB_PREPARED)
+    finally:
+        conn.close()
+    
+    return np.array([t[0] for t in targets]), medians, dict((k, v) for k, v in failures.iteritems() if v), skipped
+
+#failure reasons (see targets_run) not related to a specific exception:
+_DB_WRITE_FAILURE = "database write"
+_RISK_FAILURE = "risk calculation"
+
+def _risk_run(indices, targets, intensities, medians, percentiles, scenario_id, session_id, conn, exposure, writer, failures):
+    """
+        Runs the risk calculation of the targets at the given indices with a valid (not NaN) median (see targets_run), 
+        and flushes writer. Sets to NaN the medians of the targets whose calculation failed, and counts them in failures 
+        (collections.Counter keyed by failure reason). Targets whose intensities are (almost) all below the damage 
+        relevant level are skipped (see user_options.risk_cutoff_intensity). Returns the number of skipped targets
+    """
+    indices = [i for i in indices if not np.isnan(medians[i])]
+    skipped = 0
+    cutoff = globals.risk_cutoff_intensity
+    if indices and cutoff is not None:
+        #probability of exceeding the cutoff of each target (cells x samples matrix, a single column denotes scalars):
+        prob = np.mean(np.asarray(intensities)[indices] >= cutoff, axis=1)
+        skipped = int(np.sum(prob <= globals.risk_cutoff_tol))
+        indices = [i for i, p in zip(indices, prob) if p > globals.risk_cutoff_tol]
+    if not indices:
+        return skipped
+    try:
+        failed = risk_calc.calculaterisk_many(np.asarray(intensities)[indices], percentiles, session_id, scenario_id, 
+                                              [targets[i][0] for i in indices], [targets[i][1] for i in indices], conn, 
+                                              None if exposure is None else {k: v[indices] for k, v in exposure.iteritems()}, 
+                                              writer)
+        writer.flush()
+        dropped = set(row[3] for row in writer.dropped) #target ids
+        del writer.dropped[:]
+        dropped = np.array([targets[i][0] in dropped for i in indices], dtype=bool)
+        failures[_RISK_FAILURE] += int(np.sum(failed))
+        failures[_DB_WRITE_FAILURE] += int(np.sum(dropped & ~failed))
+        failed |= dropped
+    except Exception as exc:
+        if _DEBUG_:
+            import traceback
+            traceback.print_exc()
+        del writer.rows[:]
+        failed = np.ones(len(indices), dtype=bool)
+        failures[type(exc).__name__] += len(indices)
+    medians[np.asarray(indices)[failed]] = np.nan
+    return skipped
+
+def _progress_callback(runinfo, num_targets):
+    #returns the callback of a targets_run task (see workerpool.WorkerPool.submit) updating the in-memory 
+    #progress of runinfo with the task result. If the task raised, all its targets are failed
+    def callback(ret):
+        result, error = ret
+        if error is not None or result is None:
+            runinfo.update(0, num_targets, {error or "internal error": num_targets})
+        else:
+            num_failed = int(np.isnan(result[1]).sum())
+            runinfo.update(num_targets - num_failed, num_failed, result[2], result[3])
+    return callback
+
 def caravan_run(input_event):
     """
         Performs a gorund motion calculation of the Caravan application
@@ -167,7 +430,7 @@ def caravan_run(input_event):
             
             # if an already-simulated scenario is supplied simulation is skipped
 
-            session_id = conn.fetchall( "select * from processing.sessions where scenario_id=%s;", (scenario_id,) )[-1][0] 
+            session_id = latest_session(conn, scenario_id)
             
             runinfo.msg("Using already stored Scenario (hash={0:d}), skipping simulation".format(scenario.dbhash()))
             
@@ -205,15 +468,30 @@ def caravan_run(input_event):
         key_tess_ids = gk.TES
         tess_ids = globals.tess_ids if not key_tess_ids in scenario else scenario[key_tess_ids]
         
-        tess_id_str = " or ".join([("t.tess_id={:d}".format(t)) for t in tess_ids])
         runinfo.msg("Tessellation id(s): {}".format(', '.join(["{:d}".format(tid) for tid in tess_ids])))
         
+        #adaptive multi-resolution mode (see user_options.refine_tess_ids), if at least two of the given tessellations 
+        #are in the configured hierarchy: the targets are selected from the coarsest tessellation first, and refined 
+        #with the targets of the finer ones afterwards (see below):
+        refine_tess_ids = [t for t in (globals.refine_tess_ids or []) if t in tess_ids]
+        if len(refine_tess_ids) > 1:
+            ignored = [t for t in tess_ids if t not in refine_tess_ids]
+            if ignored:
+                runinfo.warning("Tessellation id(s) {} not in the multi-resolution hierarchy (ignored)"
+                                .format(', '.join(["{:d}".format(tid) for tid in ignored])))
+            runinfo.msg("Multi-resolution tessellation id(s), from the coarsest: {}"
+                        .format(', '.join(["{:d}".format(tid) for tid in refine_tess_ids])))
+            tess_ids = refine_tess_ids[:1]
+        else:
+            refine_tess_ids = None
+        
+        key_gm_only = gk.GMO
+        gm_only = scenario[key_gm_only] if key_gm_only in scenario else globals.gm_only
+        
+        #vertices of the area of interest polygon, if any (extended sources, see below):
+        poly_lons = poly_lats = None
+        
         if a_ref is not None: 
-            lon1, lat1, lon2, lat2 = a_ref
-            targets = conn.fetchall("""select t.gid as target_id, t.geocell_id as geocell_id, st_X(t.the_geom) as lon, 
-        st_Y(t.the_geom) as lat from exposure.targets as t where ("""+tess_id_str+""") 
-        and st_within(t.the_geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326));""", (lon1, lat1, lon2, lat2))
-
             runinfo.msg("Area: map rectangle ("+key_a_ref+" parameter [lon1, lat1, lon2, lat2], see above)") #str should place dot or not automatically
 
         else:
@@ -223,7 +501,7 @@ def caravan_run(input_event):
             I_ref = scenario[key_i_ref] if key_i_ref in scenario else globals.aoi_i_ref
             ref_dist_km_step = scenario[key_i_ref_km_step] if key_i_ref_km_step in scenario else globals.aoi_km_step #ref_dist_km_step
 
-            ref_d = ref_dist(gmpe_func, I_ref, ref_dist_km_step)
+            ref_d, azimuths, radii = ref_dists(gmpe_func, I_ref, ref_dist_km_step, _AOI_AZIMUTHS)
             runinfo.msg("Area(I &ge; {:.2f}) radius: {:.1f} Km" .format(I_ref, ref_d)) #str should place dot or not automatically
 
             if ref_d < ref_dist_km_step:
@@ -237,34 +515,76 @@ def caravan_run(input_event):
             key_lon = gk.LON #"longitude"
 
 
-            targets = conn.fetchall("""select t.gid as target_id, t.geocell_id as geocell_id, st_X(t.the_geom) as lon, 
+            if len(radii) > 2 and np.min(radii) < ref_d:
+                #extended source: the area is elongated (e.g., along the fault strike). Select the targets within the 
+                #polygon of the radii, which excludes many targets of the circle of radius ref_d below I_ref:
+                runinfo.msg("Area(I &ge; {:.2f}) minimum radius: {:.1f} Km" .format(I_ref, np.min(radii)))
+                poly_lons, poly_lats = aoi_vertices(scalar(key_lat), scalar(key_lon), azimuths, radii)
+        
+        def select_targets(tess_ids):
+            #returns the targets of the given tessellations within the area of interest. The targets are selected from the 
+            #in-memory spatial indices of the tessellations, if enabled (see spatialindex module). If the latter cannot be loaded, 
+            #fall back to the database spatial queries below:
+            indexes = None
+            if globals.spatial_index:
+                try:
+                    indexes = [spatialindex.get(conn, t) for t in tess_ids]
+                except Exception as exc:
+                    if _DEBUG_:
+                        import traceback
+                        traceback.print_exc()
+                    conn.rollback()
+                    runinfo.warning("Spatial index not loaded, selecting targets from the database ({})".format(str(exc).strip()))
+            
+            tess_id_str = " or ".join([("t.tess_id={:d}".format(t)) for t in tess_ids])
+            
+            if a_ref is not None:
+                lon1, lat1, lon2, lat2 = a_ref
+                if indexes is not None:
+                    return [t for index in indexes for t in index.within_box(lon1, lat1, lon2, lat2)]
+                return conn.fetchall("""select t.gid as target_id, t.geocell_id as geocell_id, st_X(t.the_geom) as lon, 
+            st_Y(t.the_geom) as lat from exposure.targets as t where ("""+tess_id_str+""") 
+            and st_within(t.the_geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326));""", (lon1, lat1, lon2, lat2))
+            elif poly_lons is not None:
+                if indexes is not None:
+                    #(the circle passed is the one enclosing the polygon, see aoi_vertices):
+                    return [t for index in indexes for t in index.within_polygon(poly_lons, poly_lats, scalar(key_lat), scalar(key_lon), 
+                                                                                 ref_d * _aoi_scale(azimuths))]
+                return conn.fetchall("""select t.gid as target_id, t.geocell_id as geocell_id, st_X(t.the_geom) as lon, 
+            st_Y(t.the_geom) as lat from exposure.targets as t where ("""+tess_id_str+""") 
+            and st_within(t.the_geom, st_geomfromtext(%s, 4326));""" , (aoi_polygon(poly_lons, poly_lats),))
+            elif indexes is not None:
+                return [t for index in indexes for t in index.within_distance(scalar(key_lat), scalar(key_lon), ref_d)]
+            return conn.fetchall("""select t.gid as target_id, t.geocell_id as geocell_id, st_X(t.the_geom) as lon, 
             st_Y(t.the_geom) as lat from exposure.targets as t where ("""+tess_id_str+""") 
             and st_dwithin(geography(st_point(%s, %s)), geography(t.the_geom), %s);""" , (scalar(key_lon), scalar(key_lat), ref_d * 1000))
+        
+        targets = select_targets(tess_ids)
         #conn.commit()
         
         subprocesses = len(targets)
         num_malformed = 0
         
+        #targets is a table of columns:
+        #target_id, geocell_id, lat, lon
+        #with length the number of geocells
+        #Note that geocell_id might be missing
+        #Do a check Now? YES!
+        def formwell(t):
+            try: 
+                #t is a tuple, we cannot assign to it.
+                #Simply do a check and preserve old values
+                #Note that the check below is fine also if elements are numeric strings
+                #the drawback of instantiating a new list is however too much effort
+                #as data should be numeric
+                _,_,_,_ = int(t[0]), int(t[1]), float(t[2]), float(t[3])
+            except: 
+#                import traceback
+#                traceback.print_exc()
+                return None
+            return t
+        
         if subprocesses:
-            #targets is a table of columns:
-            #target_id, geocell_id, lat, lon
-            #with length the number of geocells
-            #Note that geocell_id might be missing
-            #Do a check Now? YES!
-            def formwell(t):
-                try: 
-                    #t is a tuple, we cannot assign to it.
-                    #Simply do a check and preserve old values
-                    #Note that the check below is fine also if elements are numeric strings
-                    #the drawback of instantiating a new list is however too much effort
-                    #as data should be numeric
-                    _,_,_,_ = int(t[0]), int(t[1]), float(t[2]), float(t[3])
-                except: 
-#                    import traceback
-#                    traceback.print_exc()
-                    return None
-                return t
-                
             for i in range(subprocesses):
                 t = targets[i]
                 twf = formwell(t)
@@ -283,42 +603,63 @@ def caravan_run(input_event):
                         format(subprocesses - num_malformed, subprocesses, num_malformed))
         else:
             runinfo.msg("{:d} target cells found".format(subprocesses))
+        
+        if refine_tess_ids is not None:
+            #refine the cells where intensities (or losses) are relevant or change steeply, descending to the finer 
+            #tessellations (see refine_targets). The cells not refined fill in elsewhere:
+            targets = [t for t in targets if t is not None]
+            for tess_id in refine_tess_ids[1:]:
+                fine = [t for t in select_targets([tess_id]) if formwell(t) is not None]
+                fatalities, coarse_exposure = None, None
+                if not gm_only and globals.refine_fatalities is not None:
+                    fatalities = globals.refine_fatalities
+                    coarse_exposure = exposure_module.select(exposure_module.preload(conn, [t[1] for t in targets]), 
+                                                             [t[1] for t in targets])
+                num_coarse = len(targets)
+                targets, num_refined = refine_targets(gmpe_func, targets, fine, globals.refine_intensity, 
+                                                      globals.refine_intensity_delta, fatalities, coarse_exposure)
+                runinfo.msg("Tessellation id {:d}: {:d} of {:d} cells refined ({:d} target cells)".format(tess_id, num_refined, 
+                                                                                                          num_coarse, len(targets)))
+            subprocesses = len(targets) + num_malformed
             
         
         #WRITE session_id in processing.sessions
         
         #see https://docs.python.org/2/library/datetime.html#datetime.datetime.now (we use utcnow instead of now)
         #and http://initd.org/psycopg/docs/usage.html#adaptation-of-python-values-to-sql-types
-        session_id = None
-        while True:
-            session_timestamp = datetime.utcnow() #returns a datetime object, which is converted to timestamp in psycopg2
-            session_rows = conn.fetchall("SELECT COUNT(*) FROM processing.sessions WHERE session_timestamp=%s;", (session_timestamp,))
-            if session_rows[0][0] == 0:
-                #NOTE: do NOT run immediately num_malformed, otherwise the progressbar and time counter have invalid data
-                #just set subprocesses-num_malformed as the cells to be done: 
-                cursor = conn.cursor("INSERT INTO processing.sessions (scenario_id, session_timestamp, num_targets, num_targets_failed) \
-                VALUES(%s, %s, %s, %s) RETURNING gid;", (scenario_id, session_timestamp, subprocesses-num_malformed, 0,))
-                
-                #Note returns works because of RETURNING string in dbase execute command. execute() can return elements without return 
-                #explicitly written as long as (psycopg2 cursor doc) a QUERY was executed in execute(). Now, insert is not a query, 
-                #but for instance (see few lines above) DELETE it is
-                conn.commit() #note: in async mode does nothing
-                ret = cursor.fetchall()
-                
-                session_id = ret[0][0] #gid (serial number) of the newly added row
-                cursor.close()
-                break
+        #session ids are unique by means of the serial key (gid): no need to check for unique timestamps, 
+        #so that concurrent runs do not contend on the sessions table
+        #NOTE: do NOT run immediately num_malformed, otherwise the progressbar and time counter have invalid data
+        #just set subprocesses-num_malformed as the cells to be done: 
+        session_timestamp = datetime.utcnow() #returns a datetime object, which is converted to timestamp in psycopg2
+        ret = conn.fetchall("INSERT INTO processing.sessions (scenario_id, session_timestamp, num_targets, num_targets_failed) \
+        VALUES(%s, %s, %s, %s) RETURNING gid;", (scenario_id, session_timestamp, subprocesses-num_malformed, 0,))
+        conn.commit() #note: in async mode does nothing
+        session_id = ret[0][0] if ret else None #gid (serial number) of the newly added row
         
         if session_id is None:
             raise Exception("Unable to get session_id. Internal server error")
         
         runinfo.msg("Session id: {:d}".format(session_id), "Starting main process (might take a while...)")
         
-        #CREATE A PROCESS and a Pool of processes. For info see:
+        #GET THE APPLICATION POOL of processes, shared across simulations (see workerpool module):
         
         #For info: http://stackoverflow.com/questions/25071910/multiprocessing-pool-calling-helper-functions-when-using-apply-asyncs-callback
-        P = multiprocessing.Pool()
-        runinfo.setprocess(P, session_id)
+        #gmpe's might contain uncertain functions defined in mcerp WHICH ARE NOT PICKABLE!
+        #Therefore, we pass the gmpe spec (class name and parameters samples, which ARE pickable) to each task, 
+        #and each worker process rebuilds the gmpe once per session and caches it (see _worker_gmpe). 
+        #Each task then calculates the intensities of a block of targets (see targets_run)
+        #Blocks can be set by count and/or spatial tiles (see user_options.chunk_size and chunk_tile_deg):
+        #few large blocks reduce inter-process communication and database connections, especially for 
+        #small mcerp npts where the calculation per target is fast
+        P = workerpool.get()
+        targets = [t for t in targets if t is not None]
+        chunk_size = globals.chunk_size
+        if not chunk_size or chunk_size <= 0: #automatic: a few blocks per process, to balance the workload
+            chunk_size = -(-len(targets) // (4 * P.processes)) #ceil division
+        targets, ranges = chunks(targets, chunk_size, globals.chunk_tile_deg)
+        #track the progress in memory (see _progress_callback) instead of polling the database:
+        runinfo.setprocess(P, session_id, len(targets))
         #NOTES:
         #ARGUMENTS TO APPLY_ASYNC MUST BE PICKABLE, AS WELL AS THE FUNCTION (FIRST ARGUMENT).
         #SEE https://docs.python.org/2/library/pickle.html#what-can-be-pickled-and-unpickled
@@ -346,16 +687,6 @@ def caravan_run(input_event):
             if os.path.exists(folder): logdir = folder
             
                 
-        #'opposite' to scalar defined above: returns a numpy.ndarray if the value represents an mcerp distribution,
-        #otherwise the float value. Note that numpy.ndarray seems to be PICKABLE ('passable' as multiprocess.Pool argument)
-        def val(value):
-            #value = scenario[key]
-            
-            if isinstance(value, mcerp.UncertainFunction):
-                return value._mcpts #this is a numpy.array element WHICH IS PICKABLE, SO IT CAN BE PASSED TO multiprocess.Pool
-            else:
-                return float(value) #parse to float to be sure
-        
         #close the connection NOW?
         conn.commit()
         conn.close()
@@ -365,25 +696,24 @@ def caravan_run(input_event):
         #the number of points. Thus a distribution with 10 pts cannot calculate percentiles at, e.g., 0.05 and 0.95
         #we therefore need to set the mcepr npts here
         percentiles = globals.percentiles
-
-        key_gm_only = gk.GMO
-        gm_only = scenario[key_gm_only] if key_gm_only in scenario else globals.gm_only
         
-        #gmpe's might contain uncertain functions defined in mcerp WHICH ARE NOT PICKABLE!
-        #Given the fact that making them pickable seems to be a mess for our case
-        #(examples found in the internet deal with easy to use cases), we FIRST 
-        #calculate the intensity distribution, then we pass ITS ARRAY (a numpy array, which IS pickable)
-        #to our geocell_run function
-        #Drawback: we are not calculating intensity in a separate process, which means
-        #we therefore do not take 100% advantages of the multiprocess pool
-        
-        for t in targets:
-            if t is None: continue
-            intensity = gmpe_func(t[3], t[2])
-            #geocell_run(gmpe_func, t[3], t[2], percentiles, t[0], t[1], gm_only, scenario_id, session_id, logdir)
-            P.apply_async(geocell_run, [val(intensity), t[3], t[2], percentiles, t[0], t[1], gm_only, scenario_id, session_id, logdir])
-            
-        P.close()
+        #load the exposure of all targets at once (a few queries instead of four queries per target). 
+        #Each task is then sent the exposure arrays of its targets only:
+        exposure = None
+        if not gm_only:
+            conn = globals.connection(async=False)
+            exposure = exposure_module.preload(conn, [t[1] for t in targets])
+            conn.close()
+            conn = None
+        
+        #submit the tasks tagged with our session id (so that runinfo.stop() cancels only them):
+        gmpe_spec = gmpe_func.spec()
+        for start, end in ranges:
+            chunk = targets[start:end]
+            chunk_exposure = None if exposure is None else exposure_module.select(exposure, [t[1] for t in chunk])
+            #targets_run(gmpe_spec, mcerp.npts, chunk, percentiles, gm_only, scenario_id, session_id, logdir, chunk_exposure)
+            P.submit(session_id, targets_run, [gmpe_spec, mcerp.npts, chunk, percentiles, gm_only, scenario_id, session_id, logdir, chunk_exposure],
+                     _progress_callback(runinfo, len(chunk)))
             
     except Exception as e:
         exception = e
@@ -398,92 +728,111 @@ def caravan_run(input_event):
             
         return runinfo
 
-from math import sqrt
 def ref_dist(gmpe_func, I_ref, km_step):
     """
         Given an epicenter with given magnitude M and depth depth_hyp, 
         returns the distance D in Km such that 
         I >= I_ref
+        (see ref_dists)
+    """
+    return ref_dists(gmpe_func, I_ref, km_step)[0]
+
+#number of azimuths of the area of interest of extended sources (see ref_dists and aoi_polygon):
+_AOI_AZIMUTHS = 16
+
+def _aoi_scale(azimuths):
+    #returns the factor by which the radii of the area of interest polygon are multiplied (see aoi_vertices)
+    return 1.0 / math.cos(math.pi / len(azimuths)) if len(azimuths) > 2 else 1.0
+
+def aoi_vertices(lat, lon, azimuths, radii):
+    """
+        Returns the tuple (lons, lats) of the vertices (numpy arrays, in degrees) of the polygon of the area of interest 
+        centered at lat, lon with the given radii (in Km) along the given azimuths (see ref_dists), equally spaced and 
+        at least 3. Each vertex is placed at max(r) / cos(pi / len(azimuths)), where r are its radius and the radii of 
+        the two adjacent azimuths. Thus each polygon edge lies beyond the tangent of the circle of radius max(r) 
+        at the middle azimuth, and the polygon contains the circular sector between any two adjacent azimuths with 
+        the greater of their radii. The area of I >= I_ref is covered as long as, between two adjacent azimuths, 
+        its boundary does not extend beyond the greater of the two radii (the radii are sampled, see _AOI_AZIMUTHS)
+    """
+    radii = np.asarray(radii, dtype=float)
+    radii = np.maximum(radii, np.maximum(np.roll(radii, 1), np.roll(radii, -1)))
+    lats, lons = gmpe_utils.reckon(lat, lon, gmpe_utils.km2deg(radii * _aoi_scale(azimuths)), np.asarray(azimuths))
+    return lons, lats
+
+def aoi_polygon(lons, lats):
+    """
+        Returns the WKT string of the polygon (in lon lat coordinates, SRID 4326) of the given vertices (see aoi_vertices)
+    """
+    points = ["{:f} {:f}".format(x, y) for x, y in zip(lons, lats)]
+    return "POLYGON((" + ", ".join(points + points[:1]) + "))"
+
+def ref_dists(gmpe_func, I_ref, km_step, num_azimuths=8):
+    """
+        Returns the tuple (D, azimuths, radii) where radii[i] is the distance in Km from the epicenter, 
+        along the azimuth azimuths[i] (degrees clockwise from north), such that I >= I_ref, and D is the maximum 
+        of radii. I is the intensity of gmpe_func at its maximum percentile (see globals.percentiles). 
+        azimuths and radii are numpy arrays of length num_azimuths, or 1 for point source gmpes 
+        (gmpe_func.sourcetype == 0), whose intensity does not depend on the azimuth. 
+        If I >= I_ref at the maximum distance of the gmpe (d_bounds), all radii are set to the latter. 
+        
+        The gmpe is evaluated at once (see Gmpe.evaluate_many) on a grid of distances x azimuths around the epicenter 
+        (mean, if the latter is a distribution), and each radius is linearly interpolated between the two grid distances 
+        where I crosses I_ref. The grid distances are first spaced coarsely, then every km_step Km within the crossing 
+        intervals only (a second evaluation), as the gmpe might be expensive for many points (e.g., extended sources)
     """
     max_percentile = globals.percentiles[len(globals.percentiles)-1]
-    def val(value):
-        return value.percentile(max_percentile) if isinstance(value, mcerp.UncertainFunction) else value
+    def mean(value):
+        return value.mean if isinstance(value, mcerp.UncertainFunction) else float(value) #NOTE: mean is a @property
     
-        
-    k = 0
-    lat_hyp = gmpe_func.lat #might be dist
-    lon_hyp = gmpe_func.lon #might be dist
-    lat_sta = lat_hyp
-    lon_sta = lon_hyp
-    
-    D = 0.001 #0.0 #AVOIDS ROUND ERRORS IN GMPE DISTANCE OUT OF BOUNDS
+    D0 = 0.001 #0.0 #AVOIDS ROUND ERRORS IN GMPE DISTANCE OUT OF BOUNDS
+    gmpe_maxd = float(gmpe_func.d_bounds[1])-0.001 #AVOIDS ROUND ERRORS IN GMPE DISTANCE OUT OF BOUNDS
+    km_step = max(km_step, 0.001)
     
-    #define functions in all directions (n w s e and ne nw se sw):
-    #Note: from index 3 on, we need to divide by sqrt(2)
-    funcz = (
-        lambda d: (lat_hyp + d, lon_hyp),
-        lambda d: (lat_hyp, lon_hyp + d),
-        lambda d: (lat_hyp - d, lon_hyp),
-        lambda d: (lat_hyp, lon_hyp - d),
-        lambda d: (lat_hyp + d, lon_hyp + d),
-        lambda d: (lat_hyp - d, lon_hyp + d),
-        lambda d: (lat_hyp - d, lon_hyp - d),
-        lambda d: (lat_hyp + d, lon_hyp - d),
-    )
+    num_azimuths = 1 if gmpe_func.sourcetype == 0 else max(1, num_azimuths)
+    azimuths = np.arange(num_azimuths) * (360.0 / num_azimuths)
+    lat0, lon0 = mean(gmpe_func.lat), mean(gmpe_func.lon)
     
+    def intensities(dists, azs):
+        #returns the intensities (at max_percentile) at the given distances along the given azimuths. 
+        #Both are numpy arrays broadcastable to the same shape, which is the shape of the returned array
+        lats, lons = gmpe_utils.reckon(lat0, lon0, gmpe_utils.km2deg(dists), azs)
+        lats, lons = np.broadcast_arrays(lats, lons)
+        I = gmpe_func.evaluate_many(lats.ravel(), lons.ravel())
+        return globals.percentile_many(I, [max_percentile])[:, 0].reshape(lats.shape)
     
-    gmpe_maxd = float(gmpe_func.d_bounds[1])-0.001 #AVOIDS ROUND ERRORS IN GMPE DISTANCE OUT OF BOUNDS
+    def crossings(dists, I):
+        #returns the index k of the first distance (row) where I < I_ref for each azimuth (column), and a boolean array 
+        #denoting the azimuths where I crosses I_ref (I >= I_ref at the first distance and I < I_ref at the last one)
+        valid = (I[0] >= I_ref) & (I[-1] < I_ref)
+        return np.argmax(I < I_ref, axis=0), valid
     
-    #Set min_d = D and max_d = gmpe's d_bounds[1], then perform a kind of binary 
-    #serarch algrithm (O(logN) instead of O(N)), until we find the closest interval <= km_step 
-    #such as I_ref >= I(min_d) and I_ref < max_d. If such distances are found,
-    #set D = max_d if max_d > D. 
-    #Note that the interval of search is "restricted" from second iteration on, which 
-    #should further speed up the process
+    #coarse grid (num_dists, num_azimuths):
+    coarse_step = max(km_step, (gmpe_maxd - D0) / 8.0)
+    dists = np.append(np.arange(D0, gmpe_maxd, coarse_step), gmpe_maxd)[:, None] + np.zeros((1, num_azimuths))
+    I = intensities(dists, azimuths[None, :])
     
-    def latlon0(func, dist_in_km):
-        return func(gmpe_utils.km2deg(dist_in_km))
+    radii = np.zeros(num_azimuths)
+    if np.any(I[-1] >= I_ref):
+        radii[:] = gmpe_maxd
+        return float(np.max(radii)), azimuths, radii
     
-    sqrt_2 = sqrt(2)
-    def latlon1(func, dist_in_km):
-        return func(gmpe_utils.km2deg(dist_in_km/sqrt_2))
+    k, valid = crossings(dists, I)
+    if not np.any(valid):
+        return float(np.max(radii)), azimuths, radii
+    cols = np.flatnonzero(valid)
+    k = k[cols]
     
-    l = len(funcz)
-    for i in range(l):
-        f = funcz[i]
-        
-        latlon = latlon0 if i<=3 else latlon1
-        min_d = D
-        max_d = gmpe_maxd
-        
-        
-        
-        I_min_d = val(gmpe_func(*latlon(f,min_d)))
-        I_max_d = val(gmpe_func(*latlon(f,max_d)))
-        
-        isin = I_max_d < I_ref and I_min_d >= I_ref
-        while isin:
-            if max_d - min_d <= km_step: break
-            mid_pt = (max_d+min_d)/2
-            I = val(gmpe_func(*latlon(f,mid_pt)))
-            if I < I_ref: 
-                max_d = mid_pt
-                I_max_d = I
-            elif I >= I_ref: 
-                min_d = mid_pt
-                I_min_d = I
-        
-
-        
-        if isin: 
-            if max_d > D : D = max_d
-        elif I_max_d >= I_ref: 
-            D = gmpe_maxd
-            break
-        #else: #I_min_d < I_ref
-            
+    if coarse_step > km_step: #refine the crossing intervals with a km_step grid:
+        start, end = dists[k-1, cols], dists[k, cols]
+        dists = np.minimum(start[None, :] + km_step * np.arange(int(np.ceil(coarse_step / km_step)) + 1)[:, None], end[None, :])
+        I = intensities(dists, azimuths[cols][None, :])
+        k, _ = crossings(dists, I)
+    else:
+        dists, I = dists[:, cols], I[:, cols]
     
-    return D
+    j = np.arange(len(cols))
+    radii[cols] = dists[k-1, j] + (dists[k, j] - dists[k-1, j]) * (I[k-1, j] - I_ref) / (I[k-1, j] - I[k, j])
+    return float(np.max(radii)), azimuths, radii
     
 #    I = gmpe_func(lat_sta, lon_sta)
 #    
@@ -46,6 +46,14 @@ TWO_PI = pi*2
 HALF_PI = pi/2
 THREE_HALF_PI = 3*pi/2
 
+def _item(value):
+    """
+        Returns value as python numeric type if it is a numpy scalar (or 0-dimensional array), 
+        otherwise returns value (a numpy array). Used by the functions below so that 
+        they work also with numpy arrays (see e.g. gmpes.Gmpe.evaluate_many)
+    """
+    return value.item() if np.ndim(value) == 0 else value
+
 def mod(x1, x2):
     """
         Modulus (element-wise) i.e. x1 % x2
@@ -60,7 +68,7 @@ def mod(x1, x2):
     elif x2_is_U:
         mcpts = np.mod(x1, x2._mcpts)
     else:
-        return np.mod(x1, x2).item() #FIXME: we return a python numeric type? yes for the moment
+        return _item(np.mod(x1, x2)) #FIXME: we return a python numeric type? yes for the moment
     return UncertainFunction(mcpts)
 
 def sign(x):
@@ -71,7 +79,7 @@ def sign(x):
         mcpts = np.sign(x._mcpts)
         return UncertainFunction(mcpts)
     else:
-        return np.sign(x).item() #FIXME: we return a python numeric type? yes for the moment
+        return _item(np.sign(x)) #FIXME: we return a python numeric type? yes for the moment
 
 def atan2(x1, x2):
     """
@@ -87,7 +95,7 @@ def atan2(x1, x2):
     elif x2_is_U:
         mcpts = np.arctan2(x1, x2._mcpts)
     else:
-        return np.arctan2(x1, x2).item() #FIXME: we return a python numeric type? yes for the moment
+        return _item(np.arctan2(x1, x2)) #FIXME: we return a python numeric type? yes for the moment
     return UncertainFunction(mcpts)
 
     
@@ -461,6 +469,158 @@ def rup_distance(lat_sta, lon_sta, lat_epi, lon_epi, depth, strike_deg, dip_deg,
     
 
 
+def rup_distance_array(lat_sta, lon_sta, lat_epi, lon_epi, depth, strike_deg, dip_deg, RLD, RW):
+    """
+        Vectorized version of rup_distance. Returns the tuple (R_JB, R_XX, R_YY, R_CD) of numpy arrays 
+        (Joyner-Boore distance, distance perpendicular to the fault strike, distance parallel to the fault 
+        strike and rupture distance, respectively), all in km. 
+        Arguments are the same as rup_distance, but they must be python scalars or numpy arrays 
+        (NOT distributions) broadcastable against each other: typically, lat_sta and lon_sta are (N, 1) arrays 
+        of N points of interest (stations) and all remaining arguments are scalars or 1-dimensional arrays of 
+        npts samples. In that case, the returned arrays are (N, npts) matrices.
+        Shorthand for FaultGeometry(lat_epi, lon_epi, depth, strike_deg, dip_deg, RLD, RW).distances(lat_sta, lon_sta):
+        when calculating distances repeatedly for the same fault, build a FaultGeometry once and reuse it
+    """
+    return FaultGeometry(lat_epi, lon_epi, depth, strike_deg, dip_deg, RLD, RW).distances(lat_sta, lon_sta)
+
+class FaultGeometry(object):
+    """
+        The geometry of a rectangular fault, i.e. all quantities needed by rup_distance which do not 
+        depend on the point of interest (station): surface fault dimensions (L1, L2, W1, W2), depth of 
+        top of rupture (Ztor), trigonometric functions of strike and dip and fault corners (c1, .., c4, 
+        see rup_distance) latitudes and longitudes (and their trigonometric functions). 
+        Arguments are the same as rup_distance (excluding the station coordinates) and must be python 
+        scalars or numpy arrays (NOT distributions), usually 1-dimensional arrays of npts samples.
+        Build a FaultGeometry once per scenario, then call distances(lat_sta, lon_sta) for any station
+    """
+    def __init__(self, lat_epi, lon_epi, depth, strike_deg, dip_deg, RLD, RW):
+        self.RW = RW
+        self.dip_deg = dip_deg
+        self.strike = np.radians(strike_deg)
+        dip = np.radians(dip_deg)
+        self.sin_dip, self.cos_dip, self.tan_dip = np.sin(dip), np.cos(dip), np.tan(dip)
+        
+        D_tor = depth - RW / 2.0 * self.sin_dip  #Calculate the depth to Top of the Rupture
+        
+        # Calculating the Surface Fault dimension (see rup_distance)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.L1 = RLD / 2.0
+            self.W1 = np.where(D_tor > 0, RW / 2.0 * self.cos_dip, depth / self.tan_dip)
+            self.W2 = np.where(D_tor > 0, self.W1, RW * self.cos_dip - depth / self.tan_dip)
+        self.L2 = self.L1
+        
+        self.Ztor = np.maximum(D_tor, 0) # Ztop = depth of top of rupture
+        
+        L1, L2, W1, W2, strike, two_pi = self.L1, self.L2, self.W1, self.W2, self.strike, TWO_PI
+        Az_EC1 = rad2deg(np.mod(strike + 1 * pi + np.arctan(W1 / L1) , two_pi))
+        Az_EC2 = rad2deg(np.mod(strike + 2 * pi - np.arctan(W1 / L2) , two_pi))
+        Az_EC3 = rad2deg(np.mod(strike + 0 * pi + np.arctan(W2 / L2) , two_pi))
+        Az_EC4 = rad2deg(np.mod(strike + 1 * pi - np.arctan(W2 / L1) , two_pi))
+        
+        lat_epi = np.asarray(lat_epi, dtype=float) #reckon needs numpy arrays (not python scalars) for element-wise operations
+        #corners latitudes and longitudes, in degrees:
+        self.corners = (reckon(lat_epi, lon_epi, km2deg(np.sqrt(L1 * L1 + W1 * W1)), Az_EC1),
+                        reckon(lat_epi, lon_epi, km2deg(np.sqrt(L2 * L2 + W1 * W1)), Az_EC2),
+                        reckon(lat_epi, lon_epi, km2deg(np.sqrt(L2 * L2 + W2 * W2)), Az_EC3),
+                        reckon(lat_epi, lon_epi, km2deg(np.sqrt(L1 * L1 + W2 * W2)), Az_EC4))
+        #corners latitudes (radians, with sine and cosine) and longitudes (radians), used in distances:
+        self._corners_rad = []
+        for c_lat, c_lon in self.corners:
+            phi = np.radians(c_lat)
+            self._corners_rad.append((phi, np.sin(phi), np.cos(phi), np.radians(c_lon)))
+    
+    def _azimuth_and_distance(self, corner_index, phi, sin_phi, cos_phi, lam):
+        """
+            Returns the tuple (azimuth, distance) from the corner_index-th corner to the station (phi, lam) 
+            (latitude and longitude in radians, with latitude sine and cosine). The azimuth is in radians 
+            (see greatcircleaz), the distance in km (see greatcircledist)
+        """
+        phi_c, sin_phi_c, cos_phi_c, lam_c = self._corners_rad[corner_index]
+        half_dlam = (lam - lam_c) / 2
+        sin_half_dlam, cos_half_dlam = np.sin(half_dlam), np.cos(half_dlam)
+        sin_dlam = 2 * sin_half_dlam * cos_half_dlam
+        cos_dlam = 1 - 2 * sin_half_dlam ** 2
+        
+        az = np.arctan2(cos_phi * sin_dlam, cos_phi_c * sin_phi - sin_phi_c * cos_phi * cos_dlam)
+        half_pi = HALF_PI #see greatcircleaz for the convention at the poles:
+        az = np.where((phi_c <= -half_pi) | (phi >= half_pi), 0, az)
+        az = np.where((phi_c >= half_pi) | (phi <= -half_pi), pi, az)
+        
+        a = np.sin((phi - phi_c) / 2) ** 2 + cos_phi_c * cos_phi * sin_half_dlam ** 2
+        return az, rad2km(2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a)))
+    
+    def distances(self, lat_sta, lon_sta):
+        """
+            Returns the tuple (R_JB, R_XX, R_YY, R_CD) of numpy arrays (see rup_distance_array) at the given 
+            station(s). lat_sta and lon_sta are python scalars or numpy arrays (in degrees) broadcastable 
+            against the arrays of this object. E.g., if the latter are 1-dimensional arrays of npts samples, 
+            passing (N, 1) stations returns (N, npts) matrices
+        """
+        two_pi = TWO_PI
+        half_pi = HALF_PI
+        three_half_pi = THREE_HALF_PI
+        strike = self.strike
+        
+        phi = np.radians(lat_sta)
+        sin_phi, cos_phi, lam = np.sin(phi), np.cos(phi), np.radians(lon_sta)
+        
+        # Site azimuths wrt. corners and respective distance. Angles are corrected wrt strike
+        Az_C1S, Dist_C1toSite = self._azimuth_and_distance(0, phi, sin_phi, cos_phi, lam)
+        Az_C2S, Dist_C2toSite = self._azimuth_and_distance(1, phi, sin_phi, cos_phi, lam)
+        Az_C3S, Dist_C3toSite = self._azimuth_and_distance(2, phi, sin_phi, cos_phi, lam)
+        Az_C4S, Dist_C4toSite = self._azimuth_and_distance(3, phi, sin_phi, cos_phi, lam)
+        Az_C1S = np.mod(np.mod(Az_C1S, two_pi) - strike, two_pi)
+        Az_C2S = np.mod(np.mod(Az_C2S, two_pi) - strike, two_pi)
+        Az_C3S = np.mod(np.mod(Az_C3S, two_pi) - strike, two_pi)
+        Az_C4S = np.mod(np.mod(Az_C4S, two_pi) - strike, two_pi)
+        
+        #Regions (see rup_distance). The order of the conditions mirrors the if/elif chain in rup_distance, 
+        #and np.select picks the first matching condition for each element:
+        reg7 = (Az_C1S >= pi) & (Az_C1S < three_half_pi)
+        reg14 = Az_C1S >= three_half_pi
+        reg89 = (Az_C1S > half_pi) & (Az_C1S < pi)
+        reg56 = (Az_C1S <= half_pi) & (Az_C2S >= half_pi)
+        #remaining: Az_C1S < half_pi and Az_C2S < half_pi (regions 2 and 3)
+        reg1 = reg14 & (Az_C2S > three_half_pi)
+        reg4 = reg14 & ~reg1
+        reg8 = reg89 & (Az_C4S > pi)
+        reg9 = reg89 & ~reg8
+        reg5 = reg56 & (Az_C3S >= pi)
+        reg6 = reg56 & ~reg5
+        reg2 = Az_C3S > half_pi #(to be used as last condition only)
+        
+        conditions = [reg7, reg1, reg4, reg8, reg9, reg5, reg6, reg2]
+        
+        RW, Ztor, sin_dip, cos_dip, tan_dip = self.RW, self.Ztor, self.sin_dip, self.cos_dip, self.tan_dip
+        with np.errstate(invalid='ignore', divide='ignore'):
+            abs_sin_C1S, abs_sin_C2S = np.abs(np.sin(Az_C1S)), np.abs(np.sin(Az_C2S))
+            abs_sin_C3S, abs_sin_C4S = np.abs(np.sin(Az_C3S)), np.abs(np.sin(Az_C4S))
+            
+            R_JB = np.select(conditions, [Dist_C1toSite, Dist_C2toSite, Dist_C1toSite * abs_sin_C1S, 
+                                          Dist_C1toSite * np.abs(np.cos(Az_C1S)), Dist_C4toSite, 
+                                          0, Dist_C3toSite * abs_sin_C3S, Dist_C2toSite * np.abs(np.cos(Az_C2S))], 
+                             default=Dist_C3toSite)
+            
+            RW_cos_dip = RW * cos_dip
+            R_XX = np.select(conditions, [R_JB * np.sin(Az_C1S), R_JB * np.sin(Az_C2S), R_JB * np.sin(three_half_pi),
+                                          R_JB * np.abs(np.tan(Az_C1S)), RW_cos_dip + R_JB * abs_sin_C4S, 
+                                          Dist_C2toSite * abs_sin_C2S, RW_cos_dip + R_JB, R_JB * np.abs(np.tan(Az_C2S))],
+                             default=RW_cos_dip + R_JB * abs_sin_C3S)
+            
+            R_YY = np.abs(np.select(conditions, [R_JB * np.cos(Az_C1S), R_JB * np.cos(Az_C2S), 0,
+                                                 R_JB, R_JB * np.cos(Az_C4S),
+                                                 0, 0, R_JB], 
+                                    default=R_JB * np.cos(Az_C3S)))
+        
+            Ztor_tan_dip = Ztor * tan_dip
+            Rrup_prime = np.where((self.dip_deg == 90) | (R_XX < Ztor_tan_dip), np.sqrt(R_XX ** 2 + Ztor ** 2),
+                                  np.where(R_XX <= Ztor_tan_dip + RW / cos_dip, R_XX * sin_dip + Ztor * cos_dip,
+                                           np.sqrt((R_XX - RW_cos_dip) ** 2 + (Ztor + RW * sin_dip) ** 2)))
+        
+        R_CD = np.sqrt(Rrup_prime ** 2 + R_YY ** 2) #R_CD = rupture distance 
+        
+        return R_JB, R_XX, R_YY, R_CD
+
 def reckon(lat, lon, arclen, az): #[latout,lonout] = reckon(varargin)
     """
         Calculates and returns the tuple (LATOUT, LONOUT) denoting the position 
@@ -517,10 +677,14 @@ def _greatcirclefwd(phi0, lambda0, az, rng): #function [phi,lambda] = greatcircl
     # Ensure correct azimuths at either pole.
     epsilon = 10 * deg2rad(1.0E-6) #10*epsm('radians');    # Set tolerance
     half_pi = HALF_PI
-    if phi0 >= half_pi - epsilon:
-        az = pi
-    if phi0 <= epsilon-half_pi:
-        az = 0
+    if isinstance(phi0, np.ndarray): #numpy arrays (no distributions): apply the condition element-wise
+        az = np.where(phi0 >= half_pi - epsilon, pi, az)
+        az = np.where(phi0 <= epsilon-half_pi, 0, az)
+    else:
+        if phi0 >= half_pi - epsilon:
+            az = pi
+        if phi0 <= epsilon-half_pi:
+            az = 0
     
 #    az(phi0 >= pi/2-epsilon) = pi;    # starting at north pole
 #    az(phi0 <= epsilon-pi/2) = 0;     # starting at south pole
@@ -656,6 +820,11 @@ def greatcircleaz(lat1,lon1,lat2,lon2):
     # Azimuths are undefined at the poles, so we choose a convention: zero at
     # the north pole and pi at the south pole.
     half_pi = HALF_PI;
+    if isinstance(az, np.ndarray): #numpy arrays (no distributions): apply the convention element-wise
+        az = np.where((lat1 <= -half_pi) | (lat2 >= half_pi), 0, az)
+        az = np.where((lat1 >= half_pi) | (lat2 <= -half_pi), pi, az)
+        return az
+    
     if lat1 <= -half_pi or lat2 >= half_pi:
         az = 0
     
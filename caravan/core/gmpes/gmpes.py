@@ -26,6 +26,8 @@ __date__ ="$Aug 20, 2014 2:56:26 PM$"
 from mcerp.umath import exp, sqrt, log, log10
 from gmpe_utils import distance as greatarc_dist, deg2km, chorddistance
 import mcerp
+import numpy as np
+import copy
 import warnings
 
 def _threed_dist(lat1, lon1, depth1, lat2, lon2, depth2):
@@ -109,6 +111,15 @@ def getgmpe(name):
     """
     return sys.modules[__name__].__dict__[name] #__dict__[name]
 
+def fromspec(spec):
+    """
+        Returns a new Gmpe from the given spec, i.e. the tuple (class_name, parameters) 
+        returned by Gmpe.spec(). Numpy arrays in parameters are converted back to distributions 
+        (mcerp.UncertainFunction)
+    """
+    name, params = spec
+    return getgmpe(name)(**{k: mcerp.UncertainFunction(v) if isinstance(v, np.ndarray) else v for k, v in params.iteritems()})
+
 def getgmpes(*module_names):
     """
         Returns all Gmpe's classes implemented in this module
@@ -135,6 +146,13 @@ def _get_subclasses(cls, *modules):
                 yield name, obj
 
 
+def _mean(value):
+    """
+        Returns the mean of value if the latter is a distribution (mcerp.UncertainFunction), 
+        otherwise value
+    """
+    return value.mean if isinstance(value, mcerp.UncertainFunction) else value #NOTE: mean is a @property
+
 class Gmpe(object):
     
     @staticmethod
@@ -322,6 +340,84 @@ class Gmpe(object):
     def calculate(self, distance):
         raise Exception("calculate(distance) method not implemented")
     
+    @staticmethod
+    def samples(value):
+        """
+            Returns the numpy array of samples of value if the latter is a distribution 
+            (mcerp.UncertainFunction), otherwise value as float
+        """
+        return value._mcpts if isinstance(value, mcerp.UncertainFunction) else float(value)
+    
+    def spec(self):
+        """
+            Returns the tuple (class_name, parameters), where parameters is a dict of this object 
+            arguments (see __init__) with any distribution replaced by its numpy array of samples. 
+            A spec is PICKABLE (mcerp distributions are not) and can therefore be passed to other 
+            processes (e.g., multiprocessing.Pool) to build the same gmpe via fromspec(spec)
+        """
+        params = {}
+        for k, v in self.__dict__.iteritems():
+            if k[0] != '_': #skip private (e.g. cached) attributes
+                params[k] = v._mcpts if isinstance(v, mcerp.UncertainFunction) else v
+        return self.__class__.__name__, params
+    
+    def evaluate_many(self, lats, lons):
+        """
+            Vectorized counterpart of self(lat, lon): calculates the intensities at N points 
+            of interest in a single (numpy) broadcast pass. lats and lons are iterables (e.g. 
+            numpy arrays) of N latitudes and longitudes, respectively, in degrees.
+            Returns a numpy matrix of shape (N, npts), where npts is the number of points 
+            of the distribution parameters of this gmpe (usually mcerp.npts) or 1 if 
+            all parameters are scalars. The i-th row holds the samples of the intensity 
+            distribution at (lats[i], lons[i])
+            
+            Implementations should in principle override distance_many and/or calculate_many,
+            if the default implementations (which call distance and calculate, respectively,
+            with numpy arrays instead of distributions) are not suited for numpy broadcasting
+        """
+        lats = np.asarray(lats, dtype=float).reshape(-1, 1)
+        lons = np.asarray(lons, dtype=float).reshape(-1, 1)
+        
+        #check bounds once for all points. Use epicenter mean values, as we are interested in a warning only:
+        epidist = Gmpe.distepi(_mean(self.lat), _mean(self.lon), lats, lons)
+        outofbounds = np.sum((epidist > self.d_bounds[1]) | (epidist < self.d_bounds[0]))
+        if outofbounds:
+            warnings.warn("{0} warning: out of defined bound while calculating intensity at {1:d} of {2:d} points, epicentral distance not in {3}".
+                    format(self.__repr__(), int(outofbounds), len(lats), str(list(self.d_bounds)) )) #because list str is like closed interval in math
+        
+        I = self.calculate_many(self.distance_many(lats, lons))
+        
+        npts = max([len(v._mcpts) for v in self.__dict__.itervalues() if isinstance(v, mcerp.UncertainFunction)] or [1])
+        return np.zeros((len(lats), npts)) + I #broadcast to (N, npts) (returns a new array)
+    
+    def sampled(self):
+        """
+            Returns a shallow copy of this object where each distribution attribute 
+            (mcerp.UncertainFunction) is replaced by a numpy array of shape (1, npts) 
+            holding its samples. Used for broadcasting parameters (row vector) against 
+            points of interest (column vectors, see evaluate_many)
+        """
+        g = copy.copy(self)
+        for k, v in self.__dict__.items():
+            if isinstance(v, mcerp.UncertainFunction):
+                setattr(g, k, v._mcpts.reshape(1, -1))
+        return g
+    
+    def distance_many(self, lats, lons):
+        """
+            Returns the gmpe distance at the points of interest lats and lons (numpy column 
+            vectors, i.e. arrays of shape (N, 1)). Default implementation calls distance 
+            on self.sampled(), thus the returned value is in general a numpy matrix of shape (N, npts)
+        """
+        return self.sampled().distance(lats, lons)
+    
+    def calculate_many(self, distance):
+        """
+            Returns the intensity at the given distance (numpy matrix of shape (N, npts), 
+            or (N, 1)). Default implementation calls calculate on self.sampled()
+        """
+        return self.sampled().calculate(distance)
+    
     def __repr__(self):
         return self.__class__.__name__
     
@@ -349,7 +445,7 @@ class Gmpe(object):
 #c2 = -1.107
 #c3 = 0.813
 
-from gmpe_utils import rup_distance, rld_rw
+from gmpe_utils import FaultGeometry, rld_rw
 
 class GlobalWaRup(Gmpe):
     ref = "Intensity attenuation for active crustal regions (Allen et al.). J Seismol (2012) 16:409–433"
@@ -375,11 +471,37 @@ class GlobalWaRup(Gmpe):
         I = c0 + c1 * self.m + c2 * log (sqrt( distance ** 2 + (1 + c3 * exp(self.m -5)) **2 ))
         return I
     
+    def __init__(self, **kwargs):
+        Gmpe.__init__(self, **kwargs)
+        #build the fault geometry here, once per scenario (Gmpe.__init__ might have already built it 
+        #while checking the arguments, in which case this is a no-op):
+        self.geometry
+    
+    @property
+    def geometry(self):
+        """
+            Returns the gmpe_utils.FaultGeometry of this object, i.e. all fault quantities which do not depend 
+            on the point of interest, built from the samples of the parameters (see Gmpe.samples).
+            The object is created once in __init__ and then reused for any point of interest
+        """
+        if not hasattr(self, "_geometry"):
+            smp = Gmpe.samples
+            m = smp(self.m)
+            self._rld, self._rw = rld_rw(self.sof)(m)
+            self._geometry = FaultGeometry(smp(self.lat), smp(self.lon), smp(self.depth), smp(self.strike), 
+                                           smp(self.dip), self._rld, self._rw)
+        return self._geometry
+    
     def distance(self, lat, lon):
-        if not hasattr(self, "_rld"):
-            self._rld, self._rw = rld_rw(self.sof)(self.m)
-        R_rup = rup_distance(lat, lon, self.lat, self.lon, self.depth, self.strike, self.dip, self._rld, self._rw)
-        return R_rup
+        #lat and lon might be distributions (see e.g. core.ref_dist): use their samples, which are 
+        #coupled element-wise to the parameters samples (as in mcerp arithmetic)
+        lat = lat._mcpts if isinstance(lat, mcerp.UncertainFunction) else lat
+        lon = lon._mcpts if isinstance(lon, mcerp.UncertainFunction) else lon
+        R_rup = self.geometry.distances(lat, lon)[3]
+        return mcerp.UncertainFunction(R_rup) if np.ndim(R_rup) else float(R_rup)
+    
+    def distance_many(self, lats, lons):
+        return self.geometry.distances(lats, lons)[3]
     
 class GlobalWaHyp(Gmpe):
     #defining constants (c0, c1 , c2 , c4, m1, m2). FIXME: works like Java, does it save memory?)
@@ -415,7 +537,10 @@ class GlobalWaHyp(Gmpe):
         M = self.m #magnitude
         R_M = m1 + m2 * exp(M-5)
         I = c0 + c1 * M + c2 * log(sqrt(distance ** 2 + R_M ** 2))
-        if distance > 50:
+        if isinstance(distance, np.ndarray):
+            #numpy arrays (see evaluate_many): apply the condition element-wise (log(1)=0 for distance <= 50)
+            I = I + c4 * log(np.maximum(distance, 50)/50)
+        elif distance > 50:
             I = I + c4 * log(distance/50)
 
         return I
@@ -1,3 +1,5 @@
+import numpy as np
+import caravan.settings.globals as glb
 
 class exposure:
     '''
@@ -36,19 +38,19 @@ class exposure:
         #In any case, use format instead of % cause the latter is not (yet) deprecated but the former it's more PY3 compliant
         #Form reference, see https://docs.python.org/2/library/string.html#formatstrings
         query = 'SELECT geocell_id,bdg_density,pop_density,geocell_area FROM exposure.targets WHERE geocell_id=%s' #.format(geocell_id)
-        self.__target_prop = db_conn.fetchall(query, (geocell_id,) )
+        self.__target_prop = db_conn.fetchall(query, (geocell_id,), prepare=glb.DB_PREPARED)
 
         # get building distribution for the location
         query = 'SELECT geocell_id, building_type, freq_dirichlet FROM exposure.building_distributions WHERE geocell_id=%s' #.format(geocell_id)
-        self.__bldg_dist = db_conn.fetchall(query,(geocell_id,))
+        self.__bldg_dist = db_conn.fetchall(query,(geocell_id,), prepare=glb.DB_PREPARED)
         
         # get according building_type vulnerability-distribution, occupancy (low + high) and construction cost
         query = 'SELECT gid, vuln_ems98, occupancy_storey_low, occupancy_storey_high, construction_cost FROM exposure.building_types WHERE gid IN (SELECT building_type FROM exposure.building_distributions WHERE geocell_id=%s)' #.format(geocell_id)
-        self.__bt_prop = db_conn.fetchall(query, (geocell_id,))
+        self.__bt_prop = db_conn.fetchall(query, (geocell_id,), prepare=glb.DB_PREPARED)
 
         # get coordinates of location
         query = 'SELECT ST_X(the_geom),ST_Y(the_geom) FROM exposure.targets WHERE geocell_id=%s' #.format(geocell_id)
-        self.__target_loc = db_conn.fetchall(query, (geocell_id,))
+        self.__target_loc = db_conn.fetchall(query, (geocell_id,), prepare=glb.DB_PREPARED)
 
     @property
     def bldg_dist(self):
@@ -85,3 +87,86 @@ class exposure:
         Get longitude and latitude of target
         '''
         return self.__target_loc
+
+def toarrays(exposures):
+    '''
+    Returns the exposure information of N locations as numpy arrays, i.e. the dict:
+        'geocell_id': array of length N (the geocell ids)
+        'valid': boolean array of length N (False for locations with missing or malformed exposure information)
+        'bdg_dens_low', 'bdg_dens_high', 'area': arrays of length N (building density bounds and geocell area)
+        'bt_freq', 'occ_low', 'occ_high': matrices (N, B) of the share and the occupancy bounds of the 
+                                          building types of each location
+        'vul_shares': matrix (N, B, 6) of the vulnerability class shares of the building types of each location
+    where exposures is an iterable of N exposure objects and B is the maximum number of building types 
+    in a location. Locations with less building types are padded with zeros
+    '''
+    geocell_ids, target_props, bldg_dists, bt_props = [], {}, {}, {}
+    for exp in exposures:
+        geocell_id = exp.target_prop[0][0] if exp.target_prop else None
+        geocell_ids.append(geocell_id)
+        if exp.target_prop:
+            target_props[geocell_id] = exp.target_prop[0]
+        bldg_dists[geocell_id] = exp.bldg_dist
+        bt_props.update((row[0], row) for row in exp.bt_prop)
+    return _pack(geocell_ids, target_props, bldg_dists, bt_props)
+
+def preload(db_conn, geocell_ids):
+    '''
+    Loads from the database the exposure information of all the given geocells with a few set-based 
+    queries (instead of four queries per geocell, see exposure) and returns them as numpy arrays sorted 
+    by geocell id (see toarrays). Use select to get the arrays of a subset of geocells
+    '''
+    geocell_ids = sorted(set(geocell_ids))
+    
+    target_props = {}
+    query = 'SELECT geocell_id, bdg_density, pop_density, geocell_area FROM exposure.targets WHERE geocell_id = ANY(%s)'
+    for row in db_conn.fetchall(query, (geocell_ids,)):
+        if row[0] not in target_props: #as exposure.target_prop[0]
+            target_props[row[0]] = row
+    
+    bldg_dists = {}
+    query = 'SELECT geocell_id, building_type, freq_dirichlet FROM exposure.building_distributions WHERE geocell_id = ANY(%s)'
+    for row in db_conn.fetchall(query, (geocell_ids,)):
+        bldg_dists.setdefault(row[0], []).append(row)
+    
+    query = 'SELECT gid, vuln_ems98, occupancy_storey_low, occupancy_storey_high, construction_cost FROM exposure.building_types WHERE gid IN (SELECT building_type FROM exposure.building_distributions WHERE geocell_id = ANY(%s))'
+    bt_props = {row[0]: row for row in db_conn.fetchall(query, (geocell_ids,))}
+    
+    return _pack(geocell_ids, target_props, bldg_dists, bt_props)
+
+def select(arrays, geocell_ids):
+    '''
+    Returns the exposure arrays (see toarrays) of the given geocells, from the arrays returned by preload.
+    Geocells not found in arrays are marked as not valid
+    '''
+    geocell_ids = np.asarray(geocell_ids)
+    if not len(arrays['geocell_id']):
+        return _pack(geocell_ids.tolist(), {}, {}, {})
+    idx = np.clip(np.searchsorted(arrays['geocell_id'], geocell_ids), 0, max(0, len(arrays['geocell_id'])-1))
+    ret = {k: v[idx] for k, v in arrays.iteritems()}
+    ret['valid'] = ret['valid'] & (ret['geocell_id'] == geocell_ids)
+    ret['geocell_id'] = geocell_ids
+    return ret
+
+def _pack(geocell_ids, target_props, bldg_dists, bt_props):
+    #returns the exposure arrays (see toarrays) of the given geocell ids. target_props is a dict of geocell ids mapped 
+    #to their row in exposure.targets, bldg_dists a dict of geocell ids mapped to their rows in exposure.building_distributions, 
+    #bt_props a dict of building type ids mapped to their row in exposure.building_types
+    N = len(geocell_ids)
+    B = max([len(bldg_dists.get(g, [])) for g in geocell_ids] + [1])
+    ret = {'geocell_id': np.array(geocell_ids), 'valid': np.ones(N, dtype=bool),
+           'bdg_dens_low': np.zeros(N), 'bdg_dens_high': np.zeros(N), 'area': np.zeros(N),
+           'bt_freq': np.zeros((N, B)), 'occ_low': np.zeros((N, B)), 'occ_high': np.zeros((N, B)),
+           'vul_shares': np.zeros((N, B, 6))}
+    for i, geocell_id in enumerate(geocell_ids):
+        try:
+            target_prop = target_props[geocell_id]
+            ret['bdg_dens_low'][i], ret['bdg_dens_high'][i], ret['area'][i] = target_prop[1][0], target_prop[1][1], target_prop[3]
+            for j, row in enumerate(bldg_dists.get(geocell_id, [])):
+                bt = bt_props[row[1]]
+                ret['bt_freq'][i, j] = row[2]
+                ret['occ_low'][i, j], ret['occ_high'][i, j] = bt[2], bt[3]
+                ret['vul_shares'][i, j] = bt[1]
+        except Exception:
+            ret['valid'][i] = False
+    return ret
@@ -2,6 +2,78 @@ import mcerp
 import scipy.stats
 import numpy as np
 import caravan.settings.globals as glb
+import vulnerability_module
+import caravan.dbutils as dbutils
+
+def buildings_many(bdg_dens_low, bdg_dens_high, area, npts=None):
+    '''
+    Returns the number of buildings samples of N geocells as a numpy matrix of shape (N, npts), where 
+    bdg_dens_low, bdg_dens_high and area are numpy arrays of length N (the bounds of the building density, 
+    uniformly distributed, and the geocell area, respectively). npts defaults to mcerp.npts
+    '''
+    npts = npts or mcerp.npts
+    low, high = np.asarray(bdg_dens_low, dtype=float)[:, None], np.asarray(bdg_dens_high, dtype=float)[:, None]
+    #sometimes we have same lower and higher, in that case (high - low) = 0 and the density is a scalar
+    density = low + (high - low) * vulnerability_module.lhs_uniform((len(low), npts))
+    return density * np.asarray(area, dtype=float)[:, None]
+
+def fatalities_many(bt_dmg, nr_bdgs, bt_freq, occ_low, occ_high, nighttime=True):
+    '''
+    Returns the fatalities samples of N geocells as a numpy matrix of shape (N, npts), according to 
+    Coburn and Spence 2002. All arguments are numpy arrays:
+    
+    bt_dmg: the damage samples (N, B, npts) of B building types in each geocell (see vulnerability_module.damage_bts_many)
+    nr_bdgs: the number of buildings samples (N, npts) in each geocell (see buildings_many)
+    bt_freq: the share (N, B) of each building type in each geocell (pad with zeros geocells with less than B building types)
+    occ_low, occ_high: the occupancy bounds (N, B) (per storey, uniformly distributed) of each building type in each geocell
+    '''
+    #cdf values:
+    p45 = np.mean(bt_dmg < 4.5, axis=-1)
+    p35 = np.mean(bt_dmg < 3.5, axis=-1)
+    return fatalities_cdf(p35, p45, nr_bdgs, bt_freq, occ_low, occ_high, nighttime)
+
+def fatalities_cdf(p35, p45, nr_bdgs, bt_freq, occ_low, occ_high, nighttime=True):
+    '''
+    Same as fatalities_many, but the damage of the building types is given as the probabilities 
+    p35 = P(damage < 3.5) and p45 = P(damage < 4.5), numpy matrices of shape (N, B) 
+    (see e.g. vulnerability_module.damage_bts_cdf)
+    '''
+    # determine if nighttime or not
+    coeff = 0.5 if nighttime else 0.3
+    p35, p45 = np.asarray(p35, dtype=float), np.asarray(p45, dtype=float)
+    occ_low, occ_high = np.asarray(occ_low, dtype=float), np.asarray(occ_high, dtype=float)
+    shape = p45.shape + (nr_bdgs.shape[-1],)
+    occupancy = occ_low[:, :, None] + (occ_high - occ_low)[:, :, None] * vulnerability_module.lhs_uniform(shape)
+    #occupancy of each building type: occupancy * (number of buildings * building type share):
+    bt_occ = occupancy * nr_bdgs[:, None, :] * np.asarray(bt_freq, dtype=float)[:, :, None]
+    # coeff*p(dg3.5<dg<dg4.5)*bt_occ + coeff*p(dg>4.5)*bt_occ
+    p4 = p45 - p35
+    p5 = 1 - p45
+    #fatality distribution (sum over building types):
+    return coeff * np.sum((0.25 * p4 + p5)[:, :, None] * bt_occ, axis=1)
+
+#columns of risk.social_conseq written by loss.write2db and write_many:
+SOCIAL_CONSEQ_COLUMNS = ('session_id', 'scenario_id', 'geocell_id', 'target_id', 'est_fatalities', 'fatalities_prob_dist')
+
+def write_many(db_conn, fatalities, session_id, scenario_id, target_ids, geocell_ids, labels=None, writer=None):
+    '''
+    Writes the fatalities samples (N, npts) of N geocells (see fatalities_many) to the risk schema, 
+    in the same format of loss.write2db. target_ids and geocell_ids are iterables of length N. labels defaults 
+    to loss._fatalities_labels. 
+    writer is an optional dbutils.BatchWriter of risk.social_conseq (see SOCIAL_CONSEQ_COLUMNS): if given, rows are 
+    added to it and written according to its policy. Otherwise, all rows are written with a single statement. 
+    Returns the list of rows not written (see dbutils.BatchWriter.dropped) if writer is None, or the empty list
+    '''
+    labels = labels or loss._fatalities_labels
+    est_fat = glb.percentile_many(fatalities, [0.05, 0.95]) #5th and 95th percentiles
+    fatalities_prob_dist = np.hstack((glb.discretepdf_many(fatalities, labels), glb.percentile_many(fatalities, [0.5])))
+    _writer = writer or dbutils.BatchWriter(db_conn, 'risk.social_conseq', SOCIAL_CONSEQ_COLUMNS, len(est_fat), prepare=glb.DB_PREPARED)
+    for target_id, geocell_id, est, dist in zip(target_ids, geocell_ids, est_fat, fatalities_prob_dist):
+        _writer.add((session_id, scenario_id, geocell_id, target_id, est.tolist(), dist.tolist()))
+    if writer is None:
+        _writer.flush()
+        return _writer.dropped
+    return []
 
 class loss:
     _type_int = type(0)
@@ -59,71 +131,23 @@ class loss:
         Method to calculate social losses in terms of fatalities
         according to Coburn and Spence 2002
         '''
-        # determine if nighttime or not
-        if nighttime:
-            self.__coeff = 0.5
-        else:
-            self.__coeff = 0.3
-
-        #1) nr_bdgs (for location): target.bdg_dens*target.geocell_area
-        #sometimes we have same lower and higher, therefore use the scalar
-        distribution_density = self.__target_prop[0][1][0] if self.__target_prop[0][1][0] == self.__target_prop[0][1][1] else\
-                                mcerp.Uniform(self.__target_prop[0][1][0],self.__target_prop[0][1][1])
-        
-        self.__nr_bdgs = distribution_density * self.__target_prop[0][3]
+        if not len(self.__bldg_dist): #no building types (e.g., no exposure data): no fatalities
+            self.__fat = mcerp.UncertainFunction(np.zeros(mcerp.npts))
+            return self.__fat
+        #arrays of a single location, in the order of the building distribution:
+        bt_prop = {row[0]: row for row in self.__bt_prop}
+        bt_ids = [row[1] for row in self.__bldg_dist]
+        bt_dmg = np.array([[self.__bt_dmg[bt_id]._mcpts for bt_id in bt_ids]])
         
-        #self.__nr_bdgs = self.__target_prop[0][1][0] * self.__target_prop[0][3]
+        #1) nr_bdgs (for location): target.bdg_dens*target.geocell_area
+        nr_bdgs = buildings_many([self.__target_prop[0][1][0]], [self.__target_prop[0][1][1]], [self.__target_prop[0][3]],
+                                 bt_dmg.shape[-1])
         #2) bt_nr (for location): nr_bdgs * bt_share(=building_distributions.freq_dirichlet)
-        self.__bt_nr = [(self.__bldg_dist[i][1], self.__nr_bdgs*self.__bldg_dist[i][2]) for i in range(len(self.__bldg_dist))]
-        #3) create occpupancy distribution for each bt:
-        # assumptions: normally distributed,mean=(occ_max-occ_min/2),std=1/10*range, normal distribution truncated at range bounds of bt_occ[min_occ,max_occ]: bt_occ_min=occ_low*bt_nr; bt_occ_max=occ_high*bt_nr
-        self.__bt_occ={}
-        
-       
-        
-        for i in range(len(self.__bt_nr)):
-            bt_id = self.__bt_nr[i][0]
-            for j in range(len(self.__bt_prop)):
-                bt_id2 = self.__bt_prop[j][0]
-                if bt_id==bt_id2:
-                    #bt_nr = self.__bt_nr[i][1]
-                    #occ_min = self.__bt_prop[j][2]
-                    #occ_max = self.__bt_prop[j][3]
-                    occupancy_storey_low = self.__bt_prop[j][2]
-                    occupancy_storey_high = self.__bt_prop[j][3]
-                    
-#                    occupancy_storey = occupancy_storey_low if occupancy_storey_low >= occupancy_storey_high else \
-                    occupancy_storey = mcerp.Uniform(occupancy_storey_low, occupancy_storey_high)
-                    
-#                    lower = occupancy_storey_low * self.__bt_nr[i][1]
-#                    upper = occupancy_storey_high * self.__bt_nr[i][1]
-                    
-                    self.__bt_occ[bt_id] = occupancy_storey * self.__bt_nr[i][1]
-                    
-#                    mu = (upper-lower)/2
-#                    sigma = mu/10
-#                    a,b = (lower-mu)/sigma,(upper-mu)/sigma
-#                    self.__bt_occ[bt_id]=mcerp.uv(scipy.stats.truncnorm(a,b,loc=mu,scale=sigma))
-                    
-                    #plotting
-                    #plotting.plot_pdf(self.__bt_occ[bt_id],'Occupancy',fname='occ_location_bt'+str(bt_id))
-        
-        #print(str(self.__bt_nr)+" "+str(self.__bt_occ))
-         
-        #4) calculate fatality distribution for each bt and sum them up:
-        self.__fat = 0
-        for row in self.__bt_nr:
-            bt_id = row[0]
-            # coeff*p(dg3.5<dg<dg4.5)*bt_occ + coeff*p(dg>4.5)*bt_occ
-            #cdf values:
-            p45 = self.__bt_dmg[bt_id] < 4.5
-            p35 = self.__bt_dmg[bt_id] < 3.5
-            p4 = p45 - p35
-            p5 = 1 - p45
-            #fatality distribution
-            
-            self.__fat += self.__coeff*(0.25*p4*self.__bt_occ[bt_id] + p5*self.__bt_occ[bt_id])
+        #3) occupancy (uniformly distributed) for each bt, and fatality distribution for each bt summed up:
+        fat = fatalities_many(bt_dmg, nr_bdgs, [[row[2] for row in self.__bldg_dist]], 
+                              [[bt_prop[bt_id][2] for bt_id in bt_ids]], [[bt_prop[bt_id][3] for bt_id in bt_ids]], nighttime)
         
+        self.__fat = mcerp.UncertainFunction(fat[0])
         return self.__fat
 
     def write2db(self, db_conn, percentiles): #,scenario_id,target,social):
@@ -142,7 +166,7 @@ class loss:
         #fatalities_prob_dist.append(np.percentile(self.__fat._mcpts,0.5).astype(int))
         exc ='INSERT INTO risk.social_conseq (session_id, scenario_id, geocell_id, target_id, est_fatalities, fatalities_prob_dist) VALUES (%s, %s, %s, %s, %s, %s)'
         values = (self.__session_id, self.__scenario_id, self.__geocell_id, self.__target_id, est_fat, fatalities_prob_dist)
-        db_conn.execute(exc, values)
+        db_conn.execute(exc, values, prepare=glb.DB_PREPARED)
 
         
 #        fatalities_prob_dist = [0] * len(fat_labels)
@@ -1,88 +1,264 @@
 import math
-import scipy.stats
+import numpy as np
+import scipy.special
+import scipy.ndimage
 import mcerp
 
+#vulnerability classes (EMS-98) and their Vulnerability Index distributions according to Giovinazzi 2005:
+#normal distributions where:
+#    mean: most likely VI
+#    sigma: most likely VI - greatest/least plausible VI = 0.04 for all
+#TODO: Include according to Giovinazzi 2005 Modification factors (local factors etc.)
+VUL_CLASSES = ('A','B','C','D','E','F')
+VI_MEANS = (0.90, 0.74, 0.58, 0.42, 0.26, 0.10)
+VI_SIGMA = 0.04
+
+#caches (per process), see vi_samples, quantile_grid and damage_grades:
+_VI_CACHE = {}
+_QUANTILES_CACHE = {}
+_DG_CACHE = {}
+_DG_CACHE_SIZE = 1000
+
+#number of bins of the damage grid of the vulnerability classes in damage_bts_cdf:
+_CDF_BINS = 100
+#step of the intensity grid in damage_bts_cdf (a multiple of _CDF_Z_STEP):
+_CDF_INTENSITY_STEP = 0.1
+#max number of elements of the arrays processed at once in damage_bts_cdf:
+_CDF_BLOCK_SIZE = 2 ** 20
+#cache (per process) of the damage grade cdf tables (see _cdf_table), their range and step of I + 6.25 * VI 
+#(the damage grade is almost surely 0 below and 5 above the range) and number of intervals of [0, 1]:
+_CDF_TABLE_CACHE = {}
+_CDF_Z_RANGE = (0, 26)
+_CDF_Z_STEP = 0.025
+_CDF_TABLE_SIZE = 1024
+
+def vi_samples(npts=None):
+    '''
+    Returns the Vulnerability Index samples of all vulnerability classes as a numpy matrix of shape 
+    (len(VUL_CLASSES), npts). npts defaults to mcerp.npts. 
+    The VI distributions do not depend on the location, thus the samples are generated once per 
+    process and npts, and cached
+    '''
+    npts = npts or mcerp.npts
+    if npts not in _VI_CACHE:
+        #same as mcerp.N(mean, VI_SIGMA)._mcpts for each mean, but with npts points:
+        _VI_CACHE[npts] = np.array(VI_MEANS)[:, None] + VI_SIGMA * scipy.special.ndtri(lhs_uniform((len(VI_MEANS), npts)))
+    return _VI_CACHE[npts]
+
+def quantile_grid(npts=None):
+    '''
+    Returns the stratified quantile grid (one quantile in the middle of each of the npts strata of [0, 1], 
+    randomly permuted for each vulnerability class) used to sample the beta damage grade distributions 
+    via their inverse cdf, as numpy matrix of shape (len(VUL_CLASSES), npts). npts defaults to mcerp.npts. 
+    The grid is generated once per process and npts, and cached
+    '''
+    npts = npts or mcerp.npts
+    if npts not in _QUANTILES_CACHE:
+        strata = np.argsort(np.random.random((len(VUL_CLASSES), npts)), axis=-1)
+        _QUANTILES_CACHE[npts] = (strata + 0.5) / float(npts)
+    return _QUANTILES_CACHE[npts]
+
+def lhs_uniform(shape):
+    '''
+    Returns latin-hypercube samples of the uniform distribution in [0, 1] with the given shape, 
+    stratified along the last axis (as mcerp does for each distribution)
+    '''
+    npts = shape[-1]
+    strata = np.argsort(np.random.random(shape), axis=-1) #a random permutation of 0,...,npts-1 along the last axis
+    return (strata + np.random.random(shape)) / float(npts)
+
+def mean_damage_grade(I, V, Q=2.3):
+    '''
+    Returns damage grade for a given MMI samples 'I' and vulnerability index samples 'V' and ductility 'Q'(default: Q=2.3)
+    I and V are numpy arrays (or scalars) which must be broadcastable
+    '''
+    return 2.5*(1+np.tanh((I+6.25*V-13.1)/Q))
+
+def damage_grades(I, t=8, low=0, high=6):
+    '''
+    Returns the damage grade samples of all vulnerability classes for the given intensity samples, 
+    according to Giovinazzi 2005 (beta distribution with t=8 and damage grades 1-5 + no damage(DG 0) --> low=0 high=6)
+    
+    I is a numpy matrix of shape (N, npts) or (N, 1) holding the intensity samples of N geocells 
+    (a single column denotes scalar intensities). The returned matrix has shape (N, len(VUL_CLASSES), npts), 
+    where npts is mcerp.npts if I has a single column. 
+    Damage grades of scalar intensities with default arguments are cached by intensity value (see _DG_CACHE_SIZE)
+    '''
+    I = np.asarray(I, dtype=float)
+    if I.shape[1] > 1 or (t, low, high) != (8, 0, 6):
+        return _damage_grades(I, t, low, high)
+    
+    npts = mcerp.npts
+    values, inverse = np.unique(I[:, 0], return_inverse=True)
+    missing = [v for v in values if (npts, v) not in _DG_CACHE]
+    if missing:
+        if len(_DG_CACHE) + len(missing) > _DG_CACHE_SIZE:
+            _DG_CACHE.clear()
+        for v, dg in zip(missing, _damage_grades(np.reshape(missing, (-1, 1)), t, low, high)):
+            _DG_CACHE[(npts, v)] = dg
+    return np.array([_DG_CACHE[(npts, v)] for v in values])[inverse]
+
+def _damage_grades(I, t, low, high):
+    #computes damage_grades (see above) with no cache
+    assert low<high, 'Beta "low" must be less than "high"'
+    alpha, beta = beta_params(I, t)
+    #each sample is drawn from its own beta distribution (as mcerp.uv(scipy.stats.beta(alpha, beta)) does 
+    #with vectors alpha and beta), via the inverse of the beta cdf evaluated on the quantile grid:
+    return low + (high-low) * scipy.special.betaincinv(alpha, beta, quantile_grid(alpha.shape[-1])[None, :, :])
+
+def beta_params(I, t=8):
+    '''
+    Returns the tuple (alpha, beta) of the Giovinazzi 2005 beta damage grade distributions of all vulnerability 
+    classes for the given intensity samples I, numpy matrix of shape (N, npts) or (N, 1) (a single column 
+    denotes scalar intensities). alpha and beta are numpy matrices of shape (N, len(VUL_CLASSES), npts), 
+    where npts is mcerp.npts if I has a single column
+    '''
+    I = np.asarray(I, dtype=float)
+    npts = I.shape[1] if I.shape[1] > 1 else mcerp.npts
+    mu_d = mean_damage_grade(I[:, None, :], vi_samples(npts)[None, :, :])
+    #r,t parameters according to Giovinazzi 2005 (t=8), converted to alpha,beta:
+    alpha = t * (0.007 * mu_d**3 - 0.0525 * mu_d**2 + 0.2875 * mu_d)
+    beta = t - alpha
+    assert np.all(alpha>0) and np.all(beta>0), 'Beta "alpha" and "beta" parameters must be greater than zero'
+    return alpha, beta
+
+def damage_bts_cdf(I, vul_shares, x, t=8, low=0, high=6, bins=None):
+    '''
+    Returns the probabilities P(damage < x) of the building types of N geocells as a numpy matrix of shape (N, B), 
+    with no damage grade sampling (see damage_bts_many for the sampled counterpart). If x is an iterable, returns 
+    the matrix (N, B, len(x)) of the probabilities of each value of x. 
+    I is a numpy matrix of shape (N, npts) or (N, 1) holding the intensity samples of N geocells (a single column 
+    denotes scalar intensities) and vul_shares is the matrix (N, B, len(VUL_CLASSES)) of the vulnerability class 
+    shares of B building types in each geocell. 
+    
+    The damage of a building type is the sum of the damage grades of its vulnerability classes weighted by their shares. 
+    Given the intensity, the damage grades are independent, and the cdf of each of them (a beta distribution averaged 
+    over the normal Vulnerability Index, see _cdf_table) is read from a table computed once per process. 
+    Each weighted damage grade is discretized on a grid of bins (default: _CDF_BINS) bins, and the distribution 
+    of the sum is the convolution of the latter (via FFT), shifted to match the exact mean of the sum. 
+    Intensity samples are grouped on a grid with step _CDF_INTENSITY_STEP (linear interpolation), so that the 
+    cost does not grow with npts. The returned probability is the average over the intensity samples
+    '''
+    assert low<high, 'Beta "low" must be less than "high"'
+    I = np.asarray(I, dtype=float)
+    vul_shares = np.asarray(vul_shares, dtype=float)
+    N, B, C = vul_shares.shape
+    xs = np.asarray(x, dtype=float)
+    ret = np.zeros((N, B, xs.size))
+    if not N or not B:
+        return ret if xs.ndim else ret[:, :, 0]
+    
+    #intensity grid: each sample weight (1/npts) is split between the two nearest grid points:
+    step = _CDF_INTENSITY_STEP
+    g = I / step
+    k0 = np.floor(g)
+    frac = g - k0
+    offset = np.min(k0, axis=1) #(N,)
+    k0 = (k0 - offset[:, None]).astype(int)
+    K = int(np.max(k0)) + 2
+    k0 += K * np.arange(N)[:, None] #(indices of the flattened (N, K) matrix)
+    w = np.bincount(k0.ravel(), ((1 - frac) / I.shape[1]).ravel(), minlength=N*K) + \
+        np.bincount(k0.ravel() + 1, (frac / I.shape[1]).ravel(), minlength=N*K)
+    w = w.reshape(N, K)
+    cells, ks = np.nonzero(w) #the (geocell, intensity) pairs to be computed
+    intensities = (offset[cells] + ks) * step
+    weights = w[cells, ks]
+    
+    #grid of the damage grades in [0, 1] (before scaling to [low, high]), wide enough for the sum of the shares:
+    bins = bins or _CDF_BINS
+    total = np.sum(vul_shares, axis=-1) #(N, B)
+    h = max(1.0, float(np.max(total))) / bins
+    edges = h * np.arange(1, bins+1) #upper bin edges (the first bin holds also the mass at zero)
+    midpoints = h * (np.arange(bins) + 0.5)
+    size = 2 ** int(np.ceil(np.log2(bins + C + 1))) #fft length (no circular overlap of the convolution)
+    z, cdf_table, mean_table = _cdf_table(t)
+    dz, du = _CDF_Z_STEP, 1.0 / _CDF_TABLE_SIZE
+    
+    #process the (geocell, intensity) pairs in blocks, to limit memory usage:
+    block = max(1, _CDF_BLOCK_SIZE // (B * size))
+    for start in xrange(0, len(cells), block):
+        n, I_k = cells[start:start+block], intensities[start:start+block]
+        shares = vul_shares[n] #(P, B, C)
+        spectrum = np.ones(shares.shape[:2] + (size // 2 + 1,), dtype=complex)
+        #exact mean minus discretized mean of the sum (the latter has bin masses at bin midpoints), (P, B):
+        shift = np.zeros(shares.shape[:2])
+        for c in xrange(C):
+            p, b = np.nonzero(shares[:, :, c] > 0)
+            if not len(p):
+                continue
+            s = shares[p, b, c]
+            #mass of share * damage grade in each bin of the grid, from the tabulated cdf (the table row is exact, as 
+            #the intensity grid and 6.25 * VI_MEANS are multiples of the table step. Columns are interpolated linearly):
+            zi = np.clip(np.rint((I_k[p] + 6.25 * VI_MEANS[c] - z[0]) / dz).astype(int), 0, len(z) - 1)[:, None]
+            uf = np.minimum(edges[None, :] / s[:, None], 1) / du
+            ui = np.minimum(uf.astype(int), cdf_table.shape[1] - 2)
+            uf -= ui
+            cdf = cdf_table[zi, ui]
+            cdf += uf * (cdf_table[zi, ui+1] - cdf)
+            pmf = np.diff(np.hstack((np.zeros((len(s), 1)), cdf)), axis=-1)
+            spectrum[p, b] *= np.fft.rfft(pmf, size)
+            mean = mean_table[zi[:, 0]]
+            shift[p, b] += s * mean - np.dot(pmf, midpoints)
+        pmf = np.fft.irfft(spectrum, size)[:, :, :bins + C] #(P, B, bins + C)
+        #each bin mass is placed at the bin midpoint (zero for vulnerability classes with no share), shifted so that 
+        #the mean of the sum is exact, and spread uniformly over the bin width:
+        num_classes = np.sum(shares > 0, axis=-1) #(P, B)
+        values = h * (np.arange(pmf.shape[-1])[None, None, :] + 0.5 * num_classes[:, :, None]) + shift[:, :, None]
+        x_n = (xs.ravel()[None, None, :] - low * total[n][:, :, None]) / float(high - low) #(P, B, len(x))
+        within = np.clip((x_n[:, :, None, :] - values[:, :, :, None]) / h + 0.5, 0, 1) #(P, B, bins + C, len(x))
+        np.add.at(ret, n, weights[start:start+block, None, None] * np.einsum('pbm,pbmx->pbx', pmf, within))
+    
+    return np.clip(ret, 0, 1) if xs.ndim else np.clip(ret[:, :, 0], 0, 1)
+
+def _cdf_table(t=8):
+    '''
+    Returns the tuple (z, cdf, mean) of the damage grade distribution averaged over the Vulnerability Index, 
+    where z is the numpy array of the values of I + 6.25 * mean(VI) (see mean_damage_grade), cdf the matrix 
+    (len(z), _CDF_TABLE_SIZE + 1) of the cdf of the damage grade (in [0, 1]) on a uniform grid of [0, 1], and 
+    mean the array of the means of the damage grade. As the VI is normal with sigma VI_SIGMA, the table is the 
+    beta cdf (see beta_params) smoothed along z with a gaussian of sigma 6.25 * VI_SIGMA. 
+    The table is computed once per process and t, and cached
+    '''
+    if t not in _CDF_TABLE_CACHE:
+        z = np.arange(_CDF_Z_RANGE[0], _CDF_Z_RANGE[1] + _CDF_Z_STEP / 2.0, _CDF_Z_STEP)
+        mu_d = mean_damage_grade(z, 0)
+        alpha = t * (0.007 * mu_d**3 - 0.0525 * mu_d**2 + 0.2875 * mu_d)
+        cdf = scipy.special.betainc(alpha[:, None], (t - alpha)[:, None], np.linspace(0, 1, _CDF_TABLE_SIZE + 1)[None, :])
+        sigma = 6.25 * VI_SIGMA / _CDF_Z_STEP
+        _CDF_TABLE_CACHE[t] = (z, scipy.ndimage.gaussian_filter1d(cdf, sigma, axis=0, mode='nearest'), 
+                               scipy.ndimage.gaussian_filter1d(alpha / float(t), sigma, mode='nearest'))
+    return _CDF_TABLE_CACHE[t]
+
+def damage_bts_many(dg, vul_shares):
+    '''
+    Returns the damage samples of the building types of N geocells as a numpy matrix of shape (N, B, npts), where 
+    dg is the matrix of damage grade samples (N, len(VUL_CLASSES), npts) (see damage_grades) and vul_shares 
+    is the matrix (N, B, len(VUL_CLASSES)) of the vulnerability class shares of B building types in each geocell 
+    (pad with zeros geocells with less than B building types)
+    '''
+    return np.einsum('nbc,ncs->nbs', np.asarray(vul_shares, dtype=float), dg)
+
 class vulnerability:
     '''
     Class for the DPM calculation and damage calculation for a given building type distribution and building-type vulnerability distribution of a location
+    Thin wrapper around damage_grades for a single location (see damage_grades and damage_bts_many for N locations)
     '''
 
     def __init__(self, gm, bt_dist, bt_prop):
         self.__gm = gm
         self.__bt_dist = bt_dist
         self.__bt_prop = bt_prop
-        self.__vul_class_map = ['A','B','C','D','E','F']
+        self.__vul_class_map = list(VUL_CLASSES)
         # Create Damage grade distribution for all vulnerability classes according to Giovinazzi 2005
         # gm: intensity for location
         # bt_dist: distribution of building types at location
         # bt_prop: propertiess of the different building types at the location
+        I = gm._mcpts if isinstance(gm, mcerp.UncertainFunction) else [gm]
+        dg = damage_grades(np.reshape(I, (1, -1)))[0]
         self.__dg_pdf={}
-        for vul_class in self.__vul_class_map:
-            #Vulnerability index distribution for class
-            self.__vi = self.__class2VI(vul_class)
+        for index, vul_class in enumerate(self.__vul_class_map):
             #damage grade PDFs for all vulnerability classes
-            tmp = self.__pbeta(self.__mean_damage_grade(self.__gm,self.__vi))
-            self.__dg_pdf[vul_class] = tmp
-
-    def __class2VI(self,vul_class):
-        '''
-        Returns Vulnerability Index distribution according to Giovinazzi 2005 in form of a normal
-        distribution where:
-            mean: most likely VI
-            sigma: most likely VI - greatest/least plausible VI = 0.04 for all
-        '''
-        #TODO: Include according to Giovinazzi 2005 Modification factors (local factors etc.)
-        self.__means = {'A': 0.90, 'B': 0.74, 'C': 0.58, 'D': 0.42, 'E': 0.26 , 'F': 0.10}
-        self.__sigma = 0.04
-
-        return mcerp.N(self.__means[vul_class],self.__sigma)
-
-    def __pbeta(self,mu_d,t=8):
-        '''
-        Beta distribution to define damage state probability density parameters according to Giovinazzi 2005:
-        We have Damage grades 1-5 + no damage(DG 0) --> a=0 b=6
-        '''
-        self.__t=t
-        #bounds of dg0-5
-        self.__a,self.__b = 0,6
-        #r,t parameters according to Giovinazzi 2005 (t=8)
-        self.__r = self.__t * (0.007 * mu_d**3 - 0.0525 * mu_d**2 + 0.2875 * mu_d)
-        #convert r,t to alpha,beta
-        self.__alpha = self.__r
-        self.__beta = self.__t - self.__alpha
-
-        #return PDF (for one vulnerability class)
-        return self.__vectorialBeta(self.__alpha._mcpts,self.__beta._mcpts,self.__a,self.__b)
-
-    def __mean_damage_grade(self,I,V,Q=2.3):
-        '''
-        Returns damage grade for a given MMI distribution 'I' and vulnerability index distribution 'V' and ductility 'Q'(default: Q=2.3)
-        '''
-        return (2.5*(1+mcerp.umath.tanh((I+6.25*V-13.1)/Q)))
-
-    def __vectorialBeta(self,alpha, beta, low=0, high=1, tag=None):
-        """
-        Beta function adopted from mcerp expanded to arrays:
-        A Beta random variate
-
-        Parameters
-        ----------
-        alpha : vector
-            The first shape parameter
-        beta : scalar
-            The second shape parameter
-
-        Optional
-        --------
-        low : scalar
-            Lower bound of the distribution support (default=0)
-        high : scalar
-            Upper bound of the distribution support (default=1)
-        """
-
-        assert all(i>0 for i in alpha) and all(i>0 for i in beta), 'Beta "alpha" and "beta" parameters must be greater than zero'
-        assert low<high, 'Beta "low" must be less than "high"'
-        return mcerp.uv(scipy.stats.beta(alpha, beta, loc=low, scale=high-low), tag=tag)
+            self.__dg_pdf[vul_class] = mcerp.UncertainFunction(dg[index])
 
     def damage_bts(self):
         '''
@@ -24,6 +24,8 @@ import risk.exposure_module as exposure_module
 import risk.vulnerability_module as vulnerability_module
 import risk.loss_module as loss_module
 import caravan.settings.globals as glb
+import numpy as np
+import mcerp
 
 #FIRST thing: importing modules from upper packages seems to be a mess, at least debugging should be done from the upper parent folder
 #sharing both of them. After some try, as it was not the main goal of the simulation AND I NEEDED A DEBUGGER, 
@@ -36,9 +38,11 @@ import caravan.settings.globals as glb
 
 #gm: ground motion (mcerp distribution)
 #percentiles = an array of values usually [0.05 0.25 0.50 0.75 0.95]
-def calculaterisk(gm, percentiles, session_id, scenario_id, target_id, geocell_id):
+#db_conn = the database connection. If None, a new one is created
+def calculaterisk(gm, percentiles, session_id, scenario_id, target_id, geocell_id, db_conn=None):
     
-    db_conn = glb.connection() #FIXME: THIS CAN BE PASSED FROM THE MAIN METHOD?
+    if db_conn is None:
+        db_conn = glb.connection()
     
 
     # get exposure informations for the given location
@@ -57,6 +61,58 @@ def calculaterisk(gm, percentiles, session_id, scenario_id, target_id, geocell_i
     loss.calculate()
     loss.write2db(db_conn, percentiles)
     
+
+#gm: ground motion samples of N locations, as numpy matrix (N, npts) (a single column denotes scalars)
+#exp: the exposure arrays of the N locations (see exposure_module.toarrays)
+#analytic: if True, the damage state probabilities are calculated from the exact beta cdf of the damage grades (see 
+#vulnerability_module.damage_bts_cdf) instead of from damage grade samples. None: globals.risk_analytic
+#Returns the numpy matrix (N, npts) of fatalities samples
+def fatalities_many(gm, exp, nighttime=True, analytic=None):
+    
+    npts = gm.shape[1] if gm.shape[1] > 1 else mcerp.npts
+    nr_bdgs = loss_module.buildings_many(exp['bdg_dens_low'], exp['bdg_dens_high'], exp['area'], npts)
+    
+    if glb.risk_analytic if analytic is None else analytic:
+        #bt damage state probabilities (N x building types):
+        p = vulnerability_module.damage_bts_cdf(gm, exp['vul_shares'], (3.5, 4.5))
+        p35, p45 = p[:, :, 0], p[:, :, 1]
+        return loss_module.fatalities_cdf(p35, p45, nr_bdgs, exp['bt_freq'], exp['occ_low'], exp['occ_high'], nighttime)
+    
+    #Get damage grades (N x vul classes x npts) and bt damage (N x building types x npts):
+    dg = vulnerability_module.damage_grades(gm)
+    bt_dmg = vulnerability_module.damage_bts_many(dg, exp['vul_shares'])
+    
+    ###Calculate loss
+    return loss_module.fatalities_many(bt_dmg, nr_bdgs, exp['bt_freq'], exp['occ_low'], exp['occ_high'], nighttime)
+
+#Vectorized counterpart of calculaterisk for N locations:
+#gm: ground motion samples of N locations, as numpy matrix (N, npts) (a single column denotes scalars)
+#target_ids, geocell_ids: iterables of length N
+#exposure: the exposure arrays of the N locations (see exposure_module.select). If None, they are loaded from the database
+#writer: an optional dbutils.BatchWriter of risk.social_conseq (see loss_module.write_many). If None, results are written 
+#with a single statement
+#Returns a numpy boolean array of length N, True for the locations whose calculation failed. If writer is given, 
+#locations whose results were not yet written are not marked as failed: check writer.dropped after flushing
+def calculaterisk_many(gm, percentiles, session_id, scenario_id, target_ids, geocell_ids, db_conn=None, exposure=None, writer=None):
+    
+    if db_conn is None:
+        db_conn = glb.connection()
+    
+    # get exposure informations for the given locations
+    if exposure is None:
+        exposure = exposure_module.preload(db_conn, geocell_ids)
+        exposure = exposure_module.select(exposure, geocell_ids)
+    
+    failed = np.logical_not(exposure['valid'])
+    ok = exposure['valid']
+    if np.any(ok):
+        fat = fatalities_many(np.asarray(gm)[ok], {k: v[ok] for k, v in exposure.iteritems()})
+        dropped = loss_module.write_many(db_conn, fat, session_id, scenario_id, [t for t, o in zip(target_ids, ok) if o], 
+                                         [g for g, o in zip(geocell_ids, ok) if o], writer=writer)
+        dropped = set(row[3] for row in dropped) #target ids
+        failed |= np.array([t in dropped for t in target_ids], dtype=bool)
+    
+    return failed
     
 if __name__ == "__main__":
     import mcerp
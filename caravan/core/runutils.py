@@ -24,6 +24,7 @@ version. For more information, see http://www.gnu.org/
 """
 
 from threading import RLock
+from collections import Counter
 from array import array
 from scenario import Scenario
 import caravan.settings.globals as glb
@@ -39,6 +40,11 @@ class RunInfo(object):
         self.__errormsg = None #to be checked only if status > 1
         self.__process = None
         self.__session_id = None
+        self.__total = None #number of targets, if progress is tracked in memory (see setprocess and update)
+        self.__done_ok = 0
+        self.__done_failed = 0
+        self.__failures = Counter() #failed targets keyed by reason (see update)
+        self.__skipped = 0 #targets whose risk calculation was skipped (see update)
         
         if input_event is not None:
             self.start(input_event)
@@ -69,7 +75,12 @@ class RunInfo(object):
             return self
     
 
-    def setprocess(self, process, session_id):
+    def setprocess(self, process, session_id, total=None):
+        """
+            Sets the process (see workerpool) and the session id of the calculation. If total (the number of targets) 
+            is given, the progress is tracked in memory via the update method (to be called when 
+            targets are done). Otherwise, it is queried to the database at each call of progress()
+        """
         with self.__lock:
             
             st = self.status()
@@ -80,6 +91,7 @@ class RunInfo(object):
                     self.start() 
                 self.__process = process
                 self.__session_id = session_id
+                self.__total = total
                 
             return True
     
@@ -120,7 +132,8 @@ class RunInfo(object):
         with self.__lock:
             if self.status() < 2:
                 if self.__process is not None:
-                    self.__process.terminate()
+                    #cancel the tasks of our session only (the pool is shared across sessions, see workerpool):
+                    self.__process.cancel(self.__session_id)
                     if error is None:
                         error = "aborted by user"
                 if error:
@@ -132,6 +145,37 @@ class RunInfo(object):
                 self.__status = 2
                 
         
+    def update(self, done_ok, done_failed=0, failures=None, skipped=0):
+        """
+            Increments the number of targets succesfully calculated (done_ok) and failed (done_failed). 
+            failures is an optional dict of failed targets keyed by reason (e.g., the exception class name), 
+            reported in the final message (see progress). skipped is the number of targets (included in done_ok) 
+            whose risk calculation was skipped as their intensities are below the damage relevant level 
+            (see user_options.risk_cutoff_intensity), also reported in the final message. 
+            Meaningful only if the total number of targets has been passed to setprocess. 
+            Thread safe (can be called from within, e.g., callbacks of a process pool)
+        """
+        with self.__lock:
+            self.__done_ok += done_ok
+            self.__done_failed += done_failed
+            if failures:
+                self.__failures.update(failures)
+            self.__skipped += skipped
+    
+    def failures(self):
+        """
+            Returns a dict of the failed targets keyed by reason (see update)
+        """
+        with self.__lock:
+            return dict(self.__failures)
+    
+    def skipped(self):
+        """
+            Returns the number of targets whose risk calculation was skipped (see update)
+        """
+        with self.__lock:
+            return self.__skipped
+    
     def progress(self):
         """
             Returns the progress status of the calculation, from 0 to 100. A value
@@ -141,7 +185,10 @@ class RunInfo(object):
         """
         with self.__lock:
             status = self.status()
-            if status < 2: 
+            if status < 2 and self.__total is not None: 
+                #progress tracked in memory (see update):
+                return self.__progress(self.__done_ok, self.__done_failed, self.__total)
+            elif status < 2: 
                 
                 conn = glb.connection()
                 
@@ -150,36 +197,40 @@ class RunInfo(object):
                 UNION ALL (SELECT num_targets_failed from processing.sessions where gid=%s)\
                 UNION ALL (SELECT num_targets from processing.sessions where gid=%s)",(s_id,s_id,s_id,))
                 
-                total=1
-                done=0
-                failed = progrez[1][0]
-                
                 lp = len(progrez)
                 #PROGRES SHOULD BE SOMETHING LIKE: [(0L,), (5210L,), (5210L,)] (done_ok, done_failed, total)
                 total = progrez[2][0] if lp==3 else 1
                 done_ok = progrez[0][0] if lp==3 else 0
                 done_failed = progrez[1][0] if lp==3 else 0
                 
-                done = done_ok + done_failed
-                
                 conn.close()
-                if done >= total:
-                    if failed > total:
-                        self.stop("No target succesfully written (internal server error)")
-                    elif failed == total:
-                        self.stop("No target succesfully written")
-                    else:
-                        mzg = "{:d} of {:d} ground motion distributions succesfully calculated" .format(done_ok, total)
-                        if done_ok < total: self.warning(mzg)
-                        else: self.msg(mzg)
-                        
-                    self.__status = 2
-                    return 100.0
-                else:
-                    return (100.0 * done) / total  
-                
+                return self.__progress(done_ok, done_failed, total)
             else:
                 return 100.0 if status>=2 else 0.0
+    
+    def __progress(self, done_ok, done_failed, total):
+        #returns the progress from the given counters, setting the status to 2 if all targets are done
+        done = done_ok + done_failed
+        
+        if done >= total:
+            #failure reasons, if any (see update):
+            reasons = " (failures: {})".format(", ".join("{}: {:d}".format(k, v) for k, v in self.__failures.most_common())) \
+                if self.__failures else ""
+            if self.__skipped:
+                reasons += " ({:d} with no risk calculation: intensity below {})".format(self.__skipped, glb.risk_cutoff_intensity)
+            if done_failed > total:
+                self.stop("No target succesfully written (internal server error)")
+            elif done_failed == total:
+                self.stop("No target succesfully written" + reasons)
+            else:
+                mzg = "{:d} of {:d} ground motion distributions succesfully calculated" .format(done_ok, total) + reasons
+                if done_ok < total: self.warning(mzg)
+                else: self.msg(mzg)
+                
+            self.__status = 2
+            return 100.0
+        else:
+            return (100.0 * done) / total  
             
     def warning(self, *msgs):
         """
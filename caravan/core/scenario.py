@@ -29,6 +29,21 @@ from gmpes.gmpes import getgmpe
 import caravan.settings.globalkeys as gk
 import mcerp
 import caravan.parser as prs
+import psycopg2
+import time
+import warnings
+
+#whether to write scenarios with a single INSERT ... ON CONFLICT statement (see Scenario.writetodb and 
+#sql/002_scenarios_hash_unique.sql). Set to False, with a warning, at the first failure (e.g., postgres < 9.5)
+_UPSERT = True
+
+def latest_session(dbconn, scenario_id):
+    """
+        Returns the id (gid) of the latest (most recent) session of the given scenario, or None 
+        if the scenario has no session
+    """
+    sessions = dbconn.fetchall("SELECT gid FROM processing.sessions WHERE scenario_id=%s ORDER BY gid DESC LIMIT 1;", (scenario_id,))
+    return sessions[0][0] if sessions else None
 
 def hash(value):
     """
@@ -309,7 +324,24 @@ class Scenario(dict):
         """
         scenario_hash = self.dbhash()
         
-        scenarios = dbconn.fetchall("select * from processing.scenarios where hash=%s;" , (scenario_hash,))
+        dbkeys, dbvals = self.__dbitems(scenario_hash)
+        
+        global _UPSERT
+        if _UPSERT:
+            try:
+                return self.__upsert(dbconn, scenario_hash, dbkeys, dbvals)
+            except psycopg2.ProgrammingError as exc:
+                #no unique index on processing.scenarios.hash (see sql/002_scenarios_hash_unique.sql), or 
+                #postgres < 9.5 (no ON CONFLICT): use the select-insert path below from now on
+                if glb._DEBUG_:
+                    import traceback
+                    traceback.print_exc()
+                dbconn.rollback()
+                _UPSERT = False
+                warnings.warn("Scenario upsert disabled, scenarios are written with a (non atomic) select-insert. "
+                              "Apply sql/002_scenarios_hash_unique.sql to the database. Error: {}".format(str(exc).strip()))
+        
+        scenarios = dbconn.fetchall("select gid from processing.scenarios where hash=%s;" , (scenario_hash,))
 
         #the line above returns list objects. To return dict objects see
         #https://wiki.postgresql.org/wiki/Using_psycopg2_with_PostgreSQL
@@ -321,6 +353,19 @@ class Scenario(dict):
         elif len(scenarios) == 1:
             return scenarios[0][0], False
         
+        dbkeys_str = ','.join([k for k in dbkeys])
+        db_str = ",".join(["%s" for _ in dbkeys])
+
+        arg1 =  """INSERT INTO processing.scenarios ({0}) VALUES ({1}) RETURNING gid;""" .format (dbkeys_str, db_str) 
+        arg2 = tuple(dbvals)
+
+        scenarios = dbconn.fetchall(arg1, arg2)
+        dbconn.commit()
+        
+        return scenarios[0][0], True
+    
+    def __dbitems(self, scenario_hash):
+        #returns the tuple (column names, values) of this scenario to be written to database
         params = glb.params
     
         dbkeys = ['hash']
@@ -332,18 +377,28 @@ class Scenario(dict):
             if _scenario_name in p: #for safety, again
                 dbkeys.append(p[_scenario_name])
                 dbvals.append(self.__db[k])
-            
-        dbkeys_str = ','.join([k for k in dbkeys])
-        db_str = ",".join(["%s" for _ in dbkeys])
-
-        arg1 =  """INSERT INTO processing.scenarios ({0}) VALUES ({1});""" .format (dbkeys_str, db_str) 
-        arg2 = tuple(dbvals)
-
-        dbconn.execute(arg1, arg2)
-        dbconn.commit()
         
-        scenarios = dbconn.fetchall("select * from processing.scenarios where hash=%s;" , (scenario_hash,))
-        return scenarios[0][0], True
+        return dbkeys, dbvals
+    
+    def __upsert(self, dbconn, scenario_hash, dbkeys, dbvals):
+        #writes this scenario with a single statement (requires postgres 9.5+ and a unique index on 
+        #processing.scenarios.hash), returning the same as writetodb. 
+        #If the scenario is new, the insert returns its gid and the select returns nothing (a statement does not see 
+        #its own changes). If it exists, the insert returns nothing and the select returns its gid. 
+        #If it is being written by a concurrent transaction, both return nothing until the latter is committed: retry
+        arg1 = """WITH new AS (INSERT INTO processing.scenarios ({0}) VALUES ({1}) ON CONFLICT (hash) DO NOTHING RETURNING gid) 
+        SELECT gid, TRUE FROM new UNION ALL SELECT gid, FALSE FROM processing.scenarios WHERE hash=%s;""" \
+        .format(','.join(dbkeys), ",".join(["%s" for _ in dbkeys]))
+        arg2 = tuple(dbvals) + (scenario_hash,)
+        
+        for _ in xrange(10):
+            scenarios = dbconn.fetchall(arg1, arg2)
+            dbconn.commit()
+            if scenarios:
+                return scenarios[0][0], scenarios[0][1]
+            time.sleep(0.1)
+        
+        raise Exception("Unable to write scenario with hash={:d}: database error, please contact the administrator".format(scenario_hash))
         
         
 # if __name__ == '__main__':
@@ -0,0 +1,153 @@
+#! /usr/bin/python
+
+"""
+Module implementing an in-memory spatial index of the targets (exposure.targets) of a tessellation,
+so that the targets of an area of interest (circle, rectangle or polygon) are selected with no
+spatial query to the database. The targets geometry is static: an index is loaded once per process
+and tessellation (see get) and reloaded only if the version stamp of the tessellation targets changes
+(see version, which needs the migration sql/001_tessellations_targets_version.sql), so that back-to-back 
+simulations do not query the same geometries again
+
+Usage:
+    import caravan.core.spatialindex as spatialindex
+    index = spatialindex.get(conn, tess_id) #conn: dbutils.Connection
+    targets = index.within_distance(lat, lon, radius_km) #list of (target_id, geocell_id, lon, lat)
+
+(c) 2014, GFZ Potsdam
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+from threading import Lock
+import numpy as np
+from scipy.spatial import cKDTree
+from caravan.core.gmpes.gmpe_utils import EARTH_RADIUS
+
+def unit_vectors(lats, lons):
+    """
+        Returns the cartesian coordinates (numpy matrix of shape (N, 3)) of the points with the given
+        latitudes and longitudes (iterables of length N, in degrees) on the unit sphere
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+
+def inside_polygon(lons, lats, poly_lons, poly_lats):
+    """
+        Returns a boolean numpy array denoting which points (lons, lats) are inside the polygon of the given
+        vertices (poly_lons, poly_lats, with or without the closing vertex) with the even-odd rule
+        (points are treated as planar coordinates, as PostGIS does with geometries)
+    """
+    x, y = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    px, py = np.asarray(poly_lons, dtype=float), np.asarray(poly_lats, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    for x1, y1, x2, y2 in zip(px, py, np.roll(px, -1), np.roll(py, -1)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+class SpatialIndex(object):
+    """
+        Spatial index of the targets of a tessellation: holds the numpy arrays target_ids, geocell_ids, lons and lats,
+        and a KD-tree of the targets on the unit sphere. Targets with no geometry are not indexed, as no spatial query
+        would return them
+    """
+    def __init__(self, rows, version=None):
+        """
+            Creates a new SpatialIndex from the given rows (target_id, geocell_id, lon, lat) with the given version stamp
+        """
+        rows = [r for r in rows if r[2] is not None and r[3] is not None]
+        self.version = version
+        self.target_ids = np.array([r[0] for r in rows], dtype=object)
+        self.geocell_ids = np.array([r[1] for r in rows], dtype=object) #might be None (see core.caravan_run)
+        self.lons = np.array([r[2] for r in rows], dtype=float)
+        self.lats = np.array([r[3] for r in rows], dtype=float)
+        self.__tree = cKDTree(unit_vectors(self.lats, self.lons)) if rows else None
+
+    def __len__(self):
+        return len(self.lons)
+
+    def rows(self, indices):
+        """
+            Returns the list of tuples (target_id, geocell_id, lon, lat) of the targets at the given indices,
+            i.e. in the same format of the database query of core.caravan_run
+        """
+        return [(self.target_ids[i], self.geocell_ids[i], float(self.lons[i]), float(self.lats[i])) for i in indices]
+
+    def __within(self, lat, lon, radius_km):
+        #returns the sorted indices of the targets within radius_km from (lat, lon)
+        if self.__tree is None:
+            return np.array([], dtype=int)
+        #great circle distance (on the sphere of radius EARTH_RADIUS) to chord on the unit sphere:
+        chord = 2 * np.sin(min(np.pi, radius_km / EARTH_RADIUS) / 2)
+        return np.sort(np.asarray(self.__tree.query_ball_point(unit_vectors([lat], [lon])[0], chord), dtype=int))
+
+    def within_distance(self, lat, lon, radius_km):
+        """
+            Returns the targets (see rows) within radius_km Km (great circle distance) from the point (lat, lon)
+        """
+        return self.rows(self.__within(lat, lon, radius_km))
+
+    def within_box(self, lon1, lat1, lon2, lat2):
+        """
+            Returns the targets (see rows) within the rectangle of the given corners, in degrees
+        """
+        mask = (self.lons >= min(lon1, lon2)) & (self.lons <= max(lon1, lon2)) & \
+            (self.lats >= min(lat1, lat2)) & (self.lats <= max(lat1, lat2))
+        return self.rows(np.flatnonzero(mask))
+
+    def within_polygon(self, poly_lons, poly_lats, lat=None, lon=None, radius_km=None):
+        """
+            Returns the targets (see rows) within the polygon of the given vertices, in degrees. If lat, lon and
+            radius_km are given, they denote a circle enclosing the polygon, used to speed up the search
+        """
+        if radius_km is None:
+            indices = np.arange(len(self))
+        else:
+            indices = self.__within(lat, lon, radius_km)
+        mask = inside_polygon(self.lons[indices], self.lats[indices], poly_lons, poly_lats)
+        return self.rows(indices[mask])
+
+_INDEXES = {} #tess_id -> SpatialIndex
+_LOCK = Lock()
+
+def version(conn, tess_id):
+    """
+        Returns the version stamp of the targets of the given tessellation, i.e. the column targets_version of 
+        exposure.tessellations, incremented by a trigger on any insert, update or delete of exposure.targets 
+        (see sql/001_tessellations_targets_version.sql). A change of the stamp invalidates the index loaded in memory. 
+        The stamp is read from a single row (primary key lookup), with no scan of the targets
+    """
+    rows = conn.fetchall("SELECT targets_version FROM exposure.tessellations WHERE gid=%s;", (tess_id,))
+    return rows[0][0] if rows else None
+
+def get(conn, tess_id):
+    """
+        Returns the SpatialIndex of the targets of the given tessellation, loading it from the database
+        (via the given dbutils.Connection) the first time or if its version stamp changed (see version)
+    """
+    stamp = version(conn, tess_id)
+    with _LOCK:
+        index = _INDEXES.get(tess_id, None)
+        if index is not None and index.version == stamp:
+            return index
+    rows = conn.fetchall("""SELECT t.gid, t.geocell_id, st_X(t.the_geom), st_Y(t.the_geom)
+    FROM exposure.targets as t WHERE t.tess_id=%s;""", (tess_id,))
+    index = SpatialIndex(rows, stamp)
+    with _LOCK:
+        _INDEXES[tess_id] = index
+    return index
+
+def clear():
+    """
+        Removes all spatial indices from memory
+    """
+    with _LOCK:
+        _INDEXES.clear()
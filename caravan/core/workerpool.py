@@ -0,0 +1,227 @@
+#! /usr/bin/python
+
+"""
+Module implementing a WorkerPool, a long-lived and bounded pool of worker processes shared
+across simulations (sessions). Creating a new multiprocessing.Pool for each simulation means
+forking and importing numpy, scipy, mcerp and psycopg2 in each worker every time, which is
+expensive when simulations are launched back-to-back (e.g., quakelink.py)
+
+Tasks are submitted tagged with a session id and are kept in a per-session queue in the calling
+process. A dispatcher thread forwards them to the underlying multiprocessing.Pool picking the
+sessions in round robin fashion, so that concurrent sessions are scheduled fairly, and keeps
+at most max_pending tasks in the pool, so that a session can be canceled (see cancel) without
+terminating the pool (and thus the tasks of the other sessions). Tasks of a canceled session already
+forwarded to the pool are notified via a flag shared with the worker processes, which long tasks
+should check periodically (see cancelled)
+
+Usage:
+    import caravan.core.workerpool as workerpool
+    pool = workerpool.get() #the application pool, created once
+    pool.submit(session_id, func, args, callback) #func must be pickable (e.g., a module-level function)
+    ...
+    pool.cancel(session_id)
+    #from within func (worker process), e.g. between batches:
+    if workerpool.cancelled(session_id): return
+
+(c) 2014, GFZ Potsdam
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import os
+import atexit
+import cPickle
+import multiprocessing
+from threading import Condition, Thread, Lock
+from collections import OrderedDict, deque
+import caravan.settings.globals as glb
+
+_DEBUG_ = glb._DEBUG_
+
+#number of the most recently canceled sessions visible to the worker processes (see cancelled):
+_CANCELLED_SIZE = 64
+#the session ids of the canceled sessions (multiprocessing.Array shared with the pool), set in each worker process:
+_cancelled = None
+
+def _init(cancelled):
+    #initializer of the worker processes (see WorkerPool)
+    global _cancelled
+    _cancelled = cancelled
+
+def cancelled(session_id):
+    """
+        Returns True if the given session has been canceled (see WorkerPool.cancel). To be called from within 
+        a worker process, e.g. between batches of a long task, to stop it early: canceling a session removes 
+        its queued tasks only, the tasks already forwarded to the processes run until they check this function. 
+        Returns False if called outside a worker process
+    """
+    if _cancelled is None:
+        return False
+    with _cancelled.get_lock():
+        return session_id in _cancelled[:]
+
+def _call(task):
+    """
+        Runs func(*args) from within a worker process, where task is the tuple (func, args) pickled
+        (see WorkerPool). Returns the tuple (result, None) or (None, error_message) if func raised.
+        Python2 apply_async has no error callback: wrapping the function assures that any task notifies
+        its completion
+    """
+    try:
+        func, args = cPickle.loads(task)
+        return func(*args), None
+    except Exception as exc:
+        if _DEBUG_:
+            import traceback
+            traceback.print_exc()
+        return None, str(exc)
+
+class WorkerPool(object):
+
+    def __init__(self, processes=None, max_pending=None):
+        """
+            Creates a new WorkerPool. The underlying processes are created when the first
+            task is submitted
+
+            :param processes: the number of processes. None or non-positive: multiprocessing.cpu_count()
+            :param max_pending: the maximum number of tasks forwarded to the processes (running or queued
+            in the underlying multiprocessing.Pool) at any time. None or non-positive: twice the number of processes
+        """
+        self.processes = processes if processes and processes > 0 else multiprocessing.cpu_count()
+        self.max_pending = max_pending if max_pending and max_pending > 0 else 2 * self.processes
+        self.__cond = Condition()
+        self.__queues = OrderedDict() #session_id -> deque of (func, args, callback)
+        self.__pending = 0
+        self.__pool = None
+        self.__thread = None
+        self.__pid = None
+        self.__cancelled = None #session ids of the canceled sessions, shared with the processes (see cancelled)
+        self.__cancelled_index = 0
+
+    def submit(self, session_id, func, args, callback=None):
+        """
+            Submits the task func(*args) tagged with the given session id. func and args must be
+            pickable. callback, if not None, is a function called in the calling process with the tuple
+            (result, error_message) as argument when the task is completed (see _call). Callbacks
+            are called from a separate thread and should return quickly
+        """
+        with self.__cond:
+            self.__start()
+            if session_id not in self.__queues:
+                self.__queues[session_id] = deque()
+            self.__queues[session_id].append((func, args, callback))
+            self.__cond.notify_all()
+
+    def cancel(self, session_id):
+        """
+            Cancels the tasks of the given session which are not yet forwarded to the worker
+            processes. Tasks already forwarded (at most max_pending) are notified, and stop as soon
+            as they check the module function cancelled (otherwise, they are completed).
+            Returns the number of tasks canceled before being forwarded
+        """
+        with self.__cond:
+            if self.__cancelled is not None:
+                with self.__cancelled.get_lock():
+                    self.__cancelled[self.__cancelled_index] = session_id
+                self.__cancelled_index = (self.__cancelled_index + 1) % _CANCELLED_SIZE
+            queue = self.__queues.pop(session_id, None)
+            return 0 if queue is None else len(queue)
+
+    def queued(self, session_id):
+        """
+            Returns the number of tasks of the given session not yet forwarded to the worker processes
+        """
+        with self.__cond:
+            queue = self.__queues.get(session_id, None)
+            return 0 if queue is None else len(queue)
+
+    def close(self):
+        """
+            Cancels all queued tasks, terminates the worker processes and the dispatcher thread.
+            The pool can be reused: a new pool of processes will be created at the next submit
+        """
+        with self.__cond:
+            self.__queues.clear()
+            pool = self.__pool
+            self.__pool = None
+            self.__thread = None
+            self.__pending = 0
+            self.__cond.notify_all()
+        if pool is not None and self.__pid == os.getpid():
+            pool.terminate()
+            pool.join()
+
+    def __start(self):
+        #creates the multiprocessing.Pool and the dispatcher thread, if needed.
+        #If this object was inherited from a parent process (fork), processes and thread are not usable:
+        #recreate them
+        if self.__pool is None or self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__pending = 0
+            self.__cancelled = multiprocessing.Array('l', _CANCELLED_SIZE) #zeros (no session id)
+            self.__cancelled_index = 0
+            self.__pool = multiprocessing.Pool(self.processes, _init, (self.__cancelled,))
+            self.__thread = Thread(target=self.__dispatch, args=(self.__pool,))
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __next(self):
+        #returns the next task in round robin fashion (the first session in queue, which is then moved at the end)
+        session_id, queue = self.__queues.popitem(last=False)
+        task = queue.popleft()
+        if queue:
+            self.__queues[session_id] = queue
+        return task
+
+    def __dispatch(self, pool):
+        while True:
+            with self.__cond:
+                while pool is self.__pool and (not self.__queues or self.__pending >= self.max_pending):
+                    self.__cond.wait()
+                if pool is not self.__pool: #closed
+                    return
+                func, args, callback = self.__next()
+                self.__pending += 1
+            done = self.__done(pool, callback)
+            try:
+                #pickle here: Python2 pickles the arguments in a separate thread of the pool, where errors are 
+                #silently discarded and the task never completes:
+                pool.apply_async(_call, (cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL),), callback=done)
+            except Exception as exc: #e.g., arguments not pickable, pool closed
+                if _DEBUG_:
+                    import traceback
+                    traceback.print_exc()
+                done((None, str(exc) or type(exc).__name__))
+
+    def __done(self, pool, callback):
+        def done(ret):
+            with self.__cond:
+                if pool is self.__pool:
+                    self.__pending -= 1
+                    self.__cond.notify_all()
+            if callback is not None:
+                try:
+                    callback(ret)
+                except Exception:
+                    if _DEBUG_:
+                        import traceback
+                        traceback.print_exc()
+        return done
+
+_POOL = None
+_POOL_LOCK = Lock()
+
+def get():
+    """
+        Returns the application WorkerPool (see user_options.pool_processes), creating it the first time
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = WorkerPool(glb.pool_processes)
+            atexit.register(_POOL.close)
+        return _POOL
@@ -3,9 +3,12 @@
 """
      Utilities for connecting with the Caravan database. It implements the Connection class
      which wraps a psycopg2 connection with some utilities like:
-     execute, fetchall, close, commit, cursor
+     execute, fetchall, iterate, close, commit, cursor (optionally as prepared statements, see Statements)
      plus async support so that the user does not have to care about issues 
      (auto waits between two dbase operations, commits only in non async mode)
+     It implements also the ConnectionPool class, a per-process pool of connections
+     (see getpool), and the AsyncConnection class, a non blocking connection for event loops 
+     (asyncio/trollius)
      
 (c) 2014, GFZ Potsdam
 
@@ -24,6 +27,13 @@ __date__ ="$Oct 5, 2014 8:00:00 PM$"
 import psycopg2
 from psycopg2 import Error 
 import select
+import os
+import time
+import itertools
+import re
+import weakref
+from collections import OrderedDict
+from threading import Lock
 import socket #used to retreive if we are runnign on makalu, see below
 # via socket.gethostname()
 
@@ -76,7 +86,7 @@ def connect(host=HOST, port=PORT, dbname=DBNAME, user=USER,  password=PSWD, asyn
         wait(aconn)
     return aconn
 
-def cursor(connection, operation, parameters=None):
+def cursor(connection, operation, parameters=None, prepare=False):
     """
         Shorthand for
             c = connection.cursor()
@@ -87,24 +97,36 @@ def cursor(connection, operation, parameters=None):
         calling the wait function, and blocks
         until the cursor isn't available. For more info, see
         http://initd.org/psycopg/docs/advanced.html#asynchronous-support
+        
+        If prepare is True, operation is executed as named prepared statement (see Statements), so that 
+        PostgreSQL parses and plans it once per connection. Use it for statements executed many times
     """
+    if prepare:
+        registry = statements(connection)
+        try:
+            return cursor(connection, registry.execute_operation(operation, parameters), parameters)
+        except Exception:
+            registry.forget(operation)
+            raise
+    
     #from http://initd.org/psycopg/docs/faq.html#best-practices
     #Cursors are lightweight objects and creating lots of them should not pose any kind of problem. 
     #But note that cursors used to fetch result sets will cache the data and use memory in proportion to the result set size. 
     #Our suggestion is to almost always create a new cursor and dispose old ones as soon as the data is not required anymore (call close() on them.) 
     #The only exception are tight loops where one usually use the same cursor for a whole bunch of INSERTs or UPDATEs.
-    cursor = connection.cursor()
-    if parameters is None:  cursor.execute(operation)
-    else: cursor.execute(operation, parameters)
+    #(note: the cursor variable is named c, as cursor would hide this function, called recursively above)
+    c = connection.cursor()
+    if parameters is None:  c.execute(operation)
+    else: c.execute(operation, parameters)
         
-    if cursor.connection.async: #see http://initd.org/psycopg/docs/connection.html#connection.async
+    if c.connection.async: #see http://initd.org/psycopg/docs/connection.html#connection.async
         if _DEBUG_:
             print("waiting (async=1)")
-        wait(cursor.connection)
+        wait(c.connection)
     
-    return cursor
+    return c
 
-def execute(connection, operation, parameters=None):
+def execute(connection, operation, parameters=None, prepare=False):
     """
         Shorthand for
             c = connection.cursor()
@@ -117,9 +139,9 @@ def execute(connection, operation, parameters=None):
         until the cursor isn't available. For more info, see
         http://initd.org/psycopg/docs/advanced.html#asynchronous-support
     """
-    cursor(connection, operation, parameters).close()
+    cursor(connection, operation, parameters, prepare).close()
 
-def fetchall(connection, operation, parameters=None):
+def fetchall(connection, operation, parameters=None, prepare=False):
     """
         Shorthand for
             c = connection.cursor()
@@ -134,10 +156,146 @@ def fetchall(connection, operation, parameters=None):
         until the cursor isn't available. For more info, see
         http://initd.org/psycopg/docs/advanced.html#asynchronous-support
     """
-    c = cursor(connection, operation, parameters)
+    c = cursor(connection, operation, parameters, prepare)
     ret = c.fetchall()
     c.close()
     return ret
+
+_PLACEHOLDER = re.compile(r"%[%s]")
+
+class Statements(object):
+    """
+        Registry of the named prepared statements of a psycopg connection (see statements). 
+        Prepared statements live as long as the server session, so the registry is bound to the psycopg 
+        connection and not to the Connection wrapping it: pooled connections keep their statements across 
+        checkouts (see ConnectionPool). 
+        The attributes hits and misses count the executions of already prepared and newly prepared statements, 
+        respectively. A statement is not prepared (and counted as miss) if parameters is a dict (named arguments 
+        are not supported). At most max_size statements are kept: when a new statement is prepared, the least 
+        recently used one is deallocated (in the same command)
+    """
+    max_size = 100
+    
+    def __init__(self):
+        self.names = OrderedDict() #operation -> statement name, from the least to the most recently used
+        self.hits = 0
+        self.misses = 0
+        self.__ids = itertools.count()
+    
+    def execute_operation(self, operation, parameters=None):
+        """
+            Returns the operation executing the prepared statement of operation, to be executed with the same 
+            parameters. If the statement is not yet prepared, the returned operation prepares it first 
+            (in the same command, thus with no additional round trip to the server)
+        """
+        name = self.names.pop(operation, None)
+        if name is not None:
+            self.names[operation] = name #(re-inserted as most recently used)
+            self.hits += 1
+            _STATS['hits'] += 1
+            return self.__execute(name, parameters)
+        
+        self.misses += 1
+        _STATS['misses'] += 1
+        if isinstance(parameters, dict):
+            return operation
+        deallocate = ""
+        while len(self.names) >= self.max_size:
+            deallocate += "DEALLOCATE " + self.names.popitem(last=False)[1] + "; "
+        #a new name each time: if the command below fails, PREPARE might have been executed anyway
+        name = "caravan_stmt_{:d}".format(next(self.__ids))
+        if parameters is None: #operation is not bound to parameters (see cursor), leave it as it is
+            prepare = operation
+        else:
+            idx = itertools.count(1)
+            prepare = _PLACEHOLDER.sub(lambda m: "%" if m.group() == "%%" else "$%d" % next(idx), operation)
+            #the prepare command is bound to parameters, thus literal "%" must be escaped:
+            prepare = prepare.replace("%", "%%")
+        command = deallocate + "PREPARE " + name + " AS " + prepare + "; " + self.__execute(name, parameters)
+        self.names[operation] = name
+        return command
+    
+    def __execute(self, name, parameters):
+        if not parameters:
+            return "EXECUTE " + name
+        return "EXECUTE " + name + " (" + ", ".join(["%s"] * len(parameters)) + ")"
+
+    def forget(self, operation):
+        """
+            Removes operation from this registry (e.g., after its PREPARE failed)
+        """
+        self.names.pop(operation, None)
+
+_STATEMENTS = weakref.WeakKeyDictionary() #psycopg connection -> Statements
+_STATS = {'hits': 0, 'misses': 0}
+
+def statements(connection):
+    """
+        Returns the Statements (registry of prepared statements) of the given psycopg connection
+    """
+    ret = _STATEMENTS.get(connection, None)
+    if ret is None:
+        ret = _STATEMENTS[connection] = Statements()
+    return ret
+
+def prepared_stats():
+    """
+        Returns the tuple (hits, misses) of all prepared statements executed in the current process 
+        (see Statements)
+    """
+    return _STATS['hits'], _STATS['misses']
+
+_CURSOR_IDS = itertools.count()
+
+def iterate(connection, operation, parameters=None, batch_size=1000):
+    """
+        Returns a generator yielding the rows of the given query operation, fetched batch_size rows at a time 
+        via a server side cursor, so that large result sets are never loaded in memory at once:
+            for row in iterate(connection, "SELECT ...", (...)):
+                ...
+        Synchronous connections use psycopg named cursors. Named cursors are not supported in async mode, 
+        where the same is achieved by executing DECLARE and FETCH within a transaction block (async connections 
+        are in autocommit mode), waiting after each operation as the other functions of this module do. 
+        For more info, see http://initd.org/psycopg/docs/usage.html#server-side-cursors
+        
+        The server side cursor is closed (and, in async mode, the transaction block ended) when the generator 
+        is exhausted or closed (e.g., garbage collected after a break). Until then, the connection should not be 
+        used for other operations
+    """
+    name = "caravan_cursor_{:d}_{:d}".format(os.getpid(), next(_CURSOR_IDS))
+    if not connection.async:
+        c = connection.cursor(name)
+        c.itersize = batch_size
+        try:
+            if parameters is None: c.execute(operation)
+            else: c.execute(operation, parameters)
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+        return
+    
+    c = connection.cursor()
+    query = c.mogrify(operation, parameters)
+    c.close()
+    execute(connection, "BEGIN; DECLARE " + name + " NO SCROLL CURSOR FOR " + query)
+    ok = False
+    try:
+        fetch = "FETCH FORWARD {:d} FROM {}".format(batch_size, name)
+        while True:
+            rows = fetchall(connection, fetch)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        ok = True
+    finally:
+        if not connection.closed:
+            execute(connection, ("CLOSE " + name + "; COMMIT") if ok else "ROLLBACK")
     
 class Connection(object):
     """
@@ -149,6 +307,8 @@ class Connection(object):
             Connection.execute(operation [,parameters])) 
         and the execution and return of query commands (e.g., select): 
             v = Connection.fetchall(operation [,parameters])
+        or its streaming counterpart, for large result sets: 
+            for row in Connection.iterate(operation [,parameters]): ...
         Plus close() and commit() methods which delegate the relative connection methods
         
         All methods (excluding close) take also care of potential asynchronous connections, waiting (e.g. fetchall) 
@@ -165,24 +325,60 @@ class Connection(object):
 #        self.dbname = dbname
 #        self.user = user
         self.conn = connect(host=host, port=port, dbname=dbname, user=user,  password=password, async=async)
+        self._iterators = weakref.WeakSet() #live generators returned by iterate (see close)
         
-    def cursor(self, operation, parameters=None):
+    def cursor(self, operation, parameters=None, prepare=False):
         """
             See module level cursor function
         """
-        return cursor(self.conn, operation, parameters)
+        return cursor(self.conn, operation, parameters, prepare)
     
-    def execute(self, operation, parameters=None):
+    def execute(self, operation, parameters=None, prepare=False):
         """
-            See module level cursor function
+            See module level execute function
         """
-        return execute(self.conn, operation, parameters)
+        return execute(self.conn, operation, parameters, prepare)
     
-    def fetchall(self, operation, parameters=None):
+    def fetchall(self, operation, parameters=None, prepare=False):
         """
-            See module level cursor function
+            See module level fetchall function
+        """
+        return fetchall(self.conn, operation, parameters, prepare)
+    
+    @property
+    def statements(self):
+        """
+            Returns the registry of prepared statements of this connection (see Statements)
+        """
+        return statements(self.conn)
+    
+    def iterate(self, operation, parameters=None, batch_size=1000):
         """
-        return fetchall(self.conn, operation, parameters)
+            See module level iterate function. The returned generator is closed, if still alive, when this 
+            connection is closed
+        """
+        rows = iterate(self.conn, operation, parameters, batch_size)
+        self._iterators.add(rows)
+        return rows
+    
+    def _close_iterators(self):
+        #closes the live generators returned by iterate (ending their server side cursor and, in async mode, 
+        #their transaction block)
+        for rows in list(getattr(self, '_iterators', ())):
+            try:
+                rows.close()
+            except (Error, ValueError): #ValueError: generator already executing
+                pass
+    
+    def mogrify(self, operation, parameters=None):
+        """
+            Returns the query string after arguments binding (see psycopg cursor.mogrify)
+        """
+        c = self.conn.cursor()
+        try:
+            return c.mogrify(operation, parameters)
+        finally:
+            c.close()
     
     @property
     def closed(self):
@@ -193,6 +389,7 @@ class Connection(object):
             Closes the underlying psycopg connection. Does nothing if the connection is already closed
         """
         if not self.closed:
+            self._close_iterators()
             self.conn.close()
     
     def commit(self):
@@ -201,7 +398,421 @@ class Connection(object):
         """
         if not self.conn.async:
             self.conn.commit()
+    
+    def rollback(self):
+        """
+            Rolls back the underlying connection. Does nothing and returns silently if the latter is in async mode
+        """
+        if not self.conn.async:
+            self.conn.rollback()
             
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
     def __del__(self):
         self.close()
+
+class PooledConnection(Connection):
+    """
+        A Connection handed out by a ConnectionPool: close() (called also when exiting a with statement 
+        or when this object is garbage collected) does not close the underlying psycopg connection 
+        but returns it to the pool
+    """
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self._iterators = weakref.WeakSet()
+    
+    @property
+    def closed(self):
+        return self.pool is None or self.conn.closed != 0
+    
+    def close(self):
+        """
+            Returns the underlying psycopg connection to the pool, after closing the live generators returned 
+            by iterate. Does nothing if the connection is already closed (returned)
+        """
+        if self.pool is not None:
+            self._close_iterators()
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.putconn(self.conn)
+
+class BatchWriter(object):
+    """
+        Buffered writer of rows into a database table. Rows are accumulated and written with a single 
+        multi-row INSERT (INSERT INTO table (columns) VALUES (...), (...), ...) every batch_size rows or, 
+        if interval is a positive number, when interval seconds have passed since the last write. 
+        COPY FROM STDIN is not supported by asynchronous connections, and multi-row INSERTs perform similarly 
+        for the batch sizes we use. Usage:
+            with BatchWriter(conn, 'processing.ground_motion', ('target_id', ...)) as writer:
+                writer.add((1, ...))
+                ...
+            #here all rows are written (flush is called when exiting the with statement)
+        
+        Errors when writing are not raised: the rows of a failed write are appended to the dropped attribute 
+        (list) instead, so that the caller can account for them. 
+        If autoflush is False, rows are written only when calling flush() explicitly: use due() to check if 
+        a write is due according to batch_size and interval (e.g., to synchronize writes into several tables). 
+        If prepare is True, INSERTs of batch_size rows are executed as prepared statement (see Statements). 
+        Writes of a different number of rows (e.g., the last flush) are not prepared, as each number of rows 
+        would need its own statement
+    """
+    def __init__(self, conn, table, columns, batch_size=500, interval=None, autoflush=True, prepare=False):
+        self.conn = conn
+        self.table = table
+        self.columns = tuple(columns)
+        self.batch_size = max(1, batch_size or 1)
+        self.interval = interval
+        self.autoflush = autoflush
+        self.prepare = prepare
+        self.rows = []
+        self.dropped = []
+        self.written = 0
+        self.__last_flush = time.time()
+        self.__insert = "INSERT INTO {0} ({1}) VALUES ".format(table, ", ".join(self.columns))
+        self.__values = "(" + ", ".join(["%s"] * len(self.columns)) + ")"
+    
+    def add(self, row):
+        """
+            Adds a row (tuple of values, one per column) to be written, and writes all rows if needed
+        """
+        self.rows.append(row)
+        if self.autoflush and self.due():
+            self.flush()
+    
+    def due(self):
+        """
+            Returns True if a write is due, i.e. if batch_size rows are not yet written or interval 
+            seconds have passed since the last write
+        """
+        return len(self.rows) >= self.batch_size or \
+            (self.interval and self.interval > 0 and time.time() - self.__last_flush >= self.interval)
     
+    def flush(self):
+        """
+            Writes all rows added and not yet written. Returns the number of rows written
+        """
+        rows, self.rows = self.rows, []
+        self.__last_flush = time.time()
+        if not rows:
+            return 0
+        #chunks of batch_size rows are written with the same prepared statement, the remaining rows are not prepared:
+        size = self.batch_size if self.prepare else len(rows)
+        written = 0
+        for i in xrange(0, len(rows), size):
+            chunk = rows[i:i+size]
+            try:
+                if len(chunk) == size and self.prepare:
+                    self.conn.execute(self.__insert + ", ".join([self.__values] * size), 
+                                      [v for row in chunk for v in row], prepare=True)
+                else:
+                    self.conn.execute(self.__insert + ", ".join(self.conn.mogrify(self.__values, row) for row in chunk))
+                written += len(chunk)
+            except Exception:
+                if _DEBUG_:
+                    import traceback
+                    traceback.print_exc()
+                self.dropped.extend(chunk)
+        self.written += written
+        return written
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+#psycopg connections inherited from a parent process (see ConnectionPool): we must not close them nor let 
+#them be garbage collected, as that would terminate the parent connections on the server side:
+_ORPHANS = []
+
+class ConnectionPool(object):
+    """
+        A pool of psycopg connections of the current process. Usage:
+            pool = ConnectionPool(host=...)
+            with pool.connection() as conn:
+                conn.fetchall(...) #conn is a PooledConnection
+        or:
+            conn = pool.connection()
+            ...
+            conn.close() #returns the connection to the pool
+        
+        The pool opens minconn connections at creation, and keeps at most maxconn idle connections: 
+        when all connections are in use, new connections are opened anyway, and closed when returned 
+        if maxconn idle connections are already in the pool. Connections idle for more than check_after 
+        seconds are checked (executing a simple query) before being handed out, and replaced if broken. 
+        The pool is fork safe: in a child process (e.g., multiprocessing workers) the connections of the parent 
+        are discarded (and never closed) and new ones are opened
+    """
+    def __init__(self, minconn=0, maxconn=10, check_after=30, host=HOST, port=PORT, dbname=DBNAME, user=USER,  password=PSWD, async=ASYNC):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.check_after = check_after
+        self.__args = dict(host=host, port=port, dbname=dbname, user=user,  password=password, async=async)
+        self.__lock = Lock()
+        self.__idle = [] #list of (psycopg connection, last use time)
+        self.__pid = os.getpid()
+        self.__fill()
+        
+    def __fill(self):
+        for _ in xrange(self.minconn - len(self.__idle)):
+            self.__idle.append((connect(**self.__args), time.time()))
+    
+    def __checkpid(self):
+        #If we are in a forked process, discard parent connections. Must be called outside self.__lock: if another 
+        #thread of the parent held the lock when forking, the lock is inherited locked and would block forever here. 
+        #Thus it is replaced with a new lock (the child process has a single thread, nothing else can use it)
+        if self.__pid != os.getpid():
+            self.__lock = Lock()
+            with self.__lock:
+                _ORPHANS.extend(c for c, _ in self.__idle)
+                self.__idle = []
+                self.__pid = os.getpid()
+            return True
+        return False
+    
+    def __healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used <= self.check_after:
+            return True
+        try:
+            fetchall(conn, "SELECT 1")
+            return True
+        except Error:
+            return False
+    
+    def getconn(self):
+        """
+            Returns a psycopg connection from the pool (opening a new one, if needed). 
+            Consider using connection() instead. The returned connection must be returned to the pool via putconn
+        """
+        if self.__checkpid():
+            with self.__lock:
+                self.__fill()
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn, last_used = self.__idle.pop()
+            if self.__healthy(conn, last_used):
+                return conn
+            self.__discard(conn)
+        return connect(**self.__args)
+    
+    def putconn(self, conn):
+        """
+            Returns the given psycopg connection (obtained via getconn) to the pool
+        """
+        if self.__pid != os.getpid(): #connection from a parent process (checked before taking the lock, see __checkpid)
+            _ORPHANS.append(conn)
+            return
+        reusable = not conn.closed
+        if reusable and conn.get_transaction_status() in (psycopg2.extensions.TRANSACTION_STATUS_INTRANS, 
+                                                          psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+            try: #in transaction (e.g., uncommitted, after an error or within an iterate not exhausted): reset the connection.
+                #Async connections are in autocommit mode, their transaction blocks are explicit (see iterate):
+                if conn.async:
+                    execute(conn, "ROLLBACK")
+                else:
+                    conn.rollback()
+            except Error:
+                reusable = False
+        #command in progress, unknown status or failed reset: the connection cannot be reused:
+        reusable = reusable and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        with self.__lock:
+            if reusable and len(self.__idle) < self.maxconn:
+                self.__idle.append((conn, time.time()))
+                return
+        self.__discard(conn)
+    
+    def __discard(self, conn):
+        try:
+            conn.close()
+        except Error:
+            pass
+    
+    def connection(self):
+        """
+            Returns a PooledConnection, whose close() method returns the connection to this pool. 
+            The returned object can be used in a with statement
+        """
+        return PooledConnection(self, self.getconn())
+    
+    def closeall(self):
+        """
+            Closes all idle connections of the pool
+        """
+        self.__checkpid() #in a forked process, parent connections are discarded and not closed
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn, _ in idle:
+            self.__discard(conn)
+
+_POOLS = {}
+_POOLS_LOCK = Lock()
+_POOLS_PID = os.getpid() #the process of _POOLS_LOCK (see getpool)
+
+def getpool(minconn=0, maxconn=10, check_after=30, host=HOST, port=PORT, dbname=DBNAME, user=USER,  password=PSWD, async=ASYNC):
+    """
+        Returns the ConnectionPool of the given connection arguments, creating it the first time. 
+        minconn, maxconn and check_after are used only when the pool is created (see ConnectionPool)
+    """
+    global _POOLS_LOCK, _POOLS_PID
+    if _POOLS_PID != os.getpid():
+        #forked process: the lock might have been inherited locked (see ConnectionPool.__checkpid)
+        _POOLS_LOCK, _POOLS_PID = Lock(), os.getpid()
+    key = (host, port, dbname, user, password, bool(async))
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(minconn, maxconn, check_after, host=host, port=port, dbname=dbname, 
+                                         user=user, password=password, async=async)
+        return _POOLS[key]
+    
+
+def _future(loop):
+    #returns a new future bound to the given event loop: asyncio loops (Python 3.5.2+) have create_future, 
+    #for older asyncio versions or trollius (the asyncio backport for Python 2) use their Future class
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio.Future(loop=loop)
+
+def _poll(loop, conn, future, callback):
+    """
+        Non blocking counterpart of wait: polls the asynchronous psycopg connection conn and, if the 
+        latter is not ready, registers itself in the event loop to be called again as soon as the 
+        connection socket is readable or writable (depending on what psycopg asks for). When the connection 
+        is ready, sets the result of callback() (or its exception) as future result
+    """
+    fd = conn.fileno() if not conn.closed else None
+    if fd is not None:
+        loop.remove_reader(fd)
+        loop.remove_writer(fd)
+    if future.done(): #e.g., cancelled
+        return
+    try:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            future.set_result(callback())
+        elif state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, _poll, loop, conn, future, callback)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, _poll, loop, conn, future, callback)
+        else:
+            raise psycopg2.OperationalError("poll() returned %s" % state)
+    except Exception as exc:
+        future.set_exception(exc)
+
+class AsyncConnection(object):
+    """
+        Non blocking counterpart of Connection, for applications running an event loop (asyncio, 
+        or trollius in Python 2): instead of waiting on the connection socket (see wait), the 
+        methods below register the socket in the loop (via loop.add_reader / loop.add_writer) and 
+        return a future of the loop, so that many database operations (on different connections) 
+        can run concurrently in one thread. Usage (Python 3):
+            conn = await AsyncConnection.connect(loop, host=...)
+            rows = await conn.fetchall(operation, parameters)
+            conn.close()
+        or in Python 2 (trollius):
+            conn = yield From(AsyncConnection.connect(loop, host=...))
+            rows = yield From(conn.fetchall(operation, parameters))
+        
+        As for any asynchronous psycopg connection, a connection can run only one operation at a time 
+        (wait for the future of an operation before starting the next one), is in autocommit mode 
+        and does not support named cursors. For more info, see 
+        http://initd.org/psycopg/docs/advanced.html#asynchronous-support
+    """
+    def __init__(self, loop, conn):
+        """
+            Creates a new AsyncConnection from an asynchronous psycopg connection. Consider using 
+            AsyncConnection.connect instead
+        """
+        self.loop = loop
+        self.conn = conn
+    
+    @staticmethod
+    def connect(loop, host=HOST, port=PORT, dbname=DBNAME, user=USER,  password=PSWD):
+        """
+            Returns a future whose result is a new AsyncConnection with given arguments, which default if 
+            missing to the relative globally defined variables
+        """
+        conn = psycopg2.connect(host=host, port=port, dbname=dbname, user=user,  password=password, async=1)
+        future = _future(loop)
+        _poll(loop, conn, future, lambda: AsyncConnection(loop, conn))
+        return future
+    
+    def cursor(self, operation, parameters=None):
+        """
+            Returns a future whose result is the psycopg cursor which executed the given operation 
+            (see module level cursor function)
+        """
+        c = self.conn.cursor()
+        future = _future(self.loop)
+        try:
+            if parameters is None:  c.execute(operation)
+            else: c.execute(operation, parameters)
+        except Exception as exc:
+            c.close()
+            future.set_exception(exc)
+            return future
+        _poll(self.loop, self.conn, future, lambda: c)
+        return future
+    
+    def execute(self, operation, parameters=None):
+        """
+            Returns a future whose result is None, set when the given operation is executed 
+            (see module level execute function)
+        """
+        return self.__then(self.cursor(operation, parameters), lambda c: c.close())
+    
+    def fetchall(self, operation, parameters=None):
+        """
+            Returns a future whose result is the list of rows of the given query operation 
+            (see module level fetchall function)
+        """
+        def fetch(c):
+            try:
+                return c.fetchall()
+            finally:
+                c.close()
+        return self.__then(self.cursor(operation, parameters), fetch)
+    
+    def __then(self, future, func):
+        #returns a new future whose result is func(future.result())
+        ret = _future(self.loop)
+        def done(fut):
+            if ret.done():
+                return
+            if fut.cancelled():
+                ret.cancel()
+            elif fut.exception() is not None:
+                ret.set_exception(fut.exception())
+            else:
+                try:
+                    ret.set_result(func(fut.result()))
+                except Exception as exc:
+                    ret.set_exception(exc)
+        future.add_done_callback(done)
+        return ret
+    
+    @property
+    def closed(self):
+        return self.conn.closed != 0
+    
+    def close(self):
+        """
+            Closes the underlying psycopg connection. Does nothing if the connection is already closed
+        """
+        if not self.closed:
+            fd = self.conn.fileno()
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+            self.conn.close()
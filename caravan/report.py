@@ -421,7 +421,7 @@ def report(session_id):
     maximum_intensity = [(impact[i][1],roman_numerals[int(round(x))]) for i,x in enumerate(maximum_intensity) if x==max(maximum_intensity)][0]
 
     #--Building types
-    bt = conn.fetchall("""SELECT GM.geocell_id,
+    bt = conn.iterate("""SELECT GM.geocell_id,
            BD.building_type,
            BD.freq_dirichlet,
            BD.freq_storeys,
@@ -444,7 +444,9 @@ def report(session_id):
     bt_freq = {}
     bt_vc = {}
     bt_name = {}
+    bt_count = 0 #rows are streamed (see dbutils.iterate), count them
     for row in bt:
+        bt_count += 1
         if str(row[1]) not in bt_freq.keys():
             #frequency (single value)
             bt_freq[str(row[1])] = row[2]
@@ -461,7 +463,7 @@ def report(session_id):
     #create averages
     for key in bt_freq.keys():
         bt_freq[key]=bt_freq[key]/len(locations)
-        bt_vc[key]=[x/len(bt) for x in bt_vc[key]]
+        bt_vc[key]=[x/bt_count for x in bt_vc[key]]
 
     #select m dominant types
     m = 3
@@ -36,6 +36,7 @@ import caravan.dbutils as dbutils
 from caravan.core.gmpes.gmpe_utils import SOF as styleoffaulting #"AS" IS !ESSENTIAL!: IT AVOIDS CONFLICTS WITH PARAMS SOF (see get function)
 import caravan.parser as parser
 import caravan.core.gmpes.gmpes as gmpes
+import numpy as np
 
 #TODOLIST:
 #    Visualizzare prob. dist
@@ -62,6 +63,9 @@ tess_ids = opts.tess_ids #Other values (7,6,3,2,1)
 aoi_i_ref = opts.aoi_i_ref
 #step radius for calculating Intensity higher than I-ref in core calculations
 aoi_km_step = opts.aoi_km_step
+#select the targets of the area of interest from in-memory spatial indices (see core.spatialindex) instead of 
+#database spatial queries:
+spatial_index = getattr(opts, 'spatial_index', True)
 
 #distributions npts (might be modified according to percentiles, see below):
 mcerp_npts = opts.mcerp_npts #10000 is the default
@@ -72,6 +76,35 @@ percentiles = tuple(sorted(opts.percentiles))
 #default calculate ground motion only
 gm_only = opts.gm_only
 
+#number of targets per task (None or non-positive: automatic) and tiles size, in degrees, 
+#to group targets spatially in tasks (None or non-positive: no tiles) in core calculations:
+chunk_size = getattr(opts, 'chunk_size', None)
+chunk_tile_deg = getattr(opts, 'chunk_tile_deg', None)
+
+#number of rows and maximum interval (seconds, None or non-positive: no interval) for batch writes into the database 
+#in core calculations (see dbutils.BatchWriter):
+db_batch_size = getattr(opts, 'db_batch_size', 500)
+db_batch_interval = getattr(opts, 'db_batch_interval', None)
+
+#calculate the damage state probabilities in the risk calculation from the exact beta cdf of the damage grades instead of 
+#sampling the damage grades (see vulnerability_module.damage_bts_cdf):
+risk_analytic = getattr(opts, 'risk_analytic', False)
+
+#skip the risk calculation of the cells whose probability of an intensity greater or equal to risk_cutoff_intensity 
+#is not greater than risk_cutoff_tol (their ground motion is written anyway). None: no cutoff:
+risk_cutoff_intensity = getattr(opts, 'risk_cutoff_intensity', None)
+risk_cutoff_tol = getattr(opts, 'risk_cutoff_tol', 0.0)
+
+#adaptive multi-resolution mode: tessellation ids from the coarsest to the finest, used if at least two of them are 
+#in the tess_ids of a simulation. Coarse cells are refined according to the thresholds below (see core.refine_targets):
+refine_tess_ids = getattr(opts, 'refine_tess_ids', None)
+refine_intensity = getattr(opts, 'refine_intensity', 7.0)
+refine_intensity_delta = getattr(opts, 'refine_intensity_delta', 0.5)
+refine_fatalities = getattr(opts, 'refine_fatalities', 1.0)
+
+#number of worker processes of the application pool shared across simulations (None or non-positive: number of cpus):
+pool_processes = getattr(opts, 'pool_processes', None)
+
 try: import simplejson as json #see http://stackoverflow.com/questions/712791/what-are-the-differences-between-json-and-simplejson-python-modules
 except ImportError: import json
 
@@ -97,7 +130,22 @@ def imgpath():
     return 'imgs/'
 
 #default connection class:
-def connection(host=opts.DB_HOST, port=opts.DB_PORT, dbname=opts.DB_NAME, user=opts.DB_USER,  password=opts.DB_PSWD, async=opts.DB_ASYNC):
+#connection pool settings (see dbutils.ConnectionPool):
+DB_POOL = getattr(opts, 'DB_POOL', True)
+DB_POOL_MIN = getattr(opts, 'DB_POOL_MIN', 0)
+DB_POOL_MAX = getattr(opts, 'DB_POOL_MAX', 10)
+#execute the statements repeated for each target as prepared statements (see dbutils.Statements):
+DB_PREPARED = getattr(opts, 'DB_PREPARED', True)
+
+def connection(host=opts.DB_HOST, port=opts.DB_PORT, dbname=opts.DB_NAME, user=opts.DB_USER,  password=opts.DB_PSWD, async=opts.DB_ASYNC, pooled=DB_POOL):
+    """
+        Returns a new dbutils.Connection. If pooled is True, the connection is taken from the 
+        connection pool of the current process, and its close() method returns it to the pool 
+        (see dbutils.ConnectionPool)
+    """
+    if pooled:
+        return dbutils.getpool(DB_POOL_MIN, DB_POOL_MAX, host=host, port=port, dbname=dbname, user=user, 
+                               password=password, async=async).connection()
     return dbutils.Connection(host, port, dbname, user, password, async)
 
 #quakelink
@@ -435,6 +483,45 @@ def discretepdf(dist, ticks):
         prev=tmp
     yield (dist >= t)-0 #this converts boolean to numeric in case dist is scalar
     
+def percentile_many(samples, vals):
+    """
+        Vectorized counterpart of mcerp.UncertainFunction.percentile: returns the percentiles 
+        (NIST method, as mcerp does) of N distributions given as the numpy matrix samples of shape (N, npts) 
+        (the i-th row holds the samples of the i-th distribution). 
+        vals is an iterable of percentiles in [0, 1]. Returns a numpy matrix of shape (N, len(vals)). 
+        A single column samples matrix (npts=1) denotes scalars, and its values are returned for all percentiles
+    """
+    tmp = np.sort(np.asarray(samples, dtype=float), axis=-1)
+    npts = tmp.shape[-1]
+    out = np.empty((tmp.shape[0], len(vals)))
+    for i, val in enumerate(vals):
+        if npts == 1:
+            out[:, i] = tmp[:, 0]
+        elif val <= 0:
+            out[:, i] = tmp[:, 0]
+        elif val >= 1:
+            out[:, i] = tmp[:, -1]
+        else:
+            n = val*(npts + 1)
+            k, d = int(n), n - int(n)
+            #mcerp raises IndexError if k+1 (or k) is out of bounds (too few points for val), we clip instead:
+            k, k1 = min(k, npts - 1), min(k + 1, npts - 1)
+            out[:, i] = tmp[:, k] + d*(tmp[:, k1] - tmp[:, k])
+    return out
+
+def discretepdf_many(samples, ticks):
+    """
+        Vectorized counterpart of discretepdf: returns the (discrete) probability density functions 
+        of N distributions given as the numpy matrix samples of shape (N, npts) 
+        (the i-th row holds the samples of the i-th distribution) at the given bins 
+        represented by the ticks argument (list or tuple or iterable). 
+        Returns a numpy matrix of shape (N, len(ticks)+1). A single column samples matrix 
+        (npts=1) denotes scalars (see discretepdf)
+    """
+    samples = np.asarray(samples, dtype=float)
+    cdf = np.array([np.mean(samples < t, axis=-1) for t in ticks] + [np.ones(samples.shape[0])]).T
+    return np.diff(np.hstack((np.zeros((samples.shape[0], 1)), cdf)), axis=-1)
+
 def isnumpyscalar(val):
     return hasattr(val,"item")
 
@@ -37,8 +37,45 @@ percentiles = (0.05, 0.25, 0.5, 0.75, 0.95)
 aoi_i_ref = 5
 #area of intereest (aoi) step radius for calculating Intensity higher than I-ref in core calculations
 aoi_km_step = 10
+#if True, the targets of the area of interest are selected from in-memory spatial indices of the tessellations, loaded 
+#once per process (and reloaded when the targets of a tessellation in exposure.targets change), instead of querying the database. 
+#Needs the migration sql/001_tessellations_targets_version.sql (otherwise the targets are selected from the database, with a warning)
+spatial_index = True
 #defining the default value for ground motion only calculation (no fatalities etcetera):
 gm_only = False
+#number of targets processed in a single task (with a single database connection) in core calculations.
+#None or non-positive: automatic (a few tasks per processor)
+chunk_size = None
+#if positive, targets are also grouped in tasks by spatial tiles of chunk_tile_deg x chunk_tile_deg degrees
+#(None or non-positive: no grouping by tiles):
+chunk_tile_deg = None
+#results (e.g., ground motions) are written to the database in batches of db_batch_size rows, or every 
+#db_batch_interval seconds (None or non-positive: no interval) in core calculations:
+db_batch_size = 500
+db_batch_interval = None
+#if True, the damage state probabilities in the risk calculation are calculated from the exact beta cdf of the damage 
+#grades (combined on a fine damage grid) instead of sampling the damage grade distributions. There is no damage grade 
+#sampling noise, and the cost does not grow with mcerp_npts (intensity samples are grouped on a grid of step 0.1):
+risk_analytic = False
+#the risk calculation (damage and fatalities) of a cell is skipped if the probability of an intensity greater or equal 
+#to risk_cutoff_intensity (e.g., 5.5) is not greater than risk_cutoff_tol. The ground motion of the cell is written 
+#anyway. Peripheral cells of the area of interest are usually the majority: a cutoff speeds up large events. 
+#None: no cutoff (all cells are processed):
+risk_cutoff_intensity = None
+risk_cutoff_tol = 0.0
+#adaptive multi-resolution mode: tessellation ids ordered from the coarsest to the finest, e.g. (5, 7). If at least two 
+#of the tessellations of a simulation (tess_ids) are in this hierarchy, the other ones are ignored (with a warning) and 
+#the ground motion is first evaluated on the coarsest of them. Then only the cells where the median intensity is 
+#>= refine_intensity, or differs by at least refine_intensity_delta from a neighbouring cell, or the expected fatalities 
+#are >= refine_fatalities (ignored if ground motion only) are replaced by the cells of the next finer tessellation, and so on. Coarse cells fill in elsewhere. Each threshold can be None (criterion disabled). 
+#None: disabled (single resolution):
+refine_tess_ids = None
+refine_intensity = 7.0
+refine_intensity_delta = 0.5
+refine_fatalities = 1.0
+#number of worker processes of the application pool, created once and shared across simulations
+#(None or non-positive: the number of processors):
+pool_processes = None
 
 #database default settings:
 DB_ASYNC = 1
@@ -47,3 +84,11 @@ DB_NAME = 'caravan_dev'
 DB_USER = 'postgres'
 DB_PSWD = 'postgres'
 DB_PORT = 5432
+#database connection pool (one per process): if True, connections are reused. DB_POOL_MIN: connections opened 
+#at pool creation, DB_POOL_MAX: maximum number of idle connections kept in the pool
+DB_POOL = True
+DB_POOL_MIN = 0
+DB_POOL_MAX = 10
+#if True, the statements repeated for each target (e.g., ground motion inserts) are executed as prepared statements, 
+#so that the database parses and plans them once per connection
+DB_PREPARED = True
@@ -31,6 +31,7 @@ import miniwsgi, quakelink
 
 from caravan.core.core import caravan_run as run
 from caravan.core.runutils import RunInfo
+from caravan.core.scenario import latest_session
 from caravan.core.event import Reader as Event
 from caravan.dbutils import Error as dbError
 
@@ -89,7 +90,7 @@ def caravan_mainpage(request, response):
             scenario_id =scenario[0]
             #print(scenario_id)
 
-            session_id =conn.fetchall( "select * from processing.sessions where scenario_id=%s;", (scenario_id,) )[-1][0] #last, most recent line is picked
+            session_id =latest_session(conn, scenario_id) #last, most recent session is picked
             #print(session_id)
 
         conn.close()
@@ -484,7 +485,8 @@ def query_simulation_data(request, response):
     #::double precision is NECESSARY as it returns a json convertible value, otherwise array alone returns python decimals
     #which need to be converted to double prior to json dumps
 
-    data = conn.fetchall("""SELECT
+    #stream the rows (see dbutils.iterate) rather than loading all geometries and arrays of the session at once:
+    data = conn.iterate("""SELECT
 ST_AsGeoJSON(ST_Transform(G.the_geom,4326))::json AS geometry, GM.geocell_id, GM.ground_motion, risk.social_conseq.fatalities_prob_dist, risk.econ_conseq.total_loss
 FROM
 processing.ground_motion as GM
@@ -497,9 +499,7 @@ exposure.geocells as G ON (G.gid = GM.geocell_id)
 WHERE
 GM.session_id=%s""",(session_id,))
     #fixme: (MAX) there is no condition on tess_id ! Since the query uses geometry, a condition should be added.
-
-    #conn.conn.commit()
-    conn.close()
+    #Note: the connection is closed after the rows have been processed (see below)
 
     #HYPOTHESES:
     #1) The query above returns a table T whose header (columns) are:
@@ -580,6 +580,8 @@ GM.session_id=%s""",(session_id,))
             cell['properties'][name] = property
 
         features.append(cell)
+    #conn.conn.commit()
+    conn.close()
     dataret['features'] = features
     dataret['emptyLayers'] = {k:True for k in empty_layers}
 
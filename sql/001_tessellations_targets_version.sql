@@ -0,0 +1,35 @@
+-- Version stamp of the targets of each tessellation, read by caravan.core.spatialindex.version to decide whether 
+-- the in-memory spatial index of a tessellation must be reloaded. Any insert, update or delete of exposure.targets 
+-- increments the targets_version of the tessellation(s) of the changed rows (TRUNCATE increments all of them). 
+-- Apply once per database (the script can be run again safely):
+--     psql -d caravan -f sql/001_tessellations_targets_version.sql
+
+BEGIN;
+
+ALTER TABLE exposure.tessellations ADD COLUMN IF NOT EXISTS targets_version bigint NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION exposure.bump_targets_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN -- TRUNCATE
+        UPDATE exposure.tessellations SET targets_version = targets_version + 1;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE exposure.tessellations SET targets_version = targets_version + 1 WHERE gid = OLD.tess_id;
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.tess_id IS DISTINCT FROM OLD.tess_id) THEN
+        UPDATE exposure.tessellations SET targets_version = targets_version + 1 WHERE gid = NEW.tess_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS targets_version ON exposure.targets;
+CREATE TRIGGER targets_version AFTER INSERT OR UPDATE OR DELETE ON exposure.targets
+    FOR EACH ROW EXECUTE PROCEDURE exposure.bump_targets_version();
+
+DROP TRIGGER IF EXISTS targets_version_truncate ON exposure.targets;
+CREATE TRIGGER targets_version_truncate AFTER TRUNCATE ON exposure.targets
+    FOR EACH STATEMENT EXECUTE PROCEDURE exposure.bump_targets_version();
+
+COMMIT;
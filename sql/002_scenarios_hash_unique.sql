@@ -0,0 +1,9 @@
+-- Unique index on the scenario hash, needed by caravan.core.scenario.Scenario.writetodb to write scenarios with a 
+-- single INSERT ... ON CONFLICT (hash) statement (PostgreSQL 9.5+). Without it, writetodb falls back (with a warning) 
+-- to a select-then-insert, where two concurrent runs of the same scenario might both insert it. 
+-- The index cannot be created if the table already holds duplicated hashes. List them with: 
+--     SELECT hash, array_agg(gid ORDER BY gid) FROM processing.scenarios GROUP BY hash HAVING count(*) > 1;
+-- Apply once per database (the script can be run again safely):
+--     psql -d caravan -f sql/002_scenarios_hash_unique.sql
+
+CREATE UNIQUE INDEX IF NOT EXISTS scenarios_hash_key ON processing.scenarios (hash);
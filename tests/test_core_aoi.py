@@ -0,0 +1,48 @@
+"""
+Tests of the polygon of the area of interest of extended sources (core.aoi_vertices). Needs 
+caravan/settings/user_options.py (see APACHE_INSTALLATION_README.txt). Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import numpy as np
+from caravan.core import core
+from caravan.core.gmpes import gmpe_utils
+from caravan.core.spatialindex import inside_polygon
+
+LAT, LON = 42.87, 74.6
+
+class AoiVerticesTest(unittest.TestCase):
+
+    def check(self, radii):
+        azimuths = np.arange(len(radii)) * (360.0 / len(radii))
+        poly_lons, poly_lats = core.aoi_vertices(LAT, LON, azimuths, radii)
+        #random points of each sector between two adjacent azimuths, within the greater of their radii:
+        rnd = np.random.RandomState(1)
+        step = 360.0 / len(radii)
+        for i in xrange(len(radii)):
+            radius = max(radii[i], radii[(i + 1) % len(radii)])
+            az = azimuths[i] + step * rnd.uniform(0, 1, 200)
+            dist = radius * np.sqrt(rnd.uniform(0, 0.999, 200))
+            lats, lons = gmpe_utils.reckon(np.full(200, LAT), LON, gmpe_utils.km2deg(dist), az)
+            self.assertTrue(np.all(inside_polygon(lons, lats, poly_lons, poly_lats)), (radii, i))
+
+    def test_equal_radii(self):
+        self.check(np.full(16, 50.0))
+
+    def test_elongated(self):
+        #e.g. a rupture along the north-south direction, whose radii change abruptly between adjacent azimuths:
+        radii = np.array([120, 40, 20, 15, 15, 15, 20, 40, 120, 40, 20, 15, 15, 15, 20, 40], dtype=float)
+        self.check(radii)
+        self.check(np.roll(radii, 3))
+
+    def test_enclosing_circle(self):
+        #the circle used to speed up the polygon search (see core.caravan_run) encloses all vertices:
+        radii = np.array([120, 40, 20, 15, 15, 15, 20, 40], dtype=float)
+        azimuths = np.arange(len(radii)) * (360.0 / len(radii))
+        lons, lats = core.aoi_vertices(LAT, LON, azimuths, radii)
+        dists = [gmpe_utils.deg2km(gmpe_utils.distance(LAT, LON, lat, lon)) for lat, lon in zip(lats, lons)]
+        self.assertTrue(np.all(np.array(dists) <= np.max(radii) * core._aoi_scale(azimuths) + 1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
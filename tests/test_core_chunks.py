@@ -0,0 +1,151 @@
+"""
+Tests of the splitting of the targets into tasks (core.chunks) and of the multi-resolution refinement of the 
+targets (core.refine_targets). Needs caravan/settings/user_options.py 
+(see APACHE_INSTALLATION_README.txt). Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import math
+import unittest
+from collections import Counter
+import numpy as np
+from caravan.core import core
+
+def random_targets(rnd, n, lon0=74.0, lat0=42.0, size_deg=2.0):
+    """
+        Returns n random targets (tuples target_id, geocell_id, lon, lat) in the square of the given size and 
+        lower left corner
+    """
+    lons = lon0 + size_deg * rnd.random_sample(n)
+    lats = lat0 + size_deg * rnd.random_sample(n)
+    return [(i, 1000 + i, float(lon), float(lat)) for i, (lon, lat) in enumerate(zip(lons, lats))]
+
+class ChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = np.random.RandomState(1)
+
+    def check_ranges(self, ranges, num_targets, chunk_size):
+        #ranges are contiguous, cover all targets and hold at most chunk_size targets each:
+        self.assertEqual([r[0] for r in ranges], [0] + [r[1] for r in ranges[:-1]])
+        self.assertEqual(ranges[-1][1] if ranges else 0, num_targets)
+        self.assertTrue(all(0 < e - s <= chunk_size for s, e in ranges))
+
+    def test_chunk_size(self):
+        targets = random_targets(self.rnd, 103)
+        for chunk_size in (1, 10, 103, 500):
+            ret, ranges = core.chunks(targets, chunk_size)
+            self.assertIs(ret, targets)
+            self.check_ranges(ranges, len(targets), chunk_size)
+            self.assertEqual(len(ranges), int(math.ceil(103.0 / chunk_size)))
+        #non positive chunk sizes are treated as 1:
+        self.assertEqual(core.chunks(targets[:3], 0)[1], [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(core.chunks([], 10), ([], []))
+
+    def test_tiles(self):
+        targets = random_targets(self.rnd, 500)
+        tile_deg = 0.5
+        tile = lambda t: (math.floor(t[3] / tile_deg), math.floor(t[2] / tile_deg))
+        for chunk_size in (7, 50, 1000):
+            ret, ranges = core.chunks(targets, chunk_size, tile_deg)
+            self.assertEqual(sorted(ret), sorted(targets))
+            self.check_ranges(ranges, len(ret), chunk_size)
+            #a range never spans over two tiles, and the targets of a tile are contiguous:
+            for s, e in ranges:
+                self.assertEqual(len(set(tile(t) for t in ret[s:e])), 1)
+            tiles = [tile(ret[s]) for s, e in ranges]
+            self.assertEqual(len(set(tiles)), len([i for i in xrange(len(tiles)) if i == 0 or tiles[i] != tiles[i-1]]))
+            #4 x 4 tiles, and only the last range of each tile is not full:
+            counts = Counter(tile(t) for t in targets)
+            self.assertEqual(len(counts), 16)
+            self.assertEqual(len(ranges), sum(int(math.ceil(c / float(chunk_size))) for c in counts.itervalues()))
+        #no tiles (None or non positive tile_deg):
+        self.assertIs(core.chunks(targets, 10, 0)[0], targets)
+        self.assertIs(core.chunks(targets, 10, None)[0], targets)
+
+def great_circle(lats1, lons1, lats2, lons2):
+    #brute force great circle distances (haversine, radians), broadcasting the arguments (in degrees):
+    lats1, lons1, lats2, lons2 = [np.radians(np.asarray(v, dtype=float)) for v in (lats1, lons1, lats2, lons2)]
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a))
+
+class StubGmpe(object):
+    """
+        A gmpe whose intensity decreases linearly with the distance (in degrees) from (lat, lon), with npts 
+        equal samples (so that the median is exact)
+    """
+    def __init__(self, lat, lon, npts=5):
+        self.lat, self.lon, self.npts = lat, lon, npts
+
+    def evaluate_many(self, lats, lons):
+        median = 9 - 2 * np.degrees(great_circle(self.lat, self.lon, lats, lons))
+        return np.repeat(median[:, None], self.npts, axis=1)
+
+class RefineTargetsTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = np.random.RandomState(1)
+        self.coarse = random_targets(rnd, 40)
+        self.fine = [(10000 + t[0], 20000 + t[0], t[2], t[3]) for t in random_targets(rnd, 600)]
+        self.gmpe = StubGmpe(43., 75.)
+        self.lons = np.array([t[2] for t in self.coarse])
+        self.lats = np.array([t[3] for t in self.coarse])
+        self.medians = self.gmpe.evaluate_many(self.lats, self.lons)[:, 0]
+        #owner (nearest coarse target) of each fine target:
+        self.owners = np.argmin(great_circle(np.array([t[3] for t in self.fine])[:, None], 
+                                             np.array([t[2] for t in self.fine])[:, None], 
+                                             self.lats[None, :], self.lons[None, :]), axis=1)
+        self.fatalities_many = core.risk_calc.fatalities_many
+
+    def tearDown(self):
+        core.risk_calc.fatalities_many = self.fatalities_many
+
+    def expected(self, refine):
+        #the expected target ids and num_refined of refine_targets given the boolean array of the coarse cells to be refined:
+        refine = refine & (np.bincount(self.owners, minlength=len(self.coarse)) > 0)
+        return [t[0] for t, o in zip(self.fine, self.owners) if refine[o]] + [t[0] for t, r in zip(self.coarse, refine) if not r], \
+            int(np.sum(refine))
+
+    def refine(self, **kwargs):
+        targets, num_refined = core.refine_targets(self.gmpe, self.coarse, self.fine, **kwargs)
+        return [t[0] for t in targets], num_refined
+
+    def test_min_intensity(self):
+        refine = self.medians >= 8
+        self.assertTrue(0 < np.sum(refine) < len(self.coarse))
+        self.assertEqual(self.refine(min_intensity=8), self.expected(refine))
+
+    def test_min_delta(self):
+        #each cell is compared with its nearest core._REFINE_NEIGHBOURS cells:
+        dists = great_circle(self.lats[:, None], self.lons[:, None], self.lats[None, :], self.lons[None, :])
+        neighbours = np.argsort(dists, axis=1)[:, :core._REFINE_NEIGHBOURS + 1]
+        refine = np.max(np.abs(self.medians[neighbours] - self.medians[:, None]), axis=1) >= 0.7
+        self.assertTrue(0 < np.sum(refine) < len(self.coarse))
+        self.assertEqual(self.refine(min_delta=0.7), self.expected(refine))
+        #both criteria:
+        refine |= self.medians >= 8
+        self.assertEqual(self.refine(min_intensity=8, min_delta=0.7), self.expected(refine))
+
+    def test_min_fatalities(self):
+        #expected fatalities (mean of the samples) of each coarse cell, with no exposure for the last 5 cells:
+        fatalities = np.arange(len(self.coarse), dtype=float)
+        exposure = {'valid': np.arange(len(self.coarse)) < len(self.coarse) - 5, 'fatalities': fatalities}
+        core.risk_calc.fatalities_many = lambda I, exp: exp['fatalities'][:, None] + np.array([[-1., 0., 1.]])
+        refine = (fatalities >= 20) & exposure['valid']
+        self.assertEqual(self.refine(min_fatalities=20, exposure=exposure), self.expected(refine))
+        #no exposure: the criterion is disabled:
+        self.assertEqual(self.refine(min_fatalities=20), ([t[0] for t in self.coarse], 0))
+
+    def test_empty_cells(self):
+        #refined cells holding no fine target are kept:
+        fine = [t for t, o in zip(self.fine, self.owners) if o != 0]
+        targets, num_refined = core.refine_targets(self.gmpe, self.coarse, fine, min_intensity=0)
+        self.assertEqual(num_refined, len(self.coarse) - 1)
+        self.assertEqual(targets, fine + self.coarse[:1])
+
+    def test_no_targets(self):
+        self.assertEqual(core.refine_targets(self.gmpe, self.coarse, [], min_intensity=0), (self.coarse, 0))
+        self.assertEqual(core.refine_targets(self.gmpe, [], self.fine, min_intensity=0), (self.fine, 0))
+
+if __name__ == '__main__':
+    unittest.main()
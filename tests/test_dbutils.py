@@ -0,0 +1,275 @@
+"""
+Tests of the database utilities (dbutils) with no database: a stub psycopg connection records the executed 
+operations. Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import signal
+import threading
+import time
+import unittest
+from psycopg2.extensions import adapt, POLL_OK
+from caravan import dbutils
+
+class StubCursor(object):
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+
+    def mogrify(self, operation, parameters=None):
+        if parameters is None:
+            return operation
+        return operation % tuple(adapt(p).getquoted() for p in parameters)
+
+    def execute(self, operation, parameters=None):
+        if self.connection.fail:
+            raise dbutils.Error("stub error")
+        self.connection.executed.append((operation, parameters))
+
+    def fetchmany(self, size):
+        rows, self.connection.rows = self.connection.rows[:size], self.connection.rows[size:]
+        return rows
+
+    def fetchall(self):
+        #(FETCH FORWARD n of async iterate, see dbutils.iterate):
+        operation = self.connection.executed[-1][0]
+        return self.fetchmany(int(operation.split()[2]) if operation.startswith("FETCH FORWARD") else len(self.connection.rows))
+
+    def close(self):
+        if self.name is not None:
+            self.connection.closed_cursors.append(self.name)
+
+class StubConnection(object):
+    """
+        A psycopg connection with no server: executed operations are appended to the executed attribute, 
+        and raise if the fail attribute is True. Queries return the rows attribute (consumed when fetched)
+    """
+    async = 0
+    closed = 0
+
+    def __init__(self, async=0):
+        self.async = async
+        self.executed = []
+        self.fail = False
+        self.rows = []
+        self.closed_cursors = [] #names of the closed named cursors
+
+    def cursor(self, name=None):
+        return StubCursor(self, name)
+
+    def poll(self):
+        #(async connections, see dbutils.wait): the stub operations are always completed
+        return POLL_OK
+
+class StubPool(object):
+
+    def putconn(self, conn):
+        pass
+
+def connection():
+    return dbutils.PooledConnection(StubPool(), StubConnection())
+
+class StatementsTest(unittest.TestCase):
+
+    def test_placeholders(self):
+        #"%s" are rewritten as "$n". Literal "%" (escaped as "%%" in psycopg operations) are kept, also within 
+        #quoted strings, and the PREPARE command is escaped as it is bound to the parameters:
+        conn = connection()
+        operation = "SELECT '100%%', %s, 'a%%sb' FROM t WHERE x = %s AND y LIKE 'z%%'"
+        conn.execute(operation, (1, "o'k"), prepare=True)
+        command, parameters = conn.conn.executed[-1]
+        self.assertEqual(StubCursor(conn.conn).mogrify(command, parameters), 
+                         "PREPARE caravan_stmt_0 AS SELECT '100%', $1, 'a%sb' FROM t WHERE x = $2 AND y LIKE 'z%'; "
+                         "EXECUTE caravan_stmt_0 (1, 'o''k')")
+        conn.execute(operation, (2, "b"), prepare=True)
+        command, parameters = conn.conn.executed[-1]
+        self.assertEqual(StubCursor(conn.conn).mogrify(command, parameters), "EXECUTE caravan_stmt_0 (2, 'b')")
+
+    def test_no_parameters(self):
+        conn = connection()
+        conn.execute("SELECT 1", prepare=True)
+        conn.execute("SELECT 1", prepare=True)
+        self.assertEqual([op for op, _ in conn.conn.executed], 
+                         ["PREPARE caravan_stmt_0 AS SELECT 1; EXECUTE caravan_stmt_0", "EXECUTE caravan_stmt_0"])
+
+    def test_failure(self):
+        #a failed PREPARE is forgotten, and prepared again (with a new name) the next time:
+        conn = connection()
+        conn.conn.fail = True
+        self.assertRaises(dbutils.Error, conn.execute, "SELECT %s", (1,), prepare=True)
+        conn.conn.fail = False
+        conn.execute("SELECT %s", (1,), prepare=True)
+        self.assertTrue(conn.conn.executed[-1][0].startswith("PREPARE caravan_stmt_1 AS SELECT $1;"))
+
+    def test_lru(self):
+        conn = connection()
+        registry = conn.statements
+        registry.max_size = 2
+        conn.execute("SELECT %s", (1,), prepare=True)
+        conn.execute("SELECT %s + 1", (1,), prepare=True)
+        conn.execute("SELECT %s", (2,), prepare=True) #hit: "SELECT %s" is now the most recently used
+        self.assertEqual((registry.hits, registry.misses), (1, 2))
+        conn.execute("SELECT %s + 2", (1,), prepare=True) #evicts "SELECT %s + 1"
+        operation = conn.conn.executed[-1][0]
+        self.assertTrue(operation.startswith("DEALLOCATE caravan_stmt_1; PREPARE caravan_stmt_2 AS SELECT $1 + 2;"), 
+                        operation)
+        self.assertEqual(list(registry.names), ["SELECT %s", "SELECT %s + 2"])
+        conn.execute("SELECT %s", (3,), prepare=True)
+        self.assertEqual(conn.conn.executed[-1][0], "EXECUTE caravan_stmt_0 (%s)")
+
+class BatchWriterTest(unittest.TestCase):
+
+    def test_flush_at_batch_size(self):
+        conn = connection()
+        writer = dbutils.BatchWriter(conn, 't', ('a', 'b'), batch_size=3)
+        flushed = []
+        flush = writer.flush
+        writer.flush = lambda: flushed.append(len(writer.rows)) or flush()
+        for i in xrange(7):
+            writer.add((i, 'x'))
+        self.assertEqual(flushed, [3, 3])
+        self.assertEqual((writer.written, len(writer.rows)), (6, 1))
+        self.assertEqual(len(conn.conn.executed), 2)
+
+    def test_flush_at_close(self):
+        conn = connection()
+        with dbutils.BatchWriter(conn, 't', ('a',), batch_size=10) as writer:
+            writer.add((1,))
+            writer.add((2,))
+            self.assertEqual(conn.conn.executed, [])
+        self.assertEqual([op for op, _ in conn.conn.executed], ["INSERT INTO t (a) VALUES (1), (2)"])
+        self.assertEqual((writer.written, writer.rows), (2, []))
+        #nothing to write:
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(len(conn.conn.executed), 1)
+
+    def test_values(self):
+        #multi-row VALUES built via mogrify, with quoted strings, NULLs and arrays:
+        conn = connection()
+        writer = dbutils.BatchWriter(conn, 'processing.ground_motion', ('target_id', 'name', 'ground_motion'), autoflush=False)
+        writer.add((1, "it's", [1.5, 2]))
+        writer.add((2, None, [3]))
+        self.assertFalse(writer.due())
+        writer.flush()
+        self.assertEqual(conn.conn.executed, [("INSERT INTO processing.ground_motion (target_id, name, ground_motion) "
+                                               "VALUES (1, 'it''s', ARRAY[1.5,2]), (2, NULL, ARRAY[3])", None)])
+
+    def test_dropped(self):
+        conn = connection()
+        writer = dbutils.BatchWriter(conn, 't', ('a',), batch_size=2)
+        conn.conn.fail = True
+        writer.add((1,))
+        writer.add((2,))
+        conn.conn.fail = False
+        writer.add((3,))
+        writer.flush()
+        self.assertEqual((writer.written, writer.dropped), (1, [(1,), (2,)]))
+
+    def test_interval(self):
+        conn = connection()
+        writer = dbutils.BatchWriter(conn, 't', ('a',), batch_size=100, interval=0.001, autoflush=False)
+        writer.add((1,))
+        time.sleep(0.01)
+        self.assertTrue(writer.due())
+
+    def test_prepare_batch_size_only(self):
+        conn = connection()
+        writer = dbutils.BatchWriter(conn, 't', ('a', 'b'), batch_size=2, autoflush=False, prepare=True)
+        for i in xrange(5):
+            writer.add((i, 'x'))
+        self.assertEqual(writer.flush(), 5)
+        operations = [op for op, _ in conn.conn.executed]
+        self.assertEqual(len(operations), 3)
+        #the two chunks of batch_size rows use the same prepared statement, the remaining row is not prepared:
+        self.assertTrue(operations[0].startswith("PREPARE caravan_stmt_0 AS INSERT INTO t (a, b) VALUES ($1, $2), ($3, $4);"))
+        self.assertEqual(operations[1], "EXECUTE caravan_stmt_0 (%s, %s, %s, %s)")
+        self.assertEqual(operations[2], "INSERT INTO t (a, b) VALUES (4, 'x')")
+        self.assertEqual(list(conn.statements.names), ["INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)"])
+        self.assertEqual((writer.written, writer.dropped), (5, []))
+
+class IterateTest(unittest.TestCase):
+
+    def test_sync(self):
+        #named (server side) cursor, fetching batch_size rows at a time:
+        conn = connection()
+        conn.conn.rows = [(i,) for i in xrange(5)]
+        self.assertEqual(list(conn.iterate("SELECT %s", (1,), batch_size=2)), [(i,) for i in xrange(5)])
+        self.assertEqual(conn.conn.executed, [("SELECT %s", (1,))])
+        self.assertEqual(len(conn.conn.closed_cursors), 1)
+        self.assertTrue(conn.conn.closed_cursors[0].startswith("caravan_cursor_"))
+
+    def test_async(self):
+        #DECLARE and FETCH within a transaction block, closed and committed when exhausted:
+        conn = dbutils.PooledConnection(StubPool(), StubConnection(async=1))
+        conn.conn.rows = [(i,) for i in xrange(5)]
+        self.assertEqual(list(conn.iterate("SELECT %s", ("a",), batch_size=2)), [(i,) for i in xrange(5)])
+        operations = [op for op, _ in conn.conn.executed]
+        name = operations[0].split()[2]
+        self.assertEqual(operations, ["BEGIN; DECLARE " + name + " NO SCROLL CURSOR FOR SELECT 'a'"] + 
+                         ["FETCH FORWARD 2 FROM " + name] * 4 + ["CLOSE " + name + "; COMMIT"])
+
+    def test_async_closed(self):
+        #a generator not exhausted is closed (and its transaction rolled back) when the connection is closed:
+        conn = dbutils.PooledConnection(StubPool(), StubConnection(async=1))
+        stub = conn.conn
+        stub.rows = [(i,) for i in xrange(5)]
+        rows = conn.iterate("SELECT 1", batch_size=2)
+        self.assertEqual(next(rows), (0,))
+        conn.close()
+        self.assertEqual(stub.executed[-1][0], "ROLLBACK")
+        self.assertRaises(StopIteration, next, rows)
+
+    def test_sync_break(self):
+        #a generator closed before being exhausted closes its named cursor:
+        conn = connection()
+        conn.conn.rows = [(i,) for i in xrange(5)]
+        rows = conn.iterate("SELECT 1", batch_size=2)
+        self.assertEqual(next(rows), (0,))
+        self.assertEqual(conn.conn.closed_cursors, [])
+        rows.close()
+        self.assertEqual(len(conn.conn.closed_cursors), 1)
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = dbutils.connect
+        dbutils.connect = lambda **kwargs: StubConnection()
+
+    def tearDown(self):
+        dbutils.connect = self.connect
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "os.fork not available")
+    def test_fork_with_locks_held(self):
+        #another thread holds the locks of the pool and of getpool while the process forks: the child must not 
+        #inherit them locked (it would block forever when getting a connection)
+        pool = dbutils.getpool(minconn=1, host='stub')
+        pool_lock, held, release = pool._ConnectionPool__lock, threading.Event(), threading.Event()
+        def hold():
+            with pool_lock:
+                with dbutils._POOLS_LOCK:
+                    held.set()
+                    release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        try:
+            pid = os.fork()
+            if pid == 0: #child: exit with 0 if a connection is returned, killed by the alarm if blocked
+                signal.alarm(5)
+                code = 1
+                try:
+                    conn = dbutils.getpool(host='stub').getconn()
+                    code = 0 if isinstance(conn, StubConnection) else 1
+                finally:
+                    os._exit(code)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+        finally:
+            release.set()
+            thread.join()
+            dbutils._POOLS.clear()
+
+if __name__ == '__main__':
+    unittest.main()
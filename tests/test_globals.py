@@ -0,0 +1,60 @@
+"""
+Tests of the vectorized percentiles and discrete pdfs of many distributions (globals.percentile_many and
+globals.discretepdf_many) against mcerp.UncertainFunction.percentile and the scalar globals.discretepdf.
+Needs caravan/settings/user_options.py (see APACHE_INSTALLATION_README.txt). Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import numpy as np
+import mcerp
+from caravan.settings import globals
+
+class ManyDistributionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = np.random.RandomState(1)
+        self.npts = mcerp.npts
+
+    def tearDown(self):
+        mcerp.npts = self.npts
+
+    def test_percentile_many(self):
+        for npts in (2, 3, 10, 99, 1000):
+            samples = self.rnd.normal(7, 1.5, (20, npts))
+            #valid percentiles for mcerp (which reads the k+1-th sorted sample, see test_percentile_many_clipped) plus 0, 1 and out of range:
+            vals = [-0.1, 0, 0.5 / (npts + 1), 0.1, 0.25, 0.5, 0.75, (npts - 1.0) / (npts + 1), 1, 1.1]
+            vals = [v for v in vals if v <= 0 or v >= 1 or v * (npts + 1) + 1 < npts]
+            out = globals.percentile_many(samples, vals)
+            self.assertEqual(out.shape, (len(samples), len(vals)))
+            for row, expected in zip(out, samples):
+                self.assertEqual(row.tolist(), mcerp.UncertainFunction(expected).percentile(vals))
+
+    def test_percentile_many_clipped(self):
+        #percentiles too close to 1 for npts make mcerp raise IndexError, percentile_many returns the max:
+        samples = self.rnd.normal(7, 1.5, (5, 10))
+        self.assertRaises(IndexError, mcerp.UncertainFunction(samples[0]).percentile, 0.95)
+        self.assertEqual(globals.percentile_many(samples, [0.95])[:, 0].tolist(), np.max(samples, axis=1).tolist())
+
+    def test_percentile_many_scalars(self):
+        samples = self.rnd.normal(7, 1.5, (5, 1))
+        out = globals.percentile_many(samples, [0.1, 0.5, 0.9])
+        self.assertEqual(out.tolist(), np.repeat(samples, 3, axis=1).tolist())
+
+    def test_discretepdf_many(self):
+        ticks = [5, 6, 7, 8, 9, 10]
+        for npts in (1, 10, 1000):
+            #rounded samples, so that some of them equal the ticks:
+            samples = np.round(self.rnd.normal(7.5, 2, (20, npts)) * 2) / 2
+            #mcerp comparisons (dist < t) divide by mcerp.npts, i.e. the number of samples of every distribution:
+            mcerp.npts = npts
+            out = globals.discretepdf_many(samples, ticks)
+            self.assertEqual(out.shape, (len(samples), len(ticks) + 1))
+            for row, mcpts in zip(out, samples):
+                dist = mcerp.UncertainFunction(mcpts) if npts > 1 else mcpts[0]
+                expected = [float(p) for p in globals.discretepdf(dist, ticks)]
+                self.assertTrue(np.allclose(row, expected, rtol=0, atol=1e-12), (row, expected))
+                self.assertAlmostEqual(np.sum(row), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests of the vectorized rupture distance (gmpe_utils.rup_distance_array and FaultGeometry) against the scalar 
+rup_distance, and of the vectorized gmpe evaluation (Gmpe.evaluate_many) against the per-point one (Gmpe.__call__). 
+Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import warnings
+import numpy as np
+import mcerp
+from caravan.core.gmpes import gmpe_utils
+from caravan.core.gmpes.gmpes import GlobalWaRup, GlobalWaHyp
+
+LAT_EPI, LON_EPI = 42.87, 74.6
+
+def random_points(rnd, n, max_km=150):
+    """
+        Returns n random (lats, lons) around the epicenter within max_km, at all azimuths. Half of the 
+        points are within 20 km, i.e. above or around the fault (regions closest to the corners and sides)
+    """
+    dist = np.concatenate((rnd.uniform(0, 20, n // 2), rnd.uniform(0, max_km, n - n // 2)))
+    az = rnd.uniform(0, 360, n)
+    lats, lons = gmpe_utils.reckon(np.full(n, LAT_EPI), LON_EPI, gmpe_utils.km2deg(dist), az)
+    return lats, lons
+
+class RupDistanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = np.random.RandomState(1)
+
+    def test_array_vs_scalar(self):
+        #(depth, RLD, RW) tuples: the first has a buried fault top (D_tor > 0), the second a surface rupture:
+        for depth, RLD, RW in ((15.0, 40.0, 14.0), (5.0, 60.0, 25.0)):
+            for strike in (0.0, 40.0, 135.0, 270.0, 330.0):
+                for dip in (20.0, 45.0, 70.0, 90.0):
+                    lats, lons = random_points(self.rnd, 100)
+                    R_CD = gmpe_utils.rup_distance_array(lats, lons, LAT_EPI, LON_EPI, depth, strike, dip, RLD, RW)[3]
+                    expected = [gmpe_utils.rup_distance(lat, lon, LAT_EPI, LON_EPI, depth, strike, dip, RLD, RW)
+                                for lat, lon in zip(lats, lons)]
+                    np.testing.assert_allclose(R_CD, expected, rtol=1e-7, atol=1e-7,
+                                               err_msg="strike=%s dip=%s depth=%s" % (strike, dip, depth))
+
+    def test_samples(self):
+        #arrays of parameter samples against (N, 1) stations return (N, npts) matrices, whose columns are the 
+        #distances of each sample:
+        npts = 5
+        strikes, dips = self.rnd.uniform(0, 360, npts), self.rnd.uniform(10, 90, npts)
+        lats, lons = random_points(self.rnd, 50)
+        R_CD = gmpe_utils.FaultGeometry(LAT_EPI, LON_EPI, 10.0, strikes, dips, 30.0, 15.0).distances(lats[:, None],
+                                                                                                    lons[:, None])[3]
+        self.assertEqual(R_CD.shape, (50, npts))
+        for j in xrange(npts):
+            expected = [gmpe_utils.rup_distance(lat, lon, LAT_EPI, LON_EPI, 10.0, strikes[j], dips[j], 30.0, 15.0)
+                        for lat, lon in zip(lats, lons)]
+            np.testing.assert_allclose(R_CD[:, j], expected, rtol=1e-7, atol=1e-7)
+
+class EvaluateManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.npts = mcerp.npts
+        mcerp.npts = 50
+        self.rnd = np.random.RandomState(2)
+
+    def tearDown(self):
+        mcerp.npts = self.npts
+
+    def check(self, gmpe):
+        lats, lons = random_points(self.rnd, 40)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            I = gmpe.evaluate_many(lats, lons)
+            for i, (lat, lon) in enumerate(zip(lats, lons)):
+                expected = gmpe(lat, lon)
+                expected = expected._mcpts if isinstance(expected, mcerp.UncertainFunction) else expected
+                np.testing.assert_allclose(I[i], expected, rtol=1e-7, atol=1e-7)
+
+    def test_global_wa_rup(self):
+        self.check(GlobalWaRup(lat=LAT_EPI, lon=LON_EPI, depth=15, m=mcerp.Uniform(6.7, 6.9), strike=40, dip=60, 
+                               sof=gmpe_utils.SOF.REVERSE))
+        self.check(GlobalWaRup(lat=LAT_EPI, lon=LON_EPI, depth=15, m=6.8, strike=135, dip=30, slip=90))
+
+    def test_global_wa_hyp(self):
+        self.check(GlobalWaHyp(lat=LAT_EPI, lon=LON_EPI, depth=15, m=mcerp.Uniform(6.7, 6.9)))
+        self.check(GlobalWaHyp(lat=LAT_EPI, lon=LON_EPI, depth=15, m=6.8))
+
+if __name__ == '__main__':
+    unittest.main()
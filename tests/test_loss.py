@@ -0,0 +1,55 @@
+"""
+Tests of the loss calculation of a single location (loss_module.loss). Needs caravan/settings/user_options.py 
+(see APACHE_INSTALLATION_README.txt). Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import numpy as np
+import mcerp
+from caravan.core.risk import loss_module
+
+#target properties of a location (see exposure_module): building density bounds at index 1, area at index 3:
+TARGET_PROP = [(1, (10., 20.), None, 2.)]
+
+class StubConnection(object):
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, operation, parameters=None, prepare=False):
+        self.executed.append((operation, parameters))
+
+class LossTest(unittest.TestCase):
+
+    def setUp(self):
+        self.npts = mcerp.npts
+        mcerp.npts = 100
+
+    def tearDown(self):
+        mcerp.npts = self.npts
+
+    def test_no_building_types(self):
+        loss = loss_module.loss(1, 2, 3, 4, [], [], TARGET_PROP, {})
+        fatalities = loss.calculate()[1]
+        self.assertTrue(np.all(fatalities._mcpts == 0))
+        self.assertEqual(len(fatalities._mcpts), mcerp.npts)
+        conn = StubConnection()
+        loss.write2db(conn, [0.5])
+        values = conn.executed[0][1]
+        self.assertEqual(values[:4], (1, 2, 4, 3))
+        self.assertEqual(list(values[4]), [0, 0]) #5th and 95th percentiles
+
+    def test_building_types(self):
+        #(bldg_dist rows: id, building type id, share. bt_prop rows: building type id, _, occupancy bounds)
+        dmg = {7: mcerp.UncertainFunction(np.full(mcerp.npts, 5.)), 8: mcerp.UncertainFunction(np.zeros(mcerp.npts))}
+        loss = loss_module.loss(1, 2, 3, 4, [(0, 7, 0.5), (1, 8, 0.5)], [(7, None, 1., 1.), (8, None, 1., 1.)], 
+                                TARGET_PROP, dmg)
+        fatalities = loss.calculate()[1]._mcpts
+        #all buildings of type 7 collapse, none of type 8. Fatalities are 0.5 (nighttime coefficient) * occupancy (1) 
+        #* half of the buildings (density in [10, 20] * area 2):
+        self.assertTrue(np.all(fatalities >= 0.25 * 10 * 2) and np.all(fatalities <= 0.25 * 20 * 2))
+        self.assertGreater(np.std(fatalities), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Tests of the in-memory spatial index of the targets (spatialindex.SpatialIndex) against brute force
+great circle distances (gmpe_utils.distance) and point-in-polygon tests (spatialindex.inside_polygon).
+Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import numpy as np
+from caravan.core import spatialindex
+from caravan.core.gmpes import gmpe_utils
+
+def random_rows(rnd, n, lat0, lon0, max_deg=3.0):
+    """
+        Returns n random rows (target_id, geocell_id, lon, lat) within max_deg (great circle) from (lat0, lon0),
+        at all azimuths. Longitudes are wrapped into [-180, 180]
+    """
+    lats, lons = gmpe_utils.reckon(np.full(n, lat0), lon0, rnd.uniform(0, max_deg, n), rnd.uniform(0, 360, n))
+    lons = (np.asarray(lons) + 180) % 360 - 180
+    return [(i, 1000 + i, float(lon), float(lat)) for i, (lon, lat) in enumerate(zip(lons, lats))]
+
+def star_polygon(rnd, lat0, lon0, n=12, max_deg=2.0):
+    """
+        Returns the (non convex) polygon (poly_lons, poly_lats) of n vertices at random distances from (lat0, lon0)
+        and increasing azimuths, and the radius (km) of the circle centered in (lat0, lon0) enclosing it
+    """
+    dists = rnd.uniform(0.2, 1.0, n) * max_deg
+    poly_lats, poly_lons = gmpe_utils.reckon(np.full(n, lat0), lon0, dists, np.linspace(0, 360, n, endpoint=False))
+    return np.asarray(poly_lons), np.asarray(poly_lats), gmpe_utils.deg2km(np.max(dists)) + 1
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = np.random.RandomState(1)
+
+    def brute_force_distance(self, rows, lat, lon, radius_km):
+        return [r for r in rows if gmpe_utils.deg2km(gmpe_utils.distance(lat, lon, r[3], r[2])) <= radius_km]
+
+    def test_within_distance(self):
+        #the last center is close to the antimeridian:
+        for lat0, lon0 in ((42.87, 74.6), (-33.4, -70.6), (51.0, 179.5)):
+            rows = random_rows(self.rnd, 2000, lat0, lon0)
+            index = spatialindex.SpatialIndex(rows, 1)
+            self.assertEqual(len(index), len(rows))
+            for radius_km in (0, 10, 75, 200, 400):
+                expected = self.brute_force_distance(rows, lat0, lon0, radius_km)
+                self.assertEqual(index.within_distance(lat0, lon0, radius_km), expected, (lat0, lon0, radius_km))
+            #off-center circle:
+            self.assertEqual(index.within_distance(lat0 + 1, lon0, 150), self.brute_force_distance(rows, lat0 + 1, lon0, 150))
+
+    def test_within_box(self):
+        rows = random_rows(self.rnd, 2000, 42.87, 74.6)
+        index = spatialindex.SpatialIndex(rows)
+        expected = [r for r in rows if 73.5 <= r[2] <= 75 and 42 <= r[3] <= 43.5]
+        self.assertTrue(expected)
+        self.assertEqual(index.within_box(73.5, 42, 75, 43.5), expected)
+        #corners in any order:
+        self.assertEqual(index.within_box(75, 43.5, 73.5, 42), expected)
+
+    def test_within_polygon(self):
+        rows = random_rows(self.rnd, 2000, 42.87, 74.6)
+        index = spatialindex.SpatialIndex(rows)
+        poly_lons, poly_lats, radius_km = star_polygon(self.rnd, 42.87, 74.6)
+        lons, lats = np.array([r[2] for r in rows]), np.array([r[3] for r in rows])
+        expected = [r for r, ok in zip(rows, spatialindex.inside_polygon(lons, lats, poly_lons, poly_lats)) if ok]
+        self.assertTrue(0 < len(expected) < len(rows))
+        self.assertEqual(index.within_polygon(poly_lons, poly_lats), expected)
+        #with the enclosing circle:
+        self.assertEqual(index.within_polygon(poly_lons, poly_lats, 42.87, 74.6, radius_km), expected)
+        #closed polygon (first vertex repeated):
+        self.assertEqual(index.within_polygon(np.append(poly_lons, poly_lons[0]), np.append(poly_lats, poly_lats[0])),
+                         expected)
+
+    def test_inside_polygon(self):
+        #unit square and a concave "L" shaped polygon:
+        lons, lats = np.array([0.5, 1.5, 0.5, -0.1, 1.5]), np.array([0.5, 0.5, 1.5, 0.5, 1.5])
+        self.assertEqual(spatialindex.inside_polygon(lons, lats, [0, 1, 1, 0], [0, 0, 1, 1]).tolist(),
+                         [True, False, False, False, False])
+        self.assertEqual(spatialindex.inside_polygon(lons, lats, [0, 2, 2, 1, 1, 0], [0, 0, 1, 1, 2, 2]).tolist(),
+                         [True, True, True, False, False])
+
+    def test_missing_geometries(self):
+        rows = random_rows(self.rnd, 100, 42.87, 74.6)
+        index = spatialindex.SpatialIndex(rows + [(100, 1100, None, 42.87), (101, 1101, 74.6, None)])
+        self.assertEqual(len(index), len(rows))
+        self.assertEqual(index.within_distance(42.87, 74.6, 1000), rows)
+        #no target:
+        index = spatialindex.SpatialIndex([(0, 1000, None, None)])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.within_distance(42.87, 74.6, 1000), [])
+        self.assertEqual(index.within_box(-180, -90, 180, 90), [])
+        self.assertEqual(index.within_polygon([0, 1, 1], [0, 0, 1], 0, 0, 200), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of the closed form damage probabilities (vulnerability_module.damage_bts_cdf) against the sampled damage 
+grades (vulnerability_module.damage_grades and damage_bts_many). Run from the repository root with:
+    python -m unittest discover -s tests
+"""
+
+import unittest
+import numpy as np
+import mcerp
+from caravan.core.risk import vulnerability_module
+
+#number of damage grade samples of the sampled path:
+NUM_SAMPLES = 10000
+
+class DamageBtsCdfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.npts = mcerp.npts
+        #(a separate random generator: reseeding numpy would correlate the cached samples of different tests)
+        rnd = np.random.RandomState(1)
+        N, B = 10, 3
+        shares = rnd.random_sample((N, B, 6)) * (rnd.random_sample((N, B, 6)) < 0.5)
+        shares[:, :, 0] += 0.01
+        self.shares = shares / np.sum(shares, axis=-1)[:, :, None]
+
+    def tearDown(self):
+        mcerp.npts = self.npts
+        for cache in (vulnerability_module._VI_CACHE, vulnerability_module._QUANTILES_CACHE, vulnerability_module._DG_CACHE):
+            cache.clear()
+
+    def test_sampled(self):
+        #P(damage >= x) of each building type, closed form vs NUM_SAMPLES samples. The tolerance is about 4 times the 
+        #standard error of the sampled probabilities (the closed form discretization error is much lower):
+        for intensity in (7.5, 8.7):
+            I = np.full((len(self.shares), 1), intensity)
+            mcerp.npts = NUM_SAMPLES
+            dmg = vulnerability_module.damage_bts_many(vulnerability_module.damage_grades(I), self.shares)
+            mcerp.npts = 200
+            cdf = vulnerability_module.damage_bts_cdf(I, self.shares, (3.5, 4.5))
+            for k, x in enumerate((3.5, 4.5)):
+                sampled = np.mean(dmg >= x, axis=-1)
+                tol = 4 * np.sqrt(sampled * (1 - sampled) / float(NUM_SAMPLES)) + 0.002
+                self.assertTrue(np.all(np.abs(1 - cdf[:, :, k] - sampled) <= tol), (intensity, x))
+                #mean over all building types, where the sampling noise is lower:
+                self.assertAlmostEqual(np.mean(1 - cdf[:, :, k]), np.mean(sampled), delta=0.1 * np.mean(sampled) + 0.0005)
+
+    def test_uncertain_intensity(self):
+        #intensity samples (grouped on the intensity grid by the closed form) vs NUM_SAMPLES samples:
+        rnd = np.random.RandomState(2)
+        I = 8. + 0.5 * rnd.standard_normal((len(self.shares), NUM_SAMPLES))
+        dmg = vulnerability_module.damage_bts_many(vulnerability_module.damage_grades(I), self.shares)
+        cdf = vulnerability_module.damage_bts_cdf(I, self.shares, (3.5, 4.5))
+        for k, x in enumerate((3.5, 4.5)):
+            sampled = np.mean(dmg >= x, axis=-1)
+            tol = 4 * np.sqrt(sampled * (1 - sampled) / float(NUM_SAMPLES)) + 0.002
+            self.assertTrue(np.all(np.abs(1 - cdf[:, :, k] - sampled) <= tol), x)
+
+    def test_scalar_x(self):
+        I = np.full((len(self.shares), 1), 8.)
+        both = vulnerability_module.damage_bts_cdf(I, self.shares, (3.5, 4.5))
+        self.assertEqual(both.shape, self.shares.shape[:2] + (2,))
+        self.assertTrue(np.allclose(vulnerability_module.damage_bts_cdf(I, self.shares, 4.5), both[:, :, 1]))
+        self.assertTrue(np.all(both[:, :, 0] <= both[:, :, 1]))
+
+    def test_no_shares(self):
+        #building types with no vulnerability class shares have no damage:
+        shares = np.zeros((2, 1, 6))
+        self.assertTrue(np.allclose(vulnerability_module.damage_bts_cdf(np.full((2, 1), 9.), shares, 0.5), 1))
+
+if __name__ == '__main__':
+    unittest.main()